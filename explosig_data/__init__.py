@@ -2,18 +2,33 @@ import os
 import logging
 
 from .constants import *
-from .utils import clean_ssm_df
-from .ssm_extended import extend_ssm_df
-from .ssm_counts import counts_from_extended_ssm_df
+from .utils import clean_ssm_df, clean_ssm_chunks
+from .qc import QCReport
+from .category_schemes import CategoryScheme
+from .ssm_extended import extend_ssm_df, reference_mismatch_report
+from .ssm_checkpoint import extend_ssm_df_checkpointed
+from .ssm_counts import counts_from_extended_ssm_df, counts_dfs_from_extended_ssm_df
+from .ssm_bootstrap import bootstrap_counts
+from .ssm_cube import CountCube
+from .ssm_genes import add_gene_symbol_column, gene_counts_from_ssm_df
+from .liftover import liftover_ssm_df
+from .regions import TargetRegions, filter_ssm_df_by_regions
+from .ssm_stream import counts_from_ssm_chunks
+from .ssm_store import SimpleSomaticMutationStore, write_ssm_store
+from .arrow_io import df_from_arrow, df_to_arrow
 from .ssm_container import SimpleSomaticMutationContainer
-from .data_source_ICGC import standardize_ICGC_ssm_file
-from .data_source_TCGA import standardize_TCGA_maf_file
+from .service import MutationService, make_server
+from .ssm_shards import partition_ssm_df, map_ssm_partition, reduce_ssm_partitions
+from .data_source_ICGC import standardize_ICGC_ssm_file, standardize_ICGC_ssm_file_chunks
+from .data_source_TCGA import standardize_TCGA_maf_file, standardize_TCGA_maf_file_chunks
+from .data_source_VCF import standardize_VCF_files
 
 
 def _setup():
     os.makedirs(EXPLOSIG_DATA_DIR, exist_ok=True)
     os.makedirs(os.path.join(EXPLOSIG_DATA_DIR, 'genes'), exist_ok=True)
     os.makedirs(os.path.join(EXPLOSIG_DATA_DIR, 'genomes'), exist_ok=True)
+    os.makedirs(os.path.join(EXPLOSIG_DATA_DIR, 'liftover'), exist_ok=True)
 
 _setup()
 
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from .constants import *
+
+try:
+    import pyarrow as pa
+except ImportError:
+    # Arrow input and output require the pyarrow package
+    pa = None
+
+try:
+    import polars as pl
+except ImportError:
+    # Polars input and output also require the polars package
+    pl = None
+
+# Conversion between Arrow tables (or Polars frames) and the dataframes used by the extend and count stages.
+#
+# String columns are read through their dictionary encoding: the codes index the dictionary values,
+# so every row shares one Python string per distinct value, and chromosome codes are mapped directly to the chromosome categorical.
+# Numeric columns with a single chunk and no nulls are used as views of the Arrow buffers.
+# On output, categorical and string columns are dictionary-encoded from their codes, and numeric columns are passed as buffers.
+#
+# Output formats:
+#   'pandas'  a `pd.DataFrame` (no conversion)
+#   'arrow'   a `pyarrow.Table`
+#   'polars'  a `polars.DataFrame` (built from the Arrow table without copying)
+OUTPUT_FORMATS = [ 'pandas', 'arrow', 'polars' ]
+
+def check_output_format(output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '%s' (must be one of: %s)." % (output_format, ", ".join(OUTPUT_FORMATS)))
+    if output_format in ['arrow', 'polars'] and pa is None:
+        raise ValueError("The '%s' output format requires the pyarrow package." % output_format)
+    if output_format == 'polars' and pl is None:
+        raise ValueError("The 'polars' output format requires the polars package.")
+
+def is_arrow_data(data):
+    """Whether the data is an Arrow table or record batch, or a Polars dataframe."""
+    if pa is not None and isinstance(data, (pa.Table, pa.RecordBatch)):
+        return True
+    return pl is not None and isinstance(data, pl.DataFrame)
+
+def _chunk_codes(chunk):
+    # Dictionary codes (-1 for nulls) and dictionary values of a string or dictionary-encoded chunk
+    if not pa.types.is_dictionary(chunk.type):
+        chunk = chunk.dictionary_encode()
+    codes = chunk.indices.to_numpy(zero_copy_only=False)
+    if chunk.indices.null_count > 0:
+        codes = np.where(np.isnan(codes), -1, codes)
+    return codes.astype(np.int64), chunk.dictionary.to_numpy(zero_copy_only=False).astype(object)
+
+def _column_codes(column):
+    # Codes of a whole (chunked) column, into the concatenation of its chunks' dictionaries
+    codes = []
+    dictionaries = []
+    num_values = 0
+    for chunk in column.chunks:
+        chunk_codes, dictionary = _chunk_codes(chunk)
+        codes.append(np.where(chunk_codes >= 0, chunk_codes + num_values, -1))
+        dictionaries.append(dictionary)
+        num_values += len(dictionary)
+    return np.concatenate(codes + [np.zeros(0, dtype=np.int64)]), np.concatenate(dictionaries + [np.zeros(0, dtype=object)])
+
+def _is_string_column(column):
+    value_type = column.type.value_type if pa.types.is_dictionary(column.type) else column.type
+    return pa.types.is_string(value_type) or pa.types.is_large_string(value_type)
+
+def _column_values(colname, column):
+    if colname == COLNAME.CHR.value and _is_string_column(column):
+        codes, dictionary = _column_codes(column)
+        chr_codes = pd.Index(CHROMOSOMES).get_indexer([ str(c) for c in dictionary ])
+        chr_codes = np.append(chr_codes, -1)[codes]
+        return pd.Categorical.from_codes(chr_codes, categories=CHROMOSOMES, ordered=True)
+    if pa.types.is_dictionary(column.type) or _is_string_column(column):
+        codes, dictionary = _column_codes(column)
+        # Code -1 (null) takes the appended NaN value
+        return np.append(dictionary, np.nan)[codes]
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only=False)
+    return np.concatenate([ chunk.to_numpy(zero_copy_only=False) for chunk in column.chunks ]) if column.num_chunks > 0 else np.zeros(0)
+
+def df_from_arrow(data):
+    """Convert an Arrow table (or record batch) or a Polars dataframe to a dataframe for the extend and count stages.
+
+    Parameters
+    ----------
+    data : `pyarrow.Table`, `pyarrow.RecordBatch`, or `polars.DataFrame`
+        Mutations (or counts) with the standard column names.
+
+    Returns
+    -------
+    `pd.DataFrame`
+        The dataframe, with a range index. String columns have one Python string per distinct value, and the chromosome column is categorical.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if pyarrow is not installed.
+    """
+    if pa is None:
+        raise ValueError("Arrow input requires the pyarrow package.")
+    if pl is not None and isinstance(data, pl.DataFrame):
+        data = data.to_arrow()
+    if isinstance(data, pa.RecordBatch):
+        data = pa.Table.from_batches([data])
+
+    # Columns are inserted one at a time, since building the dataframe from a dict would copy them into a single block
+    df = pd.DataFrame(index=pd.RangeIndex(data.num_rows))
+    for colname, column in zip(data.column_names, data.columns):
+        df[colname] = _column_values(colname, column)
+    return df
+
+def as_pandas_df(data):
+    # Arrow or Polars data is converted, and anything else is passed through
+    if is_arrow_data(data):
+        return df_from_arrow(data)
+    return data
+
+def _arrow_array(values):
+    if isinstance(values, pd.Categorical):
+        return pa.DictionaryArray.from_arrays(values.codes, pa.array(np.asarray(values.categories, dtype=object), from_pandas=True), from_pandas=True)
+    if values.dtype == object:
+        codes, uniques = pd.factorize(values)
+        return pa.DictionaryArray.from_arrays(codes.astype(np.int32), pa.array(np.asarray(uniques, dtype=object), from_pandas=True), from_pandas=True)
+    return pa.array(values, from_pandas=True)
+
+def df_to_arrow(df, output_format='arrow', index_name=None):
+    """Convert a dataframe produced by the extend or count stages to an Arrow table or a Polars dataframe.
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        A simple somatic mutation or mutation count dataframe.
+    output_format : `str`, optional
+        One of `OUTPUT_FORMATS`, by default 'arrow'
+    index_name : `str`, optional
+        Name of a first column to hold the row index (e.g. the sample IDs of a count matrix), by default `None` (the index is not kept).
+
+    Returns
+    -------
+    `pyarrow.Table`, `polars.DataFrame`, or `pd.DataFrame`
+        The converted data, or the dataframe itself for the 'pandas' format.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the output format is unknown, or requires a package that is not installed.
+    """
+    check_output_format(output_format)
+    if output_format == 'pandas':
+        return df
+
+    arrays = []
+    names = []
+    if index_name is not None:
+        arrays.append(_arrow_array(np.asarray(df.index, dtype=object)))
+        names.append(index_name)
+    for colname in df.columns:
+        arrays.append(_arrow_array(df[colname].values))
+        names.append(str(colname))
+    table = pa.Table.from_arrays(arrays, names=names)
+
+    if output_format == 'polars':
+        return pl.from_arrow(table)
+    return table
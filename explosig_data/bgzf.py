@@ -0,0 +1,266 @@
+import gzip
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+# BGZF (blocked gzip, as written by bgzip/htslib) is a series of gzip members of at most 64 KiB each,
+# with the compressed size of each member stored in a 'BC' extra subfield of its header.
+# Since every block is independent, blocks can be located by reading headers only and then decompressed in parallel.
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+BGZF_MAX_BLOCK_SIZE = 65536
+
+
+def is_bgzf_file(filepath):
+    with open(filepath, 'rb') as f:
+        header = f.read(BGZF_HEADER_SIZE)
+    return len(header) == BGZF_HEADER_SIZE and header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+def is_gzip_file(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def read_block_size(f):
+    """Read the header of the BGZF block at the current file position and return the total size of the block in bytes.
+
+    Returns `None` at the end of the file. The file position is left just after the header.
+    """
+    header = f.read(12)
+    if len(header) == 0:
+        return None
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise ValueError("Not a BGZF block (file may be plain gzip rather than bgzip-compressed).")
+    extra_len = struct.unpack('<H', header[10:12])[0]
+    extra = f.read(extra_len)
+    # Search the extra subfields for the BC subfield containing the block size
+    i = 0
+    while i + 4 <= len(extra):
+        subfield_id, subfield_len = extra[i:i+2], struct.unpack('<H', extra[i+2:i+4])[0]
+        if subfield_id == b'BC' and subfield_len == 2:
+            return struct.unpack('<H', extra[i+4:i+6])[0] + 1
+        i += 4 + subfield_len
+    raise ValueError("BGZF block is missing the BC extra subfield.")
+
+def iter_raw_blocks(f):
+    """Iterate over the compressed BGZF blocks of a file object, yielding `(compressed_offset, block_bytes)` tuples."""
+    while True:
+        offset = f.tell()
+        block_size = read_block_size(f)
+        if block_size is None:
+            return
+        f.seek(offset)
+        block = f.read(block_size)
+        if len(block) != block_size:
+            raise ValueError("Truncated BGZF block at offset %d." % offset)
+        yield offset, block
+
+def decompress_block(block):
+    # zlib releases the GIL while inflating, so this can run in parallel threads
+    data = zlib.decompress(_block_payload(block), -15)
+    expected_size = struct.unpack('<I', block[-4:])[0]
+    if len(data) != expected_size:
+        raise ValueError("BGZF block decompressed to %d bytes but %d were expected." % (len(data), expected_size))
+    return data
+
+def _block_payload(block):
+    extra_len = struct.unpack('<H', block[10:12])[0]
+    return block[12 + extra_len:-BGZF_FOOTER_SIZE]
+
+def iter_bgzf_decompressed(filepath, threads=4, blocks_per_batch=64):
+    """Iterate over the decompressed contents of a BGZF file, decompressing batches of blocks in parallel threads.
+
+    Parameters
+    ----------
+    filepath : `str`
+        Path to the BGZF-compressed file.
+    threads : `int`, optional
+        Number of decompression threads, by default 4
+    blocks_per_batch : `int`, optional
+        Number of blocks to read before decompressing them in parallel, by default 64
+
+    Yields
+    ------
+    `bytes`
+        The decompressed contents of each block, in file order.
+    """
+    with open(filepath, 'rb') as f, ThreadPoolExecutor(max_workers=threads) as executor:
+        batch = []
+        for _, block in iter_raw_blocks(f):
+            batch.append(block)
+            if len(batch) == blocks_per_batch:
+                yield from executor.map(decompress_block, batch)
+                batch = []
+        if len(batch) > 0:
+            yield from executor.map(decompress_block, batch)
+
+def iter_lines(byte_chunks):
+    """Split an iterable of byte chunks into lines (without line endings), regardless of where chunk boundaries fall."""
+    remainder = b''
+    for chunk in byte_chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+    if len(remainder) > 0:
+        yield remainder
+
+def iter_file_lines(filepath, threads=4):
+    """Iterate over the lines of a plain, gzip-compressed, or BGZF-compressed text file, as `str` without line endings.
+
+    BGZF-compressed files are decompressed with `threads` parallel threads.
+    """
+    if is_bgzf_file(filepath):
+        byte_chunks = iter_bgzf_decompressed(filepath, threads=threads)
+    elif is_gzip_file(filepath):
+        byte_chunks = _iter_file_chunks(gzip.open(filepath, 'rb'))
+    else:
+        byte_chunks = _iter_file_chunks(open(filepath, 'rb'))
+    for line in iter_lines(byte_chunks):
+        # VCF 4.3 allows UTF-8 in headers and INFO values
+        yield line.rstrip(b'\r').decode('utf-8')
+
+def _iter_file_chunks(f, chunk_size=16*BGZF_MAX_BLOCK_SIZE):
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+'''Writing'''
+
+# bgzip fills each block with at most this many uncompressed bytes, so that incompressible data still fits in 64 KiB
+BGZF_BLOCK_DATA_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def compress_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(payload) + BGZF_FOOTER_SIZE
+    header = BGZF_MAGIC + struct.pack('<IBBHccHH', 0, 0, 0xff, 6, b'B', b'C', 2, block_size - 1)
+    return header + payload + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfWriter:
+    """Write a BGZF file from a stream of bytes, compressing blocks in parallel threads and recording the block offsets.
+
+    Parameters
+    ----------
+    filepath : `str`
+        Path to the output file.
+    threads : `int`, optional
+        Number of compression threads, by default 4
+    blocks_per_batch : `int`, optional
+        Number of blocks to buffer before compressing them in parallel, by default 64
+    """
+    def __init__(self, filepath, threads=4, blocks_per_batch=64):
+        self.f = open(filepath, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.blocks_per_batch = blocks_per_batch
+        self.buffer = bytearray()
+        # (compressed offset, uncompressed offset) of every block after the first, as in a .gzi index
+        self.block_offsets = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.blocks_per_batch * BGZF_BLOCK_DATA_SIZE:
+            self._flush(whole_blocks_only=True)
+
+    def _flush(self, whole_blocks_only=False):
+        num_bytes = len(self.buffer)
+        if whole_blocks_only:
+            num_bytes -= num_bytes % BGZF_BLOCK_DATA_SIZE
+        chunks = [ bytes(self.buffer[i:i+BGZF_BLOCK_DATA_SIZE]) for i in range(0, num_bytes, BGZF_BLOCK_DATA_SIZE) ]
+        del self.buffer[:num_bytes]
+        for chunk, block in zip(chunks, self.executor.map(compress_block, chunks)):
+            if self.compressed_offset > 0:
+                self.block_offsets.append((self.compressed_offset, self.uncompressed_offset))
+            self.f.write(block)
+            self.compressed_offset += len(block)
+            self.uncompressed_offset += len(chunk)
+
+    def close(self):
+        if self.f.closed:
+            return
+        self._flush()
+        self.f.write(BGZF_EOF)
+        self.f.close()
+        self.executor.shutdown()
+
+    def write_gzi(self, gzi_filepath):
+        """Write the block offsets in the .gzi index format of bgzip/samtools."""
+        with open(gzi_filepath, 'wb') as f:
+            f.write(struct.pack('<Q', len(self.block_offsets)))
+            for compressed_offset, uncompressed_offset in self.block_offsets:
+                f.write(struct.pack('<QQ', compressed_offset, uncompressed_offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_gzi(gzi_filepath):
+    """Read a .gzi index, returning a list of `(compressed_offset, uncompressed_offset)` tuples for every block, including the first."""
+    with open(gzi_filepath, 'rb') as f:
+        num_entries = struct.unpack('<Q', f.read(8))[0]
+        entries = f.read(16 * num_entries)
+    return [(0, 0)] + [ struct.unpack('<QQ', entries[i:i+16]) for i in range(0, len(entries), 16) ]
+
+'''FASTA'''
+
+def bgzip_fasta(input_fasta_file, output_fasta_file, threads=4):
+    """Recompress a plain or gzip-compressed FASTA file with BGZF, writing the `.fai` and `.gzi` indexes alongside it.
+
+    Parameters
+    ----------
+    input_fasta_file : `str`
+        Path to the plain or gzip-compressed FASTA file.
+    output_fasta_file : `str`
+        Path to the BGZF-compressed output. The indexes are written to this path with `.fai` and `.gzi` appended.
+    threads : `int`, optional
+        Number of compression threads, by default 4
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the lines of a sequence do not have the same length (except the last), since such files cannot be indexed.
+    """
+    if is_gzip_file(input_fasta_file):
+        byte_chunks = _iter_file_chunks(gzip.open(input_fasta_file, 'rb'))
+    else:
+        byte_chunks = _iter_file_chunks(open(input_fasta_file, 'rb'))
+
+    fai_rows = []
+    # Current record: [name, length, offset, line bases, line width, whether a short line has been seen]
+    record = None
+    offset = 0
+    with BgzfWriter(output_fasta_file, threads=threads) as writer:
+        def write_through(chunks):
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+
+        for line in iter_lines(write_through(byte_chunks)):
+            line_width = len(line) + 1
+            line = line.rstrip(b'\r')
+            if line.startswith(b'>'):
+                if record is not None:
+                    fai_rows.append(record[:5])
+                record = [line[1:].split()[0].decode('ascii'), 0, offset + line_width, 0, 0, False]
+            elif record is not None and len(line) > 0:
+                if record[3] == 0:
+                    record[3], record[4] = len(line), line_width
+                elif record[5] or len(line) > record[3] or line_width - len(line) != record[4] - record[3]:
+                    raise ValueError("Sequence '%s' has lines of different lengths, so it cannot be indexed." % record[0])
+                record[5] = (len(line) < record[3])
+                record[1] += len(line)
+            offset += line_width
+        if record is not None:
+            fai_rows.append(record[:5])
+
+    writer.write_gzi(output_fasta_file + '.gzi')
+    with open(output_fasta_file + '.fai', 'w') as f:
+        for row in fai_rows:
+            f.write('\t'.join(map(str, row)) + '\n')
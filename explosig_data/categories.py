@@ -1,8 +1,10 @@
 from itertools import product
 import math
+import numpy as np
 from Bio.Seq import reverse_complement
 
 from .constants import *
+from .kernels import encode_sequences, reverse_complement_sequences, repeat_scans
 
 
 '''
@@ -134,15 +136,15 @@ def DBS_category_list_helper(ref_only=False):
             if ref == 'TA': vars -= set(['AG', 'CC', 'AC'])
             if ref == 'CG': vars -= set(['AC', 'AA', 'GA'])
             if ref == 'GC': vars -= set(['CT', 'TT', 'TG'])
-        return zip([ref] * len(vars), vars)
+        return zip([ref] * len(vars), sorted(vars))
     cats = []
     if ref_only:
         # Only list the 10 AC>NN categories
-        cats = [ DBS_10_category_name({REF:ref}) for ref in refs ]
+        cats = [ DBS_10_category_name({COLNAME.REF.value:ref}) for ref in sorted(refs) ]
     else:
         # List all 78
-        for ref in refs:
-            cats += [ DBS_78_category_name({REF:inner_ref, VAR:inner_var}) for inner_ref, inner_var in dbs_cats_for_ref(ref) ]
+        for ref in sorted(refs): # sorted, so that the order does not depend on set iteration order
+            cats += [ DBS_78_category_name({COLNAME.REF.value:inner_ref, COLNAME.VAR.value:inner_var}) for inner_ref, inner_var in dbs_cats_for_ref(ref) ]
     return cats
 
 
@@ -350,6 +352,88 @@ def INDEL_Alexandrov2018_category_name_helper(five_prime, ref, variant, three_pr
             raise ValueError('Flanking base pair lengths too short for indel classification')
     return (cat_name, subcat_name)
 
+def INDEL_Alexandrov2018_16_category_names(df, kernel_backend='auto'):
+    return INDEL_Alexandrov2018_category_names_helper(df[COLNAME.FPRIME.value].values, df[COLNAME.REF.value].values,
+                                                        df[COLNAME.VAR.value].values, df[COLNAME.TPRIME.value].values, kernel_backend)[0]
+
+def INDEL_Alexandrov2018_83_category_names(df, kernel_backend='auto'):
+    return INDEL_Alexandrov2018_category_names_helper(df[COLNAME.FPRIME.value].values, df[COLNAME.REF.value].values,
+                                                        df[COLNAME.VAR.value].values, df[COLNAME.TPRIME.value].values, kernel_backend)[1]
+
+def _INDEL_Alexandrov2018_names(is_ins, unit_base, indel_length, n_repeat_units, n_overlap):
+    # Category and subcategory names of one combination of the values computed by INDEL_Alexandrov2018_category_names_helper
+    if n_overlap >= 0:
+        cat_name = 'DEL_MH_' + str(indel_length) + ('+' if indel_length == ALEXANDROV_INDEL_RANGE_MAX else '')
+        return (cat_name, cat_name + '_' + str(n_overlap) + ('+' if n_overlap == 5 else ''))
+    if unit_base != '':
+        cat_name = ('INS_' if is_ins else 'DEL_') + unit_base + '_1'
+    else:
+        cat_name = ('INS_repeats_' if is_ins else 'DEL_repeats_') + str(indel_length) + ('+' if indel_length == ALEXANDROV_INDEL_RANGE_MAX else '')
+    return (cat_name, cat_name + '_' + str(n_repeat_units) + ('+' if n_repeat_units == max(ALEXANDROV_REPEAT_INS_RANGE) else ''))
+
+def INDEL_Alexandrov2018_category_names_helper(five_primes, refs, variants, three_primes, kernel_backend='auto'):
+    """Batch version of `INDEL_Alexandrov2018_category_name_helper`, with the same results.
+
+    Sequences are reverse complemented with numpy, and the homopolymer, repeat, and microhomology scans run in a kernel (see `kernels.py`).
+
+    Returns
+    -------
+    `tuple`
+        (Alexandrov2018_16 names, Alexandrov2018_83 names) arrays.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if a mutation is not an insertion or deletion, or its flanking sequences are too short.
+    """
+    refs = np.array([ str(r) for r in refs ], dtype=object)
+    variants = np.array([ str(v) for v in variants ], dtype=object)
+    ref_lengths = np.array([ len(r) for r in refs ], dtype=np.int64)
+    var_lengths = np.array([ len(v) for v in variants ], dtype=np.int64)
+    # Reverse complements of 1bp purine refs leave the (deleted) variant as '-', so the units are those of the indels on the pyrimidine strand
+    is_ins = (refs == '-') & (var_lengths >= 1)
+    is_del = ~is_ins & (ref_lengths >= 1) & (variants == '-')
+    if not (is_ins | is_del).all():
+        raise ValueError("Received a mutation that is not an insertion or deletion.")
+    units = np.where(is_ins, variants, refs)
+    unit_lengths = np.where(is_ins, var_lengths, ref_lengths)
+
+    flanks, flank_lengths = encode_sequences(np.concatenate([np.asarray(five_primes, dtype=object), np.asarray(three_primes, dtype=object)]))
+    five_matrix, three_matrix = flanks[:len(refs)], flanks[len(refs):]
+    five_lengths, three_lengths = flank_lengths[:len(refs)], flank_lengths[len(refs):]
+    max_repeats = max(ALEXANDROV_REPEAT_INS_RANGE)
+    if ((five_lengths < max_repeats * unit_lengths) | (three_lengths < max_repeats * unit_lengths)).any():
+        raise ValueError('Flanking base pair lengths too short for indel classification')
+
+    # 1bp purine units are reverse complemented along with their flanks, which are swapped
+    purine_rows = np.flatnonzero((unit_lengths == 1) & np.isin(units, list(PURINES)))
+    units[purine_rows] = [ BASE_PAIR[u] for u in units[purine_rows] ]
+    five_rows = five_matrix[purine_rows].copy()
+    five_matrix[purine_rows], three_matrix[purine_rows] = three_matrix[purine_rows], five_rows
+    five_lengths[purine_rows], three_lengths[purine_rows] = three_lengths[purine_rows], five_lengths[purine_rows]
+    reverse_complement_sequences(five_matrix, five_lengths, purine_rows)
+    reverse_complement_sequences(three_matrix, three_lengths, purine_rows)
+
+    unit_matrix, unit_lengths = encode_sequences(units)
+    tprime_repeats, fprime_repeats, tprime_overlaps, fprime_overlaps = repeat_scans(
+        unit_matrix, unit_lengths, five_matrix, five_lengths, three_matrix, three_lengths, max_repeats, backend=kernel_backend
+    )
+    n_repeat_units = np.minimum(tprime_repeats + fprime_repeats, max_repeats)
+    # Deletions longer than 1bp without repeats are classified by their microhomology
+    n_overlaps = np.where(is_del & (unit_lengths > 1) & (n_repeat_units == 0), np.maximum(tprime_overlaps, fprime_overlaps), -1)
+
+    # Names are built once for each distinct combination of values
+    unit_bases = np.where(unit_lengths == 1, units, '')
+    unit_base_values, unit_base_codes = np.unique(unit_bases.astype(str), return_inverse=True)
+    keys = np.stack([is_ins.astype(np.int64), unit_base_codes.reshape(-1), np.minimum(unit_lengths, ALEXANDROV_INDEL_RANGE_MAX), n_repeat_units, n_overlaps], axis=1)
+    unique_keys, key_ids = np.unique(keys, axis=0, return_inverse=True)
+    names = [ _INDEL_Alexandrov2018_names(bool(k[0]), unit_base_values[k[1]], k[2], k[3], k[4]) for k in unique_keys ]
+    key_ids = key_ids.reshape(-1)
+    return (
+        np.array([ n[0] for n in names ], dtype=object)[key_ids],
+        np.array([ n[1] for n in names ], dtype=object)[key_ids]
+    )
+
 # Lists
 def INDEL_Alexandrov2018_16_category_list():
     cats = []
@@ -393,3 +477,27 @@ def INDEL_Alexandrov2018_83_category_list():
 
 def INDEL_Haradhvala2018_8_category_list():
     return ["INS1", "INS2", "INS3", "INS4", "DEL1", "DEL2", "DEL3", "DEL4"]
+
+
+'''
+Category schemes by column name
+'''
+# Maps category name functions to batch versions that name all rows of a dataframe at once, with the same results
+BATCH_CATEGORY_NAME_FUNCTIONS = {
+    INDEL_Alexandrov2018_16_category_name: INDEL_Alexandrov2018_16_category_names,
+    INDEL_Alexandrov2018_83_category_name: INDEL_Alexandrov2018_83_category_names,
+}
+
+# Maps category column names to tuples: (category_name_func, `list` of applicable mutation type enum values, category_list_func)
+CATEGORY_SCHEMES = {
+    'SBS_6': (SBS_6_category_name, [MUT_TYPE_VAL.SBS.value], SBS_6_category_list),
+    'SBS_12': (SBS_12_category_name, [MUT_TYPE_VAL.SBS.value], SBS_12_category_list),
+    'SBS_96': (SBS_96_category_name, [MUT_TYPE_VAL.SBS.value], SBS_96_category_list),
+    'SBS_192': (SBS_192_category_name, [MUT_TYPE_VAL.SBS.value], SBS_192_category_list),
+    'SBS_1536': (SBS_1536_category_name, [MUT_TYPE_VAL.SBS.value], SBS_1536_category_list),
+    'DBS_10': (DBS_10_category_name, [MUT_TYPE_VAL.DBS.value], DBS_10_category_list),
+    'DBS_78': (DBS_78_category_name, [MUT_TYPE_VAL.DBS.value], DBS_78_category_list),
+    'INDEL_Alexandrov2018_16': (INDEL_Alexandrov2018_16_category_name, [MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value], INDEL_Alexandrov2018_16_category_list),
+    'INDEL_Alexandrov2018_83': (INDEL_Alexandrov2018_83_category_name, [MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value], INDEL_Alexandrov2018_83_category_list),
+    'INDEL_Haradhvala2018_8': (INDEL_Haradhvala2018_8_category_name, [MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value], INDEL_Haradhvala2018_8_category_list),
+}
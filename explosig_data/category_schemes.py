@@ -0,0 +1,205 @@
+from itertools import product
+import numpy as np
+import pandas as pd
+from Bio.Seq import reverse_complement
+
+from .constants import *
+from .categories import *
+
+# Largest number of (flanks, reference, variant) base combinations for which a classification table is built
+MAX_SCHEME_DOMAIN_SIZE = 4 ** 9
+
+# Strand canonicalization rules:
+#   None             names are built from the genomic (+) strand
+#   'pyrimidine'     mutations whose (first) reference base is a purine are reverse complemented, with their flanks
+#   'transcription'  mutations on the - transcription strand are reverse complemented; mutations without one strand are not classified
+CANONICAL_RULES = [ None, 'pyrimidine', 'transcription' ]
+
+_BASE_CODES = np.full(256, -1, dtype=np.int64)
+for _i, _base in enumerate(BASES):
+    _BASE_CODES[ord(_base)] = _i
+
+class CategoryScheme:
+    """A declarative substitution category scheme, compiled once into a lookup table that classifies all rows of a dataframe at once.
+
+    Every combination of flanking, reference, and variant bases is named when the scheme is compiled,
+    so a mutation is classified by encoding its bases as an integer and indexing the table.
+    A scheme can also be used where a category name function is expected, e.g. `category_functions={ 'SBS_24': (scheme, scheme.mut_types) }`,
+    and `extend_ssm_df` then uses the table rather than calling it row by row.
+
+    Parameters
+    ----------
+    mut_types : `list`
+        Mutation type enum values to which the scheme applies, by default SBS.
+    ref_length : `int`, optional
+        Number of reference (and variant) bases, e.g. 1 for single-base or 2 for doublet-base substitutions, by default 1
+    flank_size : `int`, optional
+        Number of flanking bases on each side, by default 1
+    canonical : `str`, optional
+        Strand canonicalization rule (one of `CANONICAL_RULES`), by default 'pyrimidine'
+    template : `str`, optional
+        Format string of category names, with the fields five, ref, var, and three, by default '{five}[{ref}>{var}]{three}'
+    expression : `function`, optional
+        Function (five, ref, var, three) returning a category name (or `None`) to use instead of the template.
+        It is only called while compiling the scheme.
+    mapping : `dict`, optional
+        Mapping from names to category names (or `None`), applied after the template or expression, e.g. to merge categories.
+    categories : `list`, optional
+        Category values in the order of the count matrix columns, e.g. `SBS_96_category_list()`. Names not in the list are not classified.
+        By default, all names in sorted order.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the canonicalization rule is unknown, or there are too many base combinations to tabulate.
+    """
+    def __init__(self, mut_types=None, ref_length=1, flank_size=1, canonical='pyrimidine', template='{five}[{ref}>{var}]{three}',
+                    expression=None, mapping=None, categories=None):
+        if canonical not in CANONICAL_RULES:
+            raise ValueError("Unknown canonicalization rule '%s'." % canonical)
+        if 4 ** (2 * flank_size + 2 * ref_length) > MAX_SCHEME_DOMAIN_SIZE:
+            raise ValueError("Too many base combinations for a scheme with %d reference and %d flanking bases." % (ref_length, flank_size))
+
+        self.mut_types = mut_types if mut_types is not None else [MUT_TYPE_VAL.SBS.value]
+        self.ref_length = ref_length
+        self.flank_size = flank_size
+        self.canonical = canonical
+        self.template = template
+        self.expression = expression
+        self.mapping = mapping if mapping is not None else {}
+        self.categories = list(categories) if categories is not None else None
+        self._category_set = set(self.categories) if categories is not None else None
+        self._names = None
+        self._table = None
+
+    def _name(self, five, ref, var, three, tstrand=TSTRAND_VAL.PLUS.value):
+        # Name of one combination of bases, or None. Used to build the table, and for row by row calls.
+        if len(ref) != self.ref_length or len(var) != self.ref_length or len(five) < self.flank_size or len(three) < self.flank_size:
+            return None
+        five = five[len(five) - self.flank_size:]
+        three = three[:self.flank_size]
+        if not set(five + ref + var + three) <= set(BASES) or any(r == v for r, v in zip(ref, var)):
+            return None
+
+        if self.canonical == 'pyrimidine':
+            reverse = (ref[0] in PURINES)
+        elif self.canonical == 'transcription':
+            if tstrand not in [TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value]:
+                return None
+            reverse = (tstrand == TSTRAND_VAL.MINUS.value)
+        else:
+            reverse = False
+        if reverse:
+            five, ref, var, three = reverse_complement(three), reverse_complement(ref), reverse_complement(var), reverse_complement(five)
+
+        if self.expression is not None:
+            name = self.expression(five, ref, var, three)
+        else:
+            name = self.template.format(five=five, ref=ref, var=var, three=three)
+        name = self.mapping.get(name, name)
+        if name is None or (self._category_set is not None and name not in self._category_set):
+            return None
+        return name
+
+    def compile(self):
+        """Build the classification table (done once, on first use)."""
+        if self._table is not None:
+            return self
+        tstrands = [TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value] if self.canonical == 'transcription' else [TSTRAND_VAL.PLUS.value]
+        names = []
+        # Combinations are enumerated in the order of their integer codes: (5' flank, reference, variant, 3' flank) bases as base-4 digits
+        for bases in product(BASES, repeat=2 * self.flank_size + 2 * self.ref_length):
+            bases = ''.join(bases)
+            five = bases[:self.flank_size]
+            ref = bases[self.flank_size:self.flank_size + self.ref_length]
+            var = bases[self.flank_size + self.ref_length:self.flank_size + 2 * self.ref_length]
+            three = bases[self.flank_size + 2 * self.ref_length:]
+            for tstrand in tstrands:
+                names.append(self._name(five, ref, var, three, tstrand))
+
+        categories = self.categories if self.categories is not None else sorted(set(names) - {None})
+        self._names = np.array(list(categories) + [NAN_VAL], dtype=object)
+        name_codes = { name: i for i, name in enumerate(categories) }
+        self._table = np.array([ name_codes.get(name, -1) for name in names ], dtype=np.int64).reshape(-1, len(tstrands))
+        return self
+
+    def category_list(self):
+        """Get the list of category values, for the counts stage (like the `*_category_list()` functions)."""
+        if self.categories is not None:
+            return list(self.categories)
+        return list(self.compile()._names[:-1])
+
+    def __call__(self, row):
+        # Row by row use as a category name function
+        name = self._name(str(row[COLNAME.FPRIME.value]), str(row[COLNAME.REF.value]), str(row[COLNAME.VAR.value]), str(row[COLNAME.TPRIME.value]),
+                            row[COLNAME.TSTRAND.value] if self.canonical == 'transcription' else TSTRAND_VAL.PLUS.value)
+        return name if name is not None else NAN_VAL
+
+    def classify(self, df, mut_types=None):
+        """Name the category of every row of an extended dataframe (with flanking base and transcription strand columns).
+
+        Parameters
+        ----------
+        df : `pd.DataFrame`
+            An extended simple somatic mutation dataframe (flanking base and transcription strand columns are all that is needed).
+        mut_types : `list`, optional
+            Mutation type enum values of the rows to classify, by default those of the scheme.
+
+        Returns
+        -------
+        `np.array`
+            Category names, or `NAN_VAL` for rows of other mutation types or that the scheme does not classify.
+        """
+        self.compile()
+        k = self.flank_size
+        width = 2 * k + 2 * self.ref_length
+        if mut_types is None:
+            mut_types = self.mut_types
+        rows = np.flatnonzero(df[COLNAME.MUT_TYPE.value].isin(mut_types).values)
+        name_codes = np.full(df.shape[0], -1, dtype=np.int64)
+        if len(rows) == 0:
+            return self._names[name_codes]
+
+        fprimes = df[COLNAME.FPRIME.value].iloc[rows].astype(str)
+        tprimes = df[COLNAME.TPRIME.value].iloc[rows].astype(str)
+        refs = df[COLNAME.REF.value].iloc[rows].astype(str)
+        variants = df[COLNAME.VAR.value].iloc[rows].astype(str)
+        valid = ((refs.str.len() == self.ref_length) & (variants.str.len() == self.ref_length)
+                    & (fprimes.str.len() >= k) & (tprimes.str.len() >= k)).values
+        bases = (fprimes.str.slice(-k) if k > 0 else '') + refs + variants + tprimes.str.slice(0, k)
+
+        # Encode the bases of each row as base-4 digits
+        encoded = np.array(np.where(valid, bases.values, 'N' * width).tolist(), dtype='S%d' % width)
+        digits = _BASE_CODES[np.frombuffer(encoded.tobytes(), dtype=np.uint8).reshape(len(rows), width)]
+        valid &= (digits >= 0).all(axis=1)
+        combination_codes = (np.maximum(digits, 0) * (4 ** np.arange(width - 1, -1, -1, dtype=np.int64))).sum(axis=1)
+
+        if self.canonical == 'transcription':
+            tstrands = df[COLNAME.TSTRAND.value].iloc[rows].values
+            valid &= np.isin(tstrands, [TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value])
+            strand_codes = (tstrands == TSTRAND_VAL.MINUS.value).astype(np.int64)
+        else:
+            strand_codes = np.zeros(len(rows), dtype=np.int64)
+        name_codes[rows[valid]] = self._table[combination_codes[valid], strand_codes[valid]]
+        return self._names[name_codes]
+
+
+def _DBS_10_expression(five, ref, var, three):
+    return DBS_10_category_name({ COLNAME.REF.value: ref })
+
+def _DBS_78_expression(five, ref, var, three):
+    return DBS_78_category_name({ COLNAME.REF.value: ref, COLNAME.VAR.value: var })
+
+# Declarative versions of the substitution schemes in categories.py, with the same names and category lists.
+# Applicable to mutations with canonical bases (not 'N').
+DECLARATIVE_CATEGORY_SCHEMES = {
+    'SBS_6': CategoryScheme(flank_size=0, template='{ref}>{var}', categories=SBS_6_category_list()),
+    'SBS_12': CategoryScheme(flank_size=0, canonical='transcription', template='{ref}>{var}', categories=SBS_12_category_list()),
+    'SBS_96': CategoryScheme(flank_size=1, categories=SBS_96_category_list()),
+    'SBS_192': CategoryScheme(flank_size=1, canonical='transcription', categories=SBS_192_category_list()),
+    'SBS_1536': CategoryScheme(flank_size=2, categories=SBS_1536_category_list()),
+    'DBS_10': CategoryScheme(mut_types=[MUT_TYPE_VAL.DBS.value], ref_length=2, flank_size=0, canonical=None,
+                                expression=_DBS_10_expression, categories=DBS_10_category_list()),
+    'DBS_78': CategoryScheme(mut_types=[MUT_TYPE_VAL.DBS.value], ref_length=2, flank_size=0, canonical=None,
+                                expression=_DBS_78_expression, categories=DBS_78_category_list()),
+}
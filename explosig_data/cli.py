@@ -0,0 +1,433 @@
+import os
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from tqdm import tqdm
+
+from .constants import *
+from .categories import CATEGORY_SCHEMES
+from .i_o import FORMAT, read_standard_ssm_file, write_json_atomic, PrefetchIterator
+from .ssm_extended import extend_ssm_df
+from .ssm_counts import counts_dfs_from_extended_ssm_df
+from .ssm_stream import CountsAccumulator
+from .qc import QCReport
+from .regions import TargetRegions, filter_ssm_df_by_regions
+from .service import MutationService, make_server
+from .ssm_shards import partition_ssm_df, map_ssm_partition, reduce_ssm_partitions, read_shard_manifest
+from .data_source_ICGC import standardize_ICGC_ssm_file, standardize_ICGC_ssm_file_chunks
+from .data_source_TCGA import standardize_TCGA_maf_file, standardize_TCGA_maf_file_chunks
+from .data_source_VCF import standardize_VCF_files
+from .genomes import GENOME_FORMATS, download_human_genomes, get_human_genomes_dict
+from .genes import download_human_genes, get_human_genes_dict
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+SOURCES = ['icgc', 'tcga', 'vcf', 'standard']
+OUTPUT_FORMATS = ['tsv', 'csv', 'pickle', 'parquet']
+DEFAULT_CATEGORIES = ['SBS_96', 'DBS_78', 'INDEL_Alexandrov2018_83']
+
+
+class UsageError(Exception):
+    pass
+
+
+'''
+Reference data (loaded once per process)
+'''
+_references = {}
+
+def _load_references(cache_dir, download, genome_format='fasta'):
+    _references['genomes'] = get_human_genomes_dict(data_dir=cache_dir, download=download, genome_format=genome_format)
+    _references['genes'] = get_human_genes_dict(data_dir=cache_dir, download=download)
+
+def _prepare_references(cache_dir, jobs, genome_format='fasta'):
+    # Shared genomes are published once here, so that worker processes only attach to them
+    if jobs == 1 or genome_format == 'shared':
+        _load_references(cache_dir, download=True, genome_format=genome_format)
+    else:
+        # Download once here, then each worker process loads its own copy without re-running snakemake
+        download_human_genomes(data_dir=cache_dir, genome_format=genome_format)
+        download_human_genes(data_dir=cache_dir)
+
+def _close_references():
+    # Closing the last attachment to a shared genome removes it
+    for genome in _references.pop('genomes', {}).values():
+        if hasattr(genome, 'close'):
+            genome.close()
+
+def _new_executor(cache_dir, jobs, genome_format='fasta'):
+    return ProcessPoolExecutor(max_workers=jobs, initializer=_load_references, initargs=(cache_dir, False, genome_format))
+
+
+'''
+Pipeline steps
+'''
+def iter_input_chunks(input_file, source, chunksize=None, assembly=None, seq_type=None, **kwargs):
+    """Iterate over standardized dataframes for an input file, one per chunk (or a single dataframe if `chunksize` is `None`).
+
+    The genome assembly and sequencing strategy are only set for VCF files, which do not record them (by default GRCh37 and WGS).
+    """
+    _check_source_args(source, assembly, seq_type)
+    if source == 'icgc':
+        if chunksize:
+            yield from standardize_ICGC_ssm_file_chunks(input_file, chunksize=chunksize, **kwargs)
+        else:
+            yield standardize_ICGC_ssm_file(input_file, wrap=False, **kwargs)
+    elif source == 'tcga':
+        if chunksize:
+            yield from standardize_TCGA_maf_file_chunks(input_file, chunksize=chunksize, **kwargs)
+        else:
+            yield standardize_TCGA_maf_file(input_file, wrap=False, **kwargs)
+    elif source == 'vcf':
+        # VCF files hold one sample each, so they are always processed whole
+        if assembly is not None:
+            kwargs['assembly'] = assembly
+        if seq_type is not None:
+            kwargs['seq_type'] = seq_type
+        yield standardize_VCF_files([input_file], wrap=False, **kwargs)
+    elif source == 'standard':
+        if chunksize:
+            yield from read_standard_ssm_file(input_file, chunksize=chunksize)
+        else:
+            yield read_standard_ssm_file(input_file)
+    else:
+        raise UsageError("Unknown input source '%s'." % source)
+
+def _load_target_regions(args):
+    if args.target_regions is None:
+        return None
+    _check_inputs([args.target_regions])
+    return TargetRegions.from_bed(args.target_regions, padding=args.region_padding)
+
+def _count_chunk(ssm_chunk, category_lists, reference_mismatch):
+    category_functions = { colname: CATEGORY_SCHEMES[colname][:2] for colname in category_lists.keys() }
+    extended_df = extend_ssm_df(ssm_chunk, category_functions=category_functions,
+                                genomes=_references['genomes'], genes=_references['genes'],
+                                reference_mismatch=reference_mismatch)
+    qc_report = QCReport()
+    counts = counts_dfs_from_extended_ssm_df(extended_df, category_lists, sparse_output=True, qc_report=qc_report)
+    return extended_df.shape[0], pd.unique(extended_df[COLNAME.SAMPLE.value].values), counts, qc_report
+
+def _map_partition(shard_dir, partition_id, category_lists, write_extended, reference_mismatch):
+    category_functions = { colname: CATEGORY_SCHEMES[colname][:2] for colname in category_lists.keys() }
+    return map_ssm_partition(shard_dir, partition_id, category_lists, category_functions=category_functions,
+                                genomes=_references['genomes'], genes=_references['genes'],
+                                write_extended=write_extended, reference_mismatch=reference_mismatch, console_verbosity=logging.WARNING)
+
+def write_output(df, output_dir, name, output_format):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, '%s.%s' % (name, output_format))
+    if output_format == 'tsv':
+        df.to_csv(path, sep='\t', index_label=COLNAME.SAMPLE.value)
+    elif output_format == 'csv':
+        df.to_csv(path, index_label=COLNAME.SAMPLE.value)
+    elif output_format == 'pickle':
+        df.to_pickle(path)
+    elif output_format == 'parquet':
+        df.to_parquet(path)
+    return path
+
+def _check_output_format(output_format):
+    if output_format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise UsageError("The parquet output format requires the pyarrow package.")
+
+def _check_inputs(input_files):
+    missing_files = [ f for f in input_files if not os.path.exists(f) ]
+    if len(missing_files) > 0:
+        raise UsageError("Input file(s) not found: %s" % ", ".join(missing_files))
+
+def _check_source_args(source, assembly, seq_type):
+    if source != 'vcf' and (assembly is not None or seq_type is not None):
+        raise UsageError("--assembly and --seq-type only apply to VCF input (other sources record them per mutation).")
+
+
+'''
+Commands
+'''
+def run_command(args, summary):
+    _check_inputs(args.inputs)
+    _check_source_args(args.source, args.assembly, args.seq_type)
+    _check_output_format(args.output_format)
+    category_lists = { colname: CATEGORY_SCHEMES[colname][2]() for colname in args.categories }
+
+    start = time.time()
+    _prepare_references(args.cache_dir, args.jobs, args.genome_format)
+    summary['timings']['load_references'] = time.time() - start
+
+    start = time.time()
+    regions = _load_target_regions(args)
+    accumulators = { colname: CountsAccumulator(values) for colname, values in category_lists.items() }
+    # Standardization is reported from the reading thread, and counting from the main thread
+    standardize_qc_report, count_qc_report = QCReport(), QCReport()
+    progress = tqdm(unit='rows', unit_scale=True, disable=args.no_progress, desc='Extending and counting')
+
+    def chunks():
+        for input_file in args.inputs:
+            for ssm_chunk in iter_input_chunks(input_file, args.source, chunksize=args.chunksize, assembly=args.assembly, seq_type=args.seq_type,
+                                                qc_report=standardize_qc_report, cancer_type=args.cancer_type, provenance=args.provenance, cohort=args.cohort):
+                if regions is not None:
+                    ssm_chunk = filter_ssm_df_by_regions(ssm_chunk, regions, qc_report=standardize_qc_report)
+                if ssm_chunk.shape[0] > 0:
+                    yield ssm_chunk
+
+    def collect(result):
+        num_rows, sample_order, counts, qc_report = result
+        count_qc_report.merge(qc_report)
+        for colname, counts_df in counts.items():
+            accumulators[colname].add(counts_df, colname, sample_order=sample_order)
+        summary['rows'] += num_rows
+        progress.update(num_rows)
+
+    # Read and standardize the next chunk (or input file) in a background thread while the current one is processed
+    with progress, PrefetchIterator(chunks(), max_prefetch=args.prefetch) as ssm_chunks:
+        if args.jobs == 1:
+            for ssm_chunk in ssm_chunks:
+                collect(_count_chunk(ssm_chunk, category_lists, args.reference_mismatch))
+        else:
+            with _new_executor(args.cache_dir, args.jobs, args.genome_format) as executor:
+                # Bound the number of chunks in flight, and collect results in submission order so that output is deterministic
+                pending = deque()
+                for ssm_chunk in ssm_chunks:
+                    pending.append(executor.submit(_count_chunk, ssm_chunk, category_lists, args.reference_mismatch))
+                    if len(pending) >= 2 * args.jobs:
+                        collect(pending.popleft().result())
+                while len(pending) > 0:
+                    collect(pending.popleft().result())
+    summary['timings']['process'] = time.time() - start
+    summary['qc'] = standardize_qc_report.merge(count_qc_report).to_dict()
+
+    start = time.time()
+    for colname, accumulator in accumulators.items():
+        # Sorted by sample ID, so that the output does not depend on the chunk size (and matches the reduce command)
+        counts_df = accumulator.to_df()
+        summary['outputs'][colname] = write_output(counts_df, args.output_dir, colname, args.output_format)
+    summary['timings']['write_outputs'] = time.time() - start
+
+def partition_command(args, summary):
+    _check_inputs(args.inputs)
+    _check_source_args(args.source, args.assembly, args.seq_type)
+
+    start = time.time()
+    regions = _load_target_regions(args)
+    ssm_df = pd.concat([
+        (ssm_chunk if regions is None else filter_ssm_df_by_regions(ssm_chunk, regions))
+        for input_file in args.inputs
+        for ssm_chunk in iter_input_chunks(input_file, args.source, chunksize=args.chunksize, assembly=args.assembly, seq_type=args.seq_type,
+                                            cancer_type=args.cancer_type, provenance=args.provenance, cohort=args.cohort)
+    ], ignore_index=True)
+    summary['rows'] = int(ssm_df.shape[0])
+    summary['timings']['standardize'] = time.time() - start
+
+    start = time.time()
+    summary['outputs']['partitions'] = partition_ssm_df(ssm_df, args.shard_dir, num_partitions=args.partitions, by=args.by)
+    summary['timings']['partition'] = time.time() - start
+
+def map_command(args, summary):
+    category_lists = { colname: CATEGORY_SCHEMES[colname][2]() for colname in args.categories }
+    partition_ids = args.partition if args.partition else read_shard_manifest(args.shard_dir)['partitions']
+
+    start = time.time()
+    _prepare_references(args.cache_dir, args.jobs, args.genome_format)
+    summary['timings']['load_references'] = time.time() - start
+
+    start = time.time()
+    processed_ids = []
+    with tqdm(total=len(partition_ids), unit='partitions', disable=args.no_progress, desc='Mapping partitions') as progress:
+        if args.jobs == 1:
+            for partition_id in partition_ids:
+                if _map_partition(args.shard_dir, partition_id, category_lists, not args.no_extended, args.reference_mismatch):
+                    processed_ids.append(partition_id)
+                progress.update(1)
+        else:
+            with _new_executor(args.cache_dir, args.jobs, args.genome_format) as executor:
+                futures = [
+                    (partition_id, executor.submit(_map_partition, args.shard_dir, partition_id, category_lists, not args.no_extended, args.reference_mismatch))
+                    for partition_id in partition_ids
+                ]
+                for partition_id, future in futures:
+                    if future.result():
+                        processed_ids.append(partition_id)
+                    progress.update(1)
+    summary['outputs']['processed_partitions'] = processed_ids
+    summary['timings']['map'] = time.time() - start
+
+def reduce_command(args, summary):
+    _check_output_format(args.output_format)
+    category_lists = { colname: CATEGORY_SCHEMES[colname][2]() for colname in args.categories }
+
+    start = time.time()
+    container = reduce_ssm_partitions(args.shard_dir, category_lists, include_extended=args.include_extended)
+    summary['timings']['reduce'] = time.time() - start
+
+    start = time.time()
+    for colname, counts_df in container.counts_dfs.items():
+        summary['outputs'][colname] = write_output(counts_df, args.output_dir, colname, args.output_format)
+    if args.include_extended:
+        summary['rows'] = int(container.extended_df.shape[0])
+        extended_path = os.path.join(args.output_dir, 'extended.tsv')
+        container.extended_df.to_csv(extended_path, sep='\t', index=False)
+        summary['outputs']['extended'] = extended_path
+    summary['timings']['write_outputs'] = time.time() - start
+
+def serve_command(args, summary):
+    start = time.time()
+    _prepare_references(args.cache_dir, 1, args.genome_format)
+    summary['timings']['load_references'] = time.time() - start
+
+    with MutationService(_references['genomes'], _references['genes'], categories=args.categories,
+                            max_batch_rows=args.max_batch_rows, batch_wait=args.batch_wait, max_pending=args.max_pending) as service:
+        server = make_server(service, host=args.host, port=args.port, unix_socket=args.unix_socket, reference_mismatch=args.reference_mismatch)
+        logging.warning("Serving on %s" % (args.unix_socket if args.unix_socket is not None else 'http://%s:%d' % server.server_address[:2]))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if args.unix_socket is not None and os.path.exists(args.unix_socket):
+                os.remove(args.unix_socket)
+
+
+'''
+Argument parsing
+'''
+def _add_common_args(parser):
+    parser.add_argument('--summary', default=None,
+                        help='Path to which to write a JSON summary of the run (by default, printed to stdout).')
+    parser.add_argument('--no-progress', action='store_true', help='Disable the progress bar.')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Increase logging verbosity (-v for INFO, -vv for DEBUG).')
+
+def _add_input_args(parser):
+    parser.add_argument('inputs', nargs='+', help='Input mutation file(s).')
+    parser.add_argument('--source', choices=SOURCES, required=True, help='Format of the input files.')
+    parser.add_argument('--chunksize', type=int, default=None, help='Number of input rows to process at a time (streaming mode).')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of chunks (or input files) to read ahead in a background thread (0 to disable).')
+    parser.add_argument('--assembly', choices=[ a.value for a in ASSEMBLY_VAL ], default=None,
+                        help='Genome assembly of VCF input files (by default %s).' % ASSEMBLY_VAL.HG19.value)
+    parser.add_argument('--seq-type', choices=[ t.value for t in SEQ_TYPE_VAL ], default=None,
+                        help='Sequencing strategy of VCF input files (by default %s).' % SEQ_TYPE_VAL.WGS.value)
+    parser.add_argument('--cancer-type', default='unknown', help='Value to fill the Cancer Type column.')
+    parser.add_argument('--provenance', default='unknown', help='Value to fill the Provenance column.')
+    parser.add_argument('--cohort', default='unknown', help='Value to fill the Cohort column.')
+    parser.add_argument('--target-regions', default=None, help='BED file of target regions (e.g. an exome capture kit) outside of which mutations are dropped.')
+    parser.add_argument('--region-padding', type=int, default=0, help='Number of base pairs by which to extend each target region on both sides.')
+
+def _add_category_args(parser):
+    parser.add_argument('--categories', nargs='+', choices=sorted(CATEGORY_SCHEMES.keys()), default=DEFAULT_CATEGORIES,
+                        help='Category count matrices to produce.')
+
+def _add_reference_args(parser):
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes.')
+    parser.add_argument('--cache-dir', default=EXPLOSIG_DATA_DIR, help='Directory in which to cache reference genomes and gene tables.')
+    parser.add_argument('--genome-format', choices=sorted(GENOME_FORMATS.keys()), default='fasta',
+                        help="Format in which to cache reference genomes ('bgzf' reads compressed genomes with random access, "
+                            "'shared' keeps one decoded copy in shared memory for all processes).")
+    parser.add_argument('--reference-mismatch', choices=[ p.value for p in REF_MISMATCH_POLICY ], default=REF_MISMATCH_POLICY.RAISE.value,
+                        help='What to do with mutations whose reference sequence does not match the genome.')
+
+def _add_output_args(parser):
+    parser.add_argument('--output-dir', default='.', help='Directory to which to write the count matrices.')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='tsv', help='File format of the count matrices.')
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='explosig-data', description='Process mutation data into ExploSig count matrices.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Run the full pipeline from input files to count matrices.')
+    _add_input_args(run_parser)
+    _add_category_args(run_parser)
+    _add_reference_args(run_parser)
+    _add_output_args(run_parser)
+    _add_common_args(run_parser)
+    run_parser.set_defaults(func=run_command)
+
+    partition_parser = subparsers.add_parser('partition', help='Standardize input files and split them into partitions in a shared directory.')
+    _add_input_args(partition_parser)
+    partition_parser.add_argument('--shard-dir', required=True, help='Shared directory for partitions and results.')
+    partition_parser.add_argument('--partitions', type=int, default=16, help='Number of partitions when partitioning by sample.')
+    partition_parser.add_argument('--by', choices=['sample', 'chromosome'], default='sample', help='Partitioning scheme.')
+    _add_common_args(partition_parser)
+    partition_parser.set_defaults(func=partition_command)
+
+    map_parser = subparsers.add_parser('map', help='Extend and count partitions.')
+    map_parser.add_argument('--shard-dir', required=True, help='Shared directory for partitions and results.')
+    map_parser.add_argument('--partition', type=int, action='append', help='Partition ID to process (may be repeated; by default all partitions).')
+    map_parser.add_argument('--no-extended', action='store_true', help='Do not write the extended rows of each partition.')
+    _add_category_args(map_parser)
+    _add_reference_args(map_parser)
+    _add_common_args(map_parser)
+    map_parser.set_defaults(func=map_command)
+
+    reduce_parser = subparsers.add_parser('reduce', help='Merge the results of all mapped partitions.')
+    reduce_parser.add_argument('--shard-dir', required=True, help='Shared directory for partitions and results.')
+    reduce_parser.add_argument('--include-extended', action='store_true', help='Also merge and write the extended rows.')
+    _add_category_args(reduce_parser)
+    _add_output_args(reduce_parser)
+    _add_common_args(reduce_parser)
+    reduce_parser.set_defaults(func=reduce_command)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve extend and count requests over HTTP, keeping reference data loaded.')
+    _add_category_args(serve_parser)
+    serve_parser.add_argument('--cache-dir', default=EXPLOSIG_DATA_DIR, help='Directory in which to cache reference genomes and gene tables.')
+    serve_parser.add_argument('--genome-format', choices=sorted(GENOME_FORMATS.keys()), default='fasta', help='Format in which to cache reference genomes.')
+    serve_parser.add_argument('--reference-mismatch', choices=[ p.value for p in REF_MISMATCH_POLICY ], default=REF_MISMATCH_POLICY.RAISE.value,
+                                help='What to do with mutations whose reference sequence does not match the genome, for requests that do not specify it.')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address on which to listen.')
+    serve_parser.add_argument('--port', type=int, default=8000, help='Port on which to listen.')
+    serve_parser.add_argument('--unix-socket', default=None, help='Path of a Unix socket on which to listen instead of a port.')
+    serve_parser.add_argument('--max-batch-rows', type=int, default=100000, help='Maximum number of rows to extend in one batch.')
+    serve_parser.add_argument('--batch-wait', type=float, default=0.005, help='Number of seconds to wait for more requests before extending a batch.')
+    serve_parser.add_argument('--max-pending', type=int, default=64, help='Maximum number of pending requests, beyond which requests are rejected.')
+    _add_common_args(serve_parser)
+    serve_parser.set_defaults(func=serve_command)
+
+    return parser
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    if getattr(args, 'jobs', 1) < 1:
+        get_parser().error('--jobs must be at least 1')
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)], format=FORMAT)
+
+    summary = {
+        'command': args.command,
+        'status': 'ok',
+        'exit_code': EXIT_OK,
+        'rows': 0,
+        'timings': {},
+        'outputs': {},
+    }
+    start = time.time()
+    try:
+        args.func(args, summary)
+    except UsageError as e:
+        logging.error(str(e))
+        summary['status'], summary['exit_code'], summary['error'] = 'usage_error', EXIT_USAGE, str(e)
+    except KeyboardInterrupt:
+        summary['status'], summary['exit_code'] = 'interrupted', EXIT_INTERRUPTED
+    except Exception as e:
+        logging.exception(str(e))
+        summary['status'], summary['exit_code'], summary['error'] = 'failed', EXIT_FAILURE, str(e)
+    finally:
+        _close_references()
+    summary['timings']['total'] = time.time() - start
+    if summary['rows'] > 0 and summary['timings']['total'] > 0:
+        summary['rows_per_second'] = summary['rows'] / summary['timings']['total']
+
+    if args.summary is None:
+        print(json.dumps(summary, sort_keys=True))
+    else:
+        write_json_atomic(summary, args.summary)
+    return summary['exit_code']
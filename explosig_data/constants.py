@@ -40,6 +40,8 @@ class COLNAME(Enum):
     MUT_DIST = 'Distance to Previous Mutation'
     NEAREST_MUT = 'Distance to Nearest Mutation'
     MUT_DIST_ROLLING_MEAN = 'Rolling Mean of 6 Mutation Distances'
+    REF_MISMATCH = 'Reference Mismatch'
+    IN_REGION = 'In Target Region'
 
 
 SSM_COLUMNS = [
@@ -63,6 +65,12 @@ class TSTRAND_VAL(Enum):
     PLUS = '+'
     MINUS = '-'
 
+class REF_MISMATCH_POLICY(Enum):
+    # What to do with mutations whose reference sequence does not match the genome
+    RAISE = 'raise'
+    DROP = 'drop'
+    FLAG = 'flag'
+
 class GSTRAND_VAL(Enum):
     PLUS = '+'
     MINUS = '-'
@@ -1,10 +1,12 @@
 
 import logging
+import numpy as np
 import pandas as pd
 
 from .constants import *
-from .utils import clean_ssm_df, convert_with_map
-from .i_o import get_logger, get_df_drop_message
+from .utils import clean_ssm_df, convert_with_map, map_values, get_filter_mask, chromosome_filter_values
+from .i_o import get_logger, get_df_drop_message, read_csv_filtered, PrefetchIterator
+from .qc import count_values, RowMask
 from .ssm_container import SimpleSomaticMutationContainer
 
 col_dtypes = {
@@ -37,9 +39,46 @@ col_renames = {
     "chromosome_strand": COLNAME.GSTRAND.value
 }
 
+# TODO: update this indel logic
+def get_ICGC_mut_types(mut_types, refs, variants):
+    # Assign mutation type enum values from the ICGC mutation type and allele columns, in the order of precedence of the conditions
+    refs, variants = pd.Series(refs).values, pd.Series(variants).values
+    ref_lens, variant_lens = pd.Series(refs).str.len().values, pd.Series(variants).str.len().values
+    return np.select([
+        (pd.Series(mut_types).values == 'single base substitution'),
+        (ref_lens == 2) & (variant_lens == 2),
+        (refs == '-'),
+        (variants == '-'),
+    ], [MUT_TYPE_VAL.SBS.value, MUT_TYPE_VAL.DBS.value, MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value], default=NAN_VAL)
+
+def get_ICGC_ssm_filter(filter_by_seq_type=None, samples=None, patients=None, chromosomes=None, mut_types=None, qc_report=None):
+    # Returns a function that filters a raw ICGC dataframe (before renaming), or None if there are no filters
+    if all(f is None for f in [filter_by_seq_type, samples, patients, chromosomes, mut_types]):
+        return None
+
+    def filter_df(ssm_df, row_mask=None):
+        # With a row mask, the excluded rows are added to the mask rather than filtered out
+        mask = get_filter_mask([
+            (ssm_df['icgc_sample_id'].values, samples),
+            (ssm_df['icgc_donor_id'].values, patients),
+            (ssm_df['sequencing_strategy'].values, filter_by_seq_type),
+            (ssm_df['chromosome'].values, chromosome_filter_values(chromosomes)),
+            ((get_ICGC_mut_types(ssm_df['mutation_type'], ssm_df['reference_genome_allele'], ssm_df['mutated_to_allele'])
+                if mut_types is not None else None), mut_types),
+        ])
+        if row_mask is not None:
+            row_mask.drop('read', 'filters', "excluded value", ~mask)
+            return ssm_df
+        if qc_report is not None:
+            qc_report.add_drop('read', 'filters', "excluded value", int((~mask).sum()))
+        logging.debug("Dropping %i rows because excluded value in filtered columns" % (~mask).sum())
+        return ssm_df.loc[mask]
+    return filter_df
+
 def standardize_ICGC_ssm_file(input_ssm_file, wrap=True, filter_by_seq_type=None, 
+                                        samples=None, patients=None, chromosomes=None, mut_types=None,
                                         cancer_type='unknown', provenance='unknown', cohort='unknown', 
-                                        col_dtypes=col_dtypes, col_renames=col_renames,
+                                        col_dtypes=col_dtypes, col_renames=col_renames, qc_report=None,
                                         console_verbosity=logging.DEBUG):
     """Convert to explosig simple somatic mutation ("standard") format from the ICGC simple somatic mutation format.
     
@@ -51,6 +90,14 @@ def standardize_ICGC_ssm_file(input_ssm_file, wrap=True, filter_by_seq_type=None
         Whether to wrap the return value for chaining, by default `True`
     filter_by_seq_type : `str` or `list`, optional
         A sequencing type or list of sequencing types by which to filter, by default None
+    samples : `str` or `list`, optional
+        Sample ID(s) to keep, by default None (all samples)
+    patients : `str` or `list`, optional
+        Patient ID(s) to keep, by default None (all patients)
+    chromosomes : `str` or `list`, optional
+        Chromosome(s) to keep, with or without the 'chr' prefix, by default None (all chromosomes)
+    mut_types : `str` or `list`, optional
+        Mutation type enum value(s) to keep, by default None (all mutation types)
     cancer_type : `str`, optional
         Value to fill the Cancer Type column, by default 'unknown'
     provenance : `str`, optional
@@ -61,6 +108,8 @@ def standardize_ICGC_ssm_file(input_ssm_file, wrap=True, filter_by_seq_type=None
         Dictionary mapping input column names to data types.
     col_renames : `dict`, optional
         Dictionary mapping input column names to standard column name constants.
+    qc_report : `QCReport`, optional
+        Report to which to add quality control counts (also attached to the container if wrapped), by default None
     console_verbosity : `int`, optional
         Logging verbosity, by default `logging.DEBUG`
     
@@ -71,12 +120,131 @@ def standardize_ICGC_ssm_file(input_ssm_file, wrap=True, filter_by_seq_type=None
     """
     get_logger(console_verbosity=console_verbosity)
 
-    
-    ssm_df = pd.read_csv(input_ssm_file, sep='\t', usecols=col_dtypes.keys(), dtype=col_dtypes)
+    # Filter while parsing, so that rows that would be discarded are never held all at once
+    filter_df = get_ICGC_ssm_filter(filter_by_seq_type=filter_by_seq_type, samples=samples, patients=patients,
+                                        chromosomes=chromosomes, mut_types=mut_types, qc_report=qc_report)
+    ssm_df = read_csv_filtered(input_ssm_file, filter_df=filter_df, sep='\t', usecols=col_dtypes.keys(), dtype=col_dtypes)
     logging.debug("Input df has %d rows" % ssm_df.shape[0])
 
-    # Standardize column names
-    ssm_df = ssm_df.rename(columns=col_renames)
+    ssm_df = standardize_ICGC_ssm_df(ssm_df, cancer_type=cancer_type, provenance=provenance, cohort=cohort,
+                                        col_renames=col_renames, qc_report=qc_report)
+    
+    if wrap:
+        return SimpleSomaticMutationContainer(ssm_df, qc_report=qc_report)
+    else:
+        return ssm_df
+
+
+def standardize_ICGC_ssm_file_chunks(input_ssm_file, chunksize=100000, filter_by_seq_type=None,
+                                        samples=None, patients=None, chromosomes=None, mut_types=None,
+                                        cancer_type='unknown', provenance='unknown', cohort='unknown',
+                                        col_dtypes=col_dtypes, col_renames=col_renames, prefetch_chunks=0,
+                                        qc_report=None, console_verbosity=logging.DEBUG):
+    """Iterate over an ICGC simple somatic mutation file in chunks, yielding each chunk in the standardized format.
+
+    Rows sharing the mutation ID of the final row of a chunk are carried over to the next chunk,
+    so that the duplicate rows that ICGC files contain for each gene consequence
+    (which are stored contiguously) are dropped just as they would be by `standardize_ICGC_ssm_file`.
+
+    Parameters
+    ----------
+    input_ssm_file : `str`
+        Path to the ICGC simple somatic mutation file.
+    chunksize : `int`, optional
+        Number of input rows to read at a time, by default 100000
+    prefetch_chunks : `int`, optional
+        Number of raw chunks to read ahead in a background thread while the current chunk is processed, by default 0
+
+    See `standardize_ICGC_ssm_file` for the remaining parameters.
+
+    Yields
+    ------
+    `pd.DataFrame`
+        A chunk of the simple somatic mutation dataframe in a standardized format.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    filter_df = get_ICGC_ssm_filter(filter_by_seq_type=filter_by_seq_type, samples=samples, patients=patients,
+                                        chromosomes=chromosomes, mut_types=mut_types, qc_report=qc_report)
+
+    def standardize_chunk(chunk):
+        logging.debug("Input chunk has %d rows" % chunk.shape[0])
+        return standardize_ICGC_ssm_df(chunk, cancer_type=cancer_type, provenance=provenance, cohort=cohort,
+                                        col_renames=col_renames, qc_report=qc_report)
+
+    carry_df = None
+    reader = pd.read_csv(input_ssm_file, sep='\t', usecols=col_dtypes.keys(), dtype=col_dtypes, chunksize=chunksize)
+    with PrefetchIterator(reader, max_prefetch=prefetch_chunks) as chunks:
+        for chunk in chunks:
+            if filter_df is not None:
+                # Filtered rows are dropped before carrying over, since all rows of a mutation pass or fail together
+                chunk = filter_df(chunk)
+                if chunk.shape[0] == 0:
+                    continue
+            if carry_df is not None:
+                chunk = pd.concat([carry_df, chunk], ignore_index=True)
+            # Hold back the trailing rows of the last mutation since its remaining rows may be in the next chunk
+            mutation_ids = chunk["icgc_mutation_id"].values
+            is_last_mutation = (mutation_ids == mutation_ids[-1])
+            num_carry = is_last_mutation[::-1].argmin() if not is_last_mutation.all() else len(is_last_mutation)
+            carry_df = chunk.iloc[len(chunk) - num_carry:]
+            # Standardizing does not modify its input, so the chunk is passed as a view
+            chunk = chunk.iloc[:len(chunk) - num_carry]
+            if chunk.shape[0] > 0:
+                yield standardize_chunk(chunk)
+
+    if carry_df is not None and carry_df.shape[0] > 0:
+        yield standardize_chunk(carry_df)
+
+
+def standardize_ICGC_ssm_df(ssm_df, filter_by_seq_type=None,
+                                        samples=None, patients=None, chromosomes=None, mut_types=None,
+                                        cancer_type='unknown', provenance='unknown', cohort='unknown', 
+                                        col_renames=col_renames, qc_report=None):
+    """Convert to explosig simple somatic mutation ("standard") format from an ICGC simple somatic mutation dataframe that has already been read from disk.
+    
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        Dataframe containing the raw ICGC simple somatic mutation columns.
+    filter_by_seq_type : `str` or `list`, optional
+        A sequencing type or list of sequencing types by which to filter, by default None
+    samples : `str` or `list`, optional
+        Sample ID(s) to keep, by default None (all samples)
+    patients : `str` or `list`, optional
+        Patient ID(s) to keep, by default None (all patients)
+    chromosomes : `str` or `list`, optional
+        Chromosome(s) to keep, with or without the 'chr' prefix, by default None (all chromosomes)
+    mut_types : `str` or `list`, optional
+        Mutation type enum value(s) to keep, by default None (all mutation types)
+    cancer_type : `str`, optional
+        Value to fill the Cancer Type column, by default 'unknown'
+    provenance : `str`, optional
+        Value to fill the Provenance column, by default 'unknown'
+    cohort : `str`, optional
+        Value to fill the Cohort column, by default 'unknown'
+    col_renames : `dict`, optional
+        Dictionary mapping input column names to standard column name constants.
+    qc_report : `QCReport`, optional
+        Report to which to add quality control counts, by default None
+    
+    Returns
+    -------
+    `pd.DataFrame`
+        The simple somatic mutation dataframe in a standardized format.
+    """
+    # Rows are dropped by adding them to a mask, and the standardized columns are computed as arrays,
+    # so that the only copy of the rows is the cleaned dataframe
+    row_mask = RowMask(ssm_df.shape[0], qc_report=qc_report)
+
+    # Filter before any other processing
+    filter_df = get_ICGC_ssm_filter(filter_by_seq_type=filter_by_seq_type, samples=samples, patients=patients,
+                                        chromosomes=chromosomes, mut_types=mut_types, qc_report=qc_report)
+    if filter_df is not None:
+        filter_df(ssm_df, row_mask=row_mask)
+
+    # Standardize column names (without copying the columns)
+    ssm_df = ssm_df.rename(columns=col_renames, copy=False)
 
     # Mapped sequencing types
     seq_type_map = {
@@ -84,69 +252,62 @@ def standardize_ICGC_ssm_file(input_ssm_file, wrap=True, filter_by_seq_type=None
         'WXS': SEQ_TYPE_VAL.WXS.value,
         'WGS': SEQ_TYPE_VAL.WGS.value
     }
-    ssm_df[COLNAME.SEQ_TYPE.value] = ssm_df.apply(lambda row: convert_with_map(row, COLNAME.SEQ_TYPE.value, seq_type_map), axis='columns')
-
-    logging.debug("Standardized sequencing types resulting in %d WGS, %d WXS, %d RNA-Seq, %d NaN rows" % (
-        ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value] == SEQ_TYPE_VAL.WGS.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value] == SEQ_TYPE_VAL.WXS.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value] == SEQ_TYPE_VAL.RNASEQ.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value] == NAN_VAL].shape[0]
-    ))
-
-    if filter_by_seq_type != None:
-        if type(filter_by_seq_type) == str:
-            ssm_df = ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value] == filter_by_seq_type]
-        elif type(filter_by_seq_type) == list:
-            ssm_df = ssm_df.loc[ssm_df[COLNAME.SEQ_TYPE.value].isin(filter_by_seq_type)]
-        logging.debug("After restricting to sequencing type %s, df has %d rows" % (str(filter_by_seq_type), ssm_df.shape[0]))
-
-    ssm_df.sort_values(by=[COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.POS_START.value, "total_read_count"], na_position='last', inplace=True)
+    seq_types = map_values(ssm_df[COLNAME.SEQ_TYPE.value].values, seq_type_map)
+
+    seq_type_counts = count_values('standardize', pd.Series(seq_types[row_mask.valid], name=COLNAME.SEQ_TYPE.value),
+                                    [SEQ_TYPE_VAL.WGS.value, SEQ_TYPE_VAL.WXS.value, SEQ_TYPE_VAL.RNASEQ.value, NAN_VAL], qc_report=qc_report)
+    if seq_type_counts is not None:
+        logging.debug("Standardized sequencing types resulting in %d WGS, %d WXS, %d RNA-Seq, %d NaN rows" % tuple(seq_type_counts))
+
+    if row_mask.num_valid() == 0:
+        # Nothing left to standardize (e.g. a chunk containing only filtered sequencing types)
+        return pd.DataFrame(columns=SSM_COLUMNS)
+
+    # The order of the valid rows by sample, position, and read count (as strings), without sorting the dataframe
+    valid_rows = row_mask.rows()
+    keys_df = pd.DataFrame({
+        COLNAME.PATIENT.value: ssm_df[COLNAME.PATIENT.value].values[valid_rows],
+        COLNAME.SAMPLE.value: ssm_df[COLNAME.SAMPLE.value].values[valid_rows],
+        COLNAME.POS_START.value: ssm_df[COLNAME.POS_START.value].values[valid_rows],
+        "total_read_count": ssm_df["total_read_count"].values[valid_rows],
+        "icgc_mutation_id": ssm_df["icgc_mutation_id"].values[valid_rows],
+        COLNAME.SEQ_TYPE.value: seq_types[valid_rows],
+    })
+    keys_df = keys_df.sort_values(by=[COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.POS_START.value, "total_read_count"], na_position='last')
+    row_order = valid_rows[keys_df.index.values]
     
     # In ICGC ssm files, identical mutations often have multiple rows because there is a different row for each gene consequence.
     # May also have multiple rows for the same mutation if the sample had both WXS and WGS sequencing, for example.
-    ssm_df.drop_duplicates(subset=["icgc_mutation_id", COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.SEQ_TYPE.value], keep='first', inplace=True)
+    is_duplicate = np.zeros(ssm_df.shape[0], dtype=bool)
+    is_duplicate[row_order] = keys_df.duplicated(subset=["icgc_mutation_id", COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.SEQ_TYPE.value], keep='first').values
+    row_mask.drop('standardize', "icgc_mutation_id", "duplicate value", is_duplicate)
+    del keys_df
 
-    logging.debug("After dropping rows with duplicate mutation ID, patient ID, sample ID, and sequencing type, df has %d rows" % ssm_df.shape[0])
-    
-    ssm_df[COLNAME.CANCER_TYPE.value], ssm_df[COLNAME.PROVENANCE.value], ssm_df[COLNAME.COHORT.value] = cancer_type, provenance, cohort
-
-    # TODO: update this indel logic
-    def convert_mut_type(row):
-        if row[COLNAME.MUT_TYPE.value] == 'single base substitution':
-            return MUT_TYPE_VAL.SBS.value
-        elif len(row[COLNAME.REF.value]) == 2 and len(row[COLNAME.VAR.value]) == 2:
-            return MUT_TYPE_VAL.DBS.value
-        elif len(row[COLNAME.REF.value]) == 1 and row[COLNAME.REF.value] == '-':
-            return MUT_TYPE_VAL.INS.value
-        elif len(row[COLNAME.VAR.value]) == 1 and row[COLNAME.VAR.value] == '-':
-            return MUT_TYPE_VAL.DEL.value
-        else:
-            return NAN_VAL
-    
-    ssm_df[COLNAME.MUT_TYPE.value] = ssm_df.apply(convert_mut_type, axis='columns')
+    logging.debug("After dropping rows with duplicate mutation ID, patient ID, sample ID, and sequencing type, df has %d rows" % row_mask.num_valid())
+
+    mut_types = get_ICGC_mut_types(ssm_df[COLNAME.MUT_TYPE.value], ssm_df[COLNAME.REF.value], ssm_df[COLNAME.VAR.value])
 
-    logging.debug("Assigned mutation types resulting in %d SBS, %d DBS, %d INS, %d DEL, %d NaN" % (
-        ssm_df.loc[ssm_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.SBS.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.DBS.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.INS.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.DEL.value].shape[0],
-        ssm_df.loc[ssm_df[COLNAME.MUT_TYPE.value] == NAN_VAL].shape[0]
-    ))
+    mut_type_counts = count_values('standardize', pd.Series(mut_types[row_mask.valid], name=COLNAME.MUT_TYPE.value), [MUT_TYPE_VAL.SBS.value, MUT_TYPE_VAL.DBS.value, MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value, NAN_VAL], qc_report=qc_report)
+    if mut_type_counts is not None:
+        logging.debug("Assigned mutation types resulting in %d SBS, %d DBS, %d INS, %d DEL, %d NaN" % tuple(mut_type_counts))
 
     assembly_map = {
         'GRCh37': ASSEMBLY_VAL.HG19.value,
         'GRCh38': ASSEMBLY_VAL.HG38.value
     }
-    ssm_df[COLNAME.ASSEMBLY.value] = ssm_df.apply(lambda row: convert_with_map(row, COLNAME.ASSEMBLY.value, assembly_map), axis='columns')
-
     gstrand_map = {
         '1': GSTRAND_VAL.PLUS.value
     }
-    ssm_df[COLNAME.GSTRAND.value] = ssm_df.apply(lambda row: convert_with_map(row, COLNAME.GSTRAND.value, gstrand_map), axis='columns')
 
-    ssm_df = clean_ssm_df(ssm_df)
-    
-    if wrap:
-        return SimpleSomaticMutationContainer(ssm_df)
-    else:
-        return ssm_df
+    columns = { c: ssm_df[c].values for c in SSM_COLUMNS if c in ssm_df.columns }
+    columns.update({
+        COLNAME.SEQ_TYPE.value: seq_types,
+        COLNAME.CANCER_TYPE.value: cancer_type,
+        COLNAME.PROVENANCE.value: provenance,
+        COLNAME.COHORT.value: cohort,
+        COLNAME.MUT_TYPE.value: mut_types,
+        COLNAME.ASSEMBLY.value: map_values(ssm_df[COLNAME.ASSEMBLY.value].values, assembly_map),
+        COLNAME.GSTRAND.value: map_values(ssm_df[COLNAME.GSTRAND.value].values, gstrand_map),
+        'index': ssm_df.index,
+    })
+    return clean_ssm_df(columns, qc_report=qc_report, row_mask=row_mask, row_order=row_order)
@@ -1,9 +1,11 @@
 import logging
+import numpy as np
 import pandas as pd
 
 from .constants import *
-from .utils import clean_ssm_df, convert_with_map
-from .i_o import get_logger, get_df_drop_message
+from .utils import clean_ssm_df, convert_with_map, get_filter_mask, chromosome_filter_values
+from .i_o import get_logger, get_df_drop_message, read_csv_filtered, PrefetchIterator
+from .qc import count_values, RowMask
 from .ssm_container import SimpleSomaticMutationContainer
 
 col_dtypes = {
@@ -42,9 +44,50 @@ col_renames = {
     "Hugo_Symbol": COLNAME.GENE_SYMBOL.value
 }
 
+# TODO: update this indel logic
+def get_TCGA_mut_types(variant_types, refs, variants):
+    # Assign mutation type enum values from the MAF variant type and allele columns, in the order of precedence of the conditions
+    refs, variants = pd.Series(refs), pd.Series(variants)
+    has_alleles = (refs.notna() & variants.notna()).values
+    ref_lens, variant_lens = refs.str.len().values, variants.str.len().values
+    refs, variants = refs.values, variants.values
+    return np.select([
+        ~has_alleles,
+        (pd.Series(variant_types).values == 'SNP'),
+        (ref_lens == 2) & (variant_lens == 2),
+        (refs == '-'),
+        (variants == '-'),
+    ], [NAN_VAL, MUT_TYPE_VAL.SBS.value, MUT_TYPE_VAL.DBS.value, MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value], default=NAN_VAL)
+
+def get_TCGA_maf_filter(samples=None, patients=None, seq_types=None, chromosomes=None, mut_types=None, qc_report=None):
+    # Returns a function that filters a raw MAF dataframe (before renaming), or None if there are no filters
+    if all(f is None for f in [samples, patients, seq_types, chromosomes, mut_types]):
+        return None
+
+    def filter_df(maf_df, row_mask=None):
+        # With a row mask, the excluded rows are added to the mask rather than filtered out
+        barcodes = maf_df["Tumor_Sample_Barcode"]
+        mask = get_filter_mask([
+            (barcodes.values, samples),
+            ((barcodes.str.slice(0, 12).values if patients is not None else None), patients),
+            (np.full(maf_df.shape[0], SEQ_TYPE_VAL.WXS.value), seq_types),
+            (maf_df["Chromosome"].values, chromosome_filter_values(chromosomes)),
+            ((get_TCGA_mut_types(maf_df["Variant_Type"], maf_df["Reference_Allele"], maf_df["Tumor_Seq_Allele2"])
+                if mut_types is not None else None), mut_types),
+        ])
+        if row_mask is not None:
+            row_mask.drop('read', 'filters', "excluded value", ~mask)
+            return maf_df
+        if qc_report is not None:
+            qc_report.add_drop('read', 'filters', "excluded value", int((~mask).sum()))
+        logging.debug("Dropping %i rows because excluded value in filtered columns" % (~mask).sum())
+        return maf_df.loc[mask]
+    return filter_df
+
 def standardize_TCGA_maf_file(input_maf_file, wrap=True,
+                                        samples=None, patients=None, seq_types=None, chromosomes=None, mut_types=None,
                                         cancer_type='unknown', provenance='unknown', cohort='unknown', 
-                                        col_dtypes=col_dtypes, col_renames=col_renames,
+                                        col_dtypes=col_dtypes, col_renames=col_renames, qc_report=None,
                                         console_verbosity=logging.DEBUG):
     """Convert to explosig simple somatic mutation ("standard") format from the TCGA PanCanAtlas MAF format.
     
@@ -54,8 +97,19 @@ def standardize_TCGA_maf_file(input_maf_file, wrap=True,
         Path to a TCGA PanCanAtlas MAF file.
     wrap : `bool`, optional
         Whether to wrap the return value for chaining, by default `True`
+    samples : `str` or `list`, optional
+        Sample ID(s) (tumor sample barcodes) to keep, by default None (all samples)
+    patients : `str` or `list`, optional
+        Patient ID(s) (the first 12 characters of the barcodes) to keep, by default None (all patients)
+    seq_types : `str` or `list`, optional
+        Sequencing type enum value(s) to keep, by default None. All MAF rows are WXS, so any other value excludes every row.
+    chromosomes : `str` or `list`, optional
+        Chromosome(s) to keep, with or without the 'chr' prefix, by default None (all chromosomes)
+    mut_types : `str` or `list`, optional
+        Mutation type enum value(s) to keep, by default None (all mutation types)
     cancer_type : `str`, optional
-        The cancer type value on which to filter.
+        Value to fill the Cancer Type column, by default 'unknown'. PanCanAtlas MAF files do not contain cancer types,
+        so to restrict to one cancer type, pass the barcodes of its samples as `samples`.
     provenance : `str`, optional
         Value to fill the Provenance column, by default 'unknown'
     cohort : `str`, optional
@@ -64,6 +118,8 @@ def standardize_TCGA_maf_file(input_maf_file, wrap=True,
         Dictionary mapping input column names to data types.
     col_renames : `dict`, optional
         Dictionary mapping input column names to standard column name constants.
+    qc_report : `QCReport`, optional
+        Report to which to add quality control counts (also attached to the container if wrapped), by default None
     console_verbosity : `int`, optional
         Logging verbosity, by default `logging.DEBUG`
     
@@ -75,55 +131,133 @@ def standardize_TCGA_maf_file(input_maf_file, wrap=True,
     
     get_logger(console_verbosity=console_verbosity)
 
-    maf_df = pd.read_csv(input_maf_file, sep="\t", usecols=col_dtypes.keys(), dtype=col_dtypes)
+    # Filter while parsing, so that rows that would be discarded are never held all at once
+    filter_df = get_TCGA_maf_filter(samples=samples, patients=patients, seq_types=seq_types, chromosomes=chromosomes,
+                                        mut_types=mut_types, qc_report=qc_report)
+    maf_df = read_csv_filtered(input_maf_file, filter_df=filter_df, sep="\t", usecols=col_dtypes.keys(), dtype=col_dtypes)
     logging.debug("Input df has %d rows" % maf_df.shape[0])
+
+    maf_df = standardize_TCGA_maf_df(maf_df, cancer_type=cancer_type, provenance=provenance, cohort=cohort,
+                                        col_renames=col_renames, qc_report=qc_report)
     
-    maf_df = maf_df.rename(columns=col_renames)
-    # set sequencing strategy to be whole exome sequencing (WXS)
-    # not part of the MAF but WR manually verified via the mc3 paper (Ellrot et al 2018)
-    maf_df[COLNAME.SEQ_TYPE.value] = SEQ_TYPE_VAL.WXS.value
-    # set patient to be first 12 characters of sample
-    maf_df[COLNAME.PATIENT.value] = [barcode[0:12] for barcode in maf_df[COLNAME.SAMPLE.value]]
+    if wrap:
+        return SimpleSomaticMutationContainer(maf_df, qc_report=qc_report)
+    else:
+        return maf_df
+
+
+def standardize_TCGA_maf_file_chunks(input_maf_file, chunksize=100000,
+                                        samples=None, patients=None, seq_types=None, chromosomes=None, mut_types=None,
+                                        cancer_type='unknown', provenance='unknown', cohort='unknown',
+                                        col_dtypes=col_dtypes, col_renames=col_renames, prefetch_chunks=0,
+                                        qc_report=None, console_verbosity=logging.DEBUG):
+    """Iterate over a TCGA PanCanAtlas MAF file in chunks, yielding each chunk in the standardized format.
+
+    Parameters
+    ----------
+    input_maf_file : `str`
+        Path to a TCGA PanCanAtlas MAF file.
+    chunksize : `int`, optional
+        Number of input rows to read at a time, by default 100000
+    prefetch_chunks : `int`, optional
+        Number of raw chunks to read ahead in a background thread while the current chunk is processed, by default 0
+
+    See `standardize_TCGA_maf_file` for the remaining parameters.
+
+    Yields
+    ------
+    `pd.DataFrame`
+        A chunk of the simple somatic mutation dataframe in a standardized format.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    filter_df = get_TCGA_maf_filter(samples=samples, patients=patients, seq_types=seq_types, chromosomes=chromosomes,
+                                        mut_types=mut_types, qc_report=qc_report)
+    reader = pd.read_csv(input_maf_file, sep="\t", usecols=col_dtypes.keys(), dtype=col_dtypes, chunksize=chunksize)
+    with PrefetchIterator(reader, max_prefetch=prefetch_chunks) as chunks:
+        for maf_df in chunks:
+            logging.debug("Input chunk has %d rows" % maf_df.shape[0])
+            if filter_df is not None:
+                maf_df = filter_df(maf_df)
+            yield standardize_TCGA_maf_df(maf_df, cancer_type=cancer_type, provenance=provenance, cohort=cohort,
+                                            col_renames=col_renames, qc_report=qc_report)
+
+
+def standardize_TCGA_maf_df(maf_df, samples=None, patients=None, seq_types=None, chromosomes=None, mut_types=None,
+                                        cancer_type='unknown', provenance='unknown', cohort='unknown',
+                                        col_renames=col_renames, qc_report=None):
+    """Convert to explosig simple somatic mutation ("standard") format from a TCGA PanCanAtlas MAF dataframe that has already been read from disk.
     
-    # remove mutations where Filter column contains 'nonpreferredpair' or 'oxog' or 'StrandBias'
-    maf_df = maf_df.loc[~maf_df["FILTER"].str.contains('StrandBias|oxog|nonpreferredpair')]
-
-    logging.debug("After removing mutations where FILTER column contains 'nonpreferredpair' or 'oxog' or 'StrandBias', df has %d rows" % maf_df.shape[0])
-
-    # set cohort and provenance
-    maf_df[COLNAME.COHORT.value] = cohort
-    maf_df[COLNAME.PROVENANCE.value] = provenance
-    maf_df[COLNAME.CANCER_TYPE.value] = cancer_type
-
-    # TODO: update this indel logic
-    def convert_mut_type(row):
-        # required because len(NaN) returns a TypeError "object of type 'float' has no len()"
-        if row.isnull()[[COLNAME.REF.value, COLNAME.VAR.value]].any():
-            return NAN_VAL
-        if row[COLNAME.MUT_TYPE.value] == 'SNP':
-            return MUT_TYPE_VAL.SBS.value
-        elif len(row[COLNAME.REF.value]) == 2 and len(row[COLNAME.VAR.value]) == 2:
-            return MUT_TYPE_VAL.DBS.value
-        elif len(row[COLNAME.REF.value]) == 1 and row[COLNAME.REF.value] == '-':
-            return MUT_TYPE_VAL.INS.value
-        elif len(row[COLNAME.VAR.value]) == 1 and row[COLNAME.VAR.value] == '-':
-            return MUT_TYPE_VAL.DEL.value
-        else:
-            return NAN_VAL
+    Parameters
+    ----------
+    maf_df : `pd.DataFrame`
+        Dataframe containing the raw TCGA PanCanAtlas MAF columns.
+    samples : `str` or `list`, optional
+        Sample ID(s) (tumor sample barcodes) to keep, by default None (all samples)
+    patients : `str` or `list`, optional
+        Patient ID(s) (the first 12 characters of the barcodes) to keep, by default None (all patients)
+    seq_types : `str` or `list`, optional
+        Sequencing type enum value(s) to keep, by default None. All MAF rows are WXS, so any other value excludes every row.
+    chromosomes : `str` or `list`, optional
+        Chromosome(s) to keep, with or without the 'chr' prefix, by default None (all chromosomes)
+    mut_types : `str` or `list`, optional
+        Mutation type enum value(s) to keep, by default None (all mutation types)
+    cancer_type : `str`, optional
+        Value to fill the Cancer Type column, by default 'unknown'
+    provenance : `str`, optional
+        Value to fill the Provenance column, by default 'unknown'
+    cohort : `str`, optional
+        Value to fill the Cohort column, by default 'unknown'
+    col_renames : `dict`, optional
+        Dictionary mapping input column names to standard column name constants.
+    qc_report : `QCReport`, optional
+        Report to which to add quality control counts, by default None
     
-    maf_df[COLNAME.MUT_TYPE.value] = maf_df.apply(convert_mut_type, axis=1)
+    Returns
+    -------
+    `pd.DataFrame`
+        The simple somatic mutation dataframe in a standardized format.
+    """
+    # Rows are dropped by adding them to a mask, so that the only copy of the rows is the cleaned dataframe
+    row_mask = RowMask(maf_df.shape[0], qc_report=qc_report)
 
-    logging.debug("Assigned mutation types resulting in %d SBS, %d DBS, %d INS, %d DEL, %d NaN" % (
-        maf_df.loc[maf_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.SBS.value].shape[0],
-        maf_df.loc[maf_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.DBS.value].shape[0],
-        maf_df.loc[maf_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.INS.value].shape[0],
-        maf_df.loc[maf_df[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.DEL.value].shape[0],
-        maf_df.loc[maf_df[COLNAME.MUT_TYPE.value] == NAN_VAL].shape[0]
-    ))
+    # Filter before any other processing
+    filter_df = get_TCGA_maf_filter(samples=samples, patients=patients, seq_types=seq_types, chromosomes=chromosomes,
+                                        mut_types=mut_types, qc_report=qc_report)
+    if filter_df is not None:
+        filter_df(maf_df, row_mask=row_mask)
 
-    maf_df = clean_ssm_df(maf_df)
+    # Standardize column names (without copying the columns)
+    maf_df = maf_df.rename(columns=col_renames, copy=False)
     
-    if wrap:
-        return SimpleSomaticMutationContainer(maf_df)
-    else:
-        return maf_df
\ No newline at end of file
+    # remove mutations where Filter column contains 'nonpreferredpair' or 'oxog' or 'StrandBias'
+    is_filtered = maf_df["FILTER"].str.contains('StrandBias|oxog|nonpreferredpair', na=False).values
+    row_mask.drop('standardize', "FILTER", "excluded value", is_filtered)
+
+    logging.debug("After removing mutations where FILTER column contains 'nonpreferredpair' or 'oxog' or 'StrandBias', df has %d rows" % row_mask.num_valid())
+
+    if row_mask.num_valid() == 0:
+        # Nothing left to standardize (e.g. a chunk containing only filtered mutations)
+        return pd.DataFrame(columns=SSM_COLUMNS)
+
+    mut_type_values = get_TCGA_mut_types(maf_df[COLNAME.MUT_TYPE.value], maf_df[COLNAME.REF.value], maf_df[COLNAME.VAR.value])
+
+    mut_type_counts = count_values('standardize', pd.Series(mut_type_values[row_mask.valid], name=COLNAME.MUT_TYPE.value), [MUT_TYPE_VAL.SBS.value, MUT_TYPE_VAL.DBS.value, MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value, NAN_VAL], qc_report=qc_report)
+    if mut_type_counts is not None:
+        logging.debug("Assigned mutation types resulting in %d SBS, %d DBS, %d INS, %d DEL, %d NaN" % tuple(mut_type_counts))
+
+    columns = { c: maf_df[c].values for c in SSM_COLUMNS if c in maf_df.columns }
+    columns.update({
+        # set sequencing strategy to be whole exome sequencing (WXS)
+        # not part of the MAF but WR manually verified via the mc3 paper (Ellrot et al 2018)
+        COLNAME.SEQ_TYPE.value: SEQ_TYPE_VAL.WXS.value,
+        # set patient to be first 12 characters of sample
+        COLNAME.PATIENT.value: maf_df[COLNAME.SAMPLE.value].str.slice(0, 12).values,
+        # set cohort and provenance
+        COLNAME.COHORT.value: cohort,
+        COLNAME.PROVENANCE.value: provenance,
+        COLNAME.CANCER_TYPE.value: cancer_type,
+        COLNAME.MUT_TYPE.value: mut_type_values,
+        'index': maf_df.index,
+    })
+    return clean_ssm_df(columns, qc_report=qc_report, row_mask=row_mask)
\ No newline at end of file
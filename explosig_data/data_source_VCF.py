@@ -0,0 +1,193 @@
+import os
+import logging
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .constants import *
+from .utils import clean_ssm_df
+from .i_o import get_logger
+from .qc import count_values
+from .bgzf import iter_file_lines
+from .ssm_container import SimpleSomaticMutationContainer
+
+VCF_FIXED_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER']
+VCF_PASS_FILTER_VALUES = set(['PASS', '.'])
+VCF_EXTENSIONS = ['.vcf.gz', '.vcf.bgz', '.vcf', '.gz', '.bgz']
+
+def get_VCF_sample_name(input_vcf_file):
+    # Use the file name without the VCF extension(s) as the sample name
+    name = os.path.basename(input_vcf_file)
+    for ext in VCF_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def normalize_VCF_allele(pos, ref, alt):
+    """Convert a VCF REF/ALT allele pair (which may share padding bases) to the standard format.
+
+    Parameters
+    ----------
+    pos : `int`
+        The VCF POS value (1-based position of the first base of REF).
+    ref : `str`
+        The VCF REF value.
+    alt : `str`
+        A single VCF ALT allele.
+
+    Returns
+    -------
+    `tuple`
+        (start position, end position, reference sequence, variant sequence, mutation type),
+        where insertions and deletions use '-' for the empty allele and insertions span the two bases on either side of the insertion, as in MAF files.
+        The padding is trimmed as by vcf2maf, e.g. `(100, 'ACA', 'A')` is a deletion of 'CA' at 101-102,
+        and `(100, 'A', 'ACA')` is an insertion of 'CA' between 100 and 101.
+    """
+    ref, alt = ref.upper(), alt.upper()
+    # Trim the shared prefix (the VCF padding base of indels) and then the shared suffix
+    while len(ref) > 0 and len(alt) > 0 and ref[0] == alt[0]:
+        ref, alt = ref[1:], alt[1:]
+        pos += 1
+    while len(ref) > 0 and len(alt) > 0 and ref[-1] == alt[-1]:
+        ref, alt = ref[:-1], alt[:-1]
+
+    if len(ref) == 1 and len(alt) == 1:
+        return (pos, pos, ref, alt, MUT_TYPE_VAL.SBS.value)
+    elif len(ref) == 2 and len(alt) == 2:
+        return (pos, pos + 1, ref, alt, MUT_TYPE_VAL.DBS.value)
+    elif len(ref) == 0 and len(alt) > 0:
+        return (pos - 1, pos, '-', alt, MUT_TYPE_VAL.INS.value)
+    elif len(ref) > 0 and len(alt) == 0:
+        return (pos, pos + len(ref) - 1, ref, '-', MUT_TYPE_VAL.DEL.value)
+    else:
+        return (pos, pos + max(len(ref), 1) - 1, (ref if len(ref) > 0 else '-'), (alt if len(alt) > 0 else '-'), NAN_VAL)
+
+def read_VCF_file(input_vcf_file, sample_name=None, filter_pass=True, threads=4):
+    """Stream the records of a single-sample VCF file into a dataframe with one row per ALT allele.
+
+    Parameters
+    ----------
+    input_vcf_file : `str`
+        Path to a VCF file, which may be plain, gzip-compressed, or BGZF-compressed (decompressed in parallel threads).
+    sample_name : `str`, optional
+        Value to fill the Sample and Patient columns, by default the file name without the VCF extension.
+    filter_pass : `bool`, optional
+        Whether to only keep records whose FILTER value is PASS (or missing), by default `True`
+    threads : `int`, optional
+        Number of BGZF decompression threads, by default 4
+
+    Returns
+    -------
+    `pd.DataFrame`
+        Dataframe containing the patient, sample, chromosome, position, allele, and mutation type columns.
+    """
+    if sample_name is None:
+        sample_name = get_VCF_sample_name(input_vcf_file)
+
+    rows = []
+    num_records = 0
+    for line in iter_file_lines(input_vcf_file, threads=threads):
+        if len(line) == 0 or line[0] == '#':
+            continue
+        fields = line.split('\t', len(VCF_FIXED_COLUMNS))
+        if len(fields) < len(VCF_FIXED_COLUMNS):
+            raise ValueError("Malformed VCF record in %s: %s" % (input_vcf_file, line))
+        num_records += 1
+        chrom, pos, _, ref, alts, _, vcf_filter = fields[:len(VCF_FIXED_COLUMNS)]
+        if filter_pass and vcf_filter not in VCF_PASS_FILTER_VALUES:
+            continue
+        if chrom.startswith('chr'):
+            chrom = chrom[3:]
+        # Split multi-allelic sites into one row per ALT allele
+        for alt in alts.split(','):
+            if alt in ('*', '.') or alt.startswith('<') or ('[' in alt) or (']' in alt):
+                # Skip spanning deletions, missing alleles, symbolic alleles, and breakends
+                continue
+            rows.append((chrom,) + normalize_VCF_allele(int(pos), ref, alt))
+
+    logging.debug("Read %d records resulting in %d alleles from %s" % (num_records, len(rows), input_vcf_file))
+
+    df = pd.DataFrame(rows, columns=[
+        COLNAME.CHR.value, COLNAME.POS_START.value, COLNAME.POS_END.value,
+        COLNAME.REF.value, COLNAME.VAR.value, COLNAME.MUT_TYPE.value
+    ])
+    df[COLNAME.PATIENT.value] = sample_name
+    df[COLNAME.SAMPLE.value] = sample_name
+    return df
+
+def _read_VCF_file_args(args):
+    return read_VCF_file(*args)
+
+def standardize_VCF_files(input_vcf_files, wrap=True, sample_names=None, filter_pass=True,
+                            assembly=ASSEMBLY_VAL.HG19.value, seq_type=SEQ_TYPE_VAL.WGS.value,
+                            cancer_type='unknown', provenance='unknown', cohort='unknown',
+                            jobs=1, threads=4, qc_report=None, console_verbosity=logging.DEBUG):
+    """Convert to explosig simple somatic mutation ("standard") format from single-sample VCF files.
+
+    Parameters
+    ----------
+    input_vcf_files : `list` or `str`
+        Paths to VCF files (plain, gzip-compressed, or BGZF-compressed), with one sample per file.
+    wrap : `bool`, optional
+        Whether to wrap the return value for chaining, by default `True`
+    sample_names : `list`, optional
+        Sample name for each file, by default each file name without the VCF extension.
+    filter_pass : `bool`, optional
+        Whether to only keep records whose FILTER value is PASS (or missing), by default `True`
+    assembly : `str`, optional
+        Value to fill the Assembly Version column, by default `ASSEMBLY_VAL.HG19.value`
+    seq_type : `str`, optional
+        Value to fill the Sequencing Strategy column, by default `SEQ_TYPE_VAL.WGS.value`
+    cancer_type : `str`, optional
+        Value to fill the Cancer Type column, by default 'unknown'
+    provenance : `str`, optional
+        Value to fill the Provenance column, by default 'unknown'
+    cohort : `str`, optional
+        Value to fill the Cohort column, by default 'unknown'
+    jobs : `int`, optional
+        Number of VCF files to read concurrently in separate processes, by default 1
+    threads : `int`, optional
+        Number of BGZF decompression threads per file, by default 4
+    qc_report : `QCReport`, optional
+        Report to which to add quality control counts (also attached to the container if wrapped), by default None
+    console_verbosity : `int`, optional
+        Logging verbosity, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `pd.DataFrame`
+        The simple somatic mutation dataframe in a standardized format. This dataframe can be passed to the `extend...` functions.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    if isinstance(input_vcf_files, str):
+        input_vcf_files = [input_vcf_files]
+    if sample_names is None:
+        sample_names = [None] * len(input_vcf_files)
+    elif len(sample_names) != len(input_vcf_files):
+        raise ValueError("Expected one sample name per VCF file.")
+
+    file_args = [ (input_vcf_file, sample_name, filter_pass, threads) for input_vcf_file, sample_name in zip(input_vcf_files, sample_names) ]
+    if jobs > 1 and len(file_args) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            vcf_dfs = list(executor.map(_read_VCF_file_args, file_args))
+    else:
+        vcf_dfs = [ _read_VCF_file_args(args) for args in file_args ]
+
+    ssm_df = pd.concat(vcf_dfs, ignore_index=True)
+    logging.debug("Input df has %d rows" % ssm_df.shape[0])
+
+    ssm_df[COLNAME.CANCER_TYPE.value], ssm_df[COLNAME.PROVENANCE.value], ssm_df[COLNAME.COHORT.value] = cancer_type, provenance, cohort
+    ssm_df[COLNAME.ASSEMBLY.value] = assembly
+    ssm_df[COLNAME.SEQ_TYPE.value] = seq_type
+    ssm_df[COLNAME.GSTRAND.value] = GSTRAND_VAL.PLUS.value
+
+    mut_type_counts = count_values('standardize', ssm_df[COLNAME.MUT_TYPE.value], [MUT_TYPE_VAL.SBS.value, MUT_TYPE_VAL.DBS.value, MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value, NAN_VAL], qc_report=qc_report)
+    if mut_type_counts is not None:
+        logging.debug("Assigned mutation types resulting in %d SBS, %d DBS, %d INS, %d DEL, %d NaN" % tuple(mut_type_counts))
+
+    ssm_df = clean_ssm_df(ssm_df, qc_report=qc_report)
+
+    if wrap:
+        return SimpleSomaticMutationContainer(ssm_df, qc_report=qc_report)
+    else:
+        return ssm_df
@@ -1,10 +1,12 @@
 import os
 import bisect
+import numpy as np
 import pandas as pd
 
 
 from .utils import run_snakemake_with_config
 from .constants import *
+from .kernels import strand_walks
 
 def row_matches(row, pos):
     if row[COLNAME.POS_START.value] <= pos and row[COLNAME.POS_END.value] >= pos:
@@ -50,6 +52,112 @@ class GeneLookup:
             self.df[chromosome] = df.loc[df[COLNAME.CHR.value] == chromosome]
             # Store the position column as a list so that python's bisect can be used
             self.positions[chromosome] = self.df[chromosome][COLNAME.POS_END.value].tolist()
+
+        # Gene symbols, and the sets of overlapping genes (as sorted tuples of gene codes) shared by the segments of all chromosomes.
+        # Gene set 0 is the empty set.
+        self.gene_names = np.sort(df['gene'].unique()).astype(object)
+        self.gene_sets = [()]
+        self._gene_set_ids = { (): 0 }
+        self._segments = {}
+        self._strand_arrays = {}
+
+    def _chr_segments(self, chr_name):
+        # Boundaries of the segments of a chromosome on which the set of overlapping transcripts does not change,
+        # and the gene set ID of each segment, computed on first use with one sweep over the transcript starts and ends
+        if chr_name not in self._segments:
+            chr_df = self.df[chr_name]
+            gene_codes = np.searchsorted(self.gene_names, chr_df['gene'].values)
+            # Transcripts cover [start, end], so they are removed from the active set at end + 1
+            event_pos = np.concatenate([chr_df[COLNAME.POS_START.value].values, chr_df[COLNAME.POS_END.value].values + 1]).astype(np.int64)
+            event_genes = np.concatenate([gene_codes, gene_codes])
+            event_deltas = np.concatenate([np.ones(len(gene_codes), dtype=np.int64), -np.ones(len(gene_codes), dtype=np.int64)])
+            order = np.argsort(event_pos, kind='stable')
+            event_pos, event_genes, event_deltas = event_pos[order], event_genes[order], event_deltas[order]
+
+            boundaries = np.unique(event_pos)
+            segment_set_ids = np.zeros(len(boundaries), dtype=np.int64)
+            active = {}
+            i = 0
+            for segment_i, pos in enumerate(boundaries):
+                # All events at a position are applied before the segment starting there gets its gene set
+                while i < len(event_pos) and event_pos[i] == pos:
+                    gene_code = event_genes[i]
+                    active[gene_code] = active.get(gene_code, 0) + event_deltas[i]
+                    if active[gene_code] == 0:
+                        del active[gene_code]
+                    i += 1
+                gene_set = tuple(sorted(active.keys()))
+                if gene_set not in self._gene_set_ids:
+                    self._gene_set_ids[gene_set] = len(self.gene_sets)
+                    self.gene_sets.append(gene_set)
+                segment_set_ids[segment_i] = self._gene_set_ids[gene_set]
+            self._segments[chr_name] = (boundaries, segment_set_ids)
+        return self._segments[chr_name]
+
+    def gene_set_ids(self, chr_names, positions):
+        """Find the set of genes overlapping each position, with one binary search per chromosome.
+
+        Parameters
+        ----------
+        chr_names : array-like
+            Chromosome names (without the 'chr' prefix).
+        positions : array-like
+            1-based positions.
+
+        Returns
+        -------
+        `np.array`
+            Indices into `self.gene_sets`, the sorted tuples of codes into `self.gene_names` of the genes with a transcript overlapping each position.
+            Positions that do not overlap a transcript, or are on other chromosomes, have gene set 0 (the empty set).
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        result = np.zeros(len(positions), dtype=np.int64)
+
+        chr_codes, chr_uniques = pd.factorize(np.asarray(chr_names).astype(str))
+        order = np.argsort(chr_codes, kind='stable')
+        bounds = np.searchsorted(chr_codes[order], np.arange(len(chr_uniques) + 1))
+        for chr_code, chr_name in enumerate(chr_uniques):
+            if chr_name not in self.df:
+                continue
+            rows = order[bounds[chr_code]:bounds[chr_code + 1]]
+            boundaries, segment_set_ids = self._chr_segments(chr_name)
+            segment_i = np.searchsorted(boundaries, positions[rows], side='right') - 1
+            in_range = (segment_i >= 0)
+            result[rows[in_range]] = segment_set_ids[segment_i[in_range]]
+        return result
+
+    def gene_symbols(self, chr_names, positions):
+        """Annotate positions with the symbols of the genes that they overlap.
+
+        Parameters
+        ----------
+        chr_names : array-like
+            Chromosome names (without the 'chr' prefix).
+        positions : array-like
+            1-based positions.
+
+        Returns
+        -------
+        `np.array`
+            Comma-separated, sorted gene symbols for each position, or `NAN_VAL` where no transcript overlaps the position.
+        """
+        set_ids = self.gene_set_ids(chr_names, positions)
+        # Each distinct gene set is joined once
+        set_symbols = np.array([ (','.join(self.gene_names[list(gene_set)]) if len(gene_set) > 0 else NAN_VAL) for gene_set in self.gene_sets ], dtype=object)
+        return set_symbols[set_ids]
+
+    def gene_set_members(self):
+        """Get the gene codes of all gene sets, in a compressed layout.
+
+        Returns
+        -------
+        `tuple`
+            (offsets, gene codes): the codes into `self.gene_names` of gene set `i` are `gene_codes[offsets[i]:offsets[i + 1]]`.
+        """
+        sizes = np.array([ len(gene_set) for gene_set in self.gene_sets ], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        gene_codes = np.fromiter((code for gene_set in self.gene_sets for code in gene_set), dtype=np.int64, count=int(offsets[-1]))
+        return offsets, gene_codes
     
     def strand(self, chr_name, pos, gstrand):
         chr_name = str(chr_name)
@@ -86,20 +194,56 @@ class GeneLookup:
         else:
             raise ValueError("No transcript matches found.")
 
-def download_human_genes():
+    def strands(self, chr_names, positions, gstrands, kernel_backend='auto'):
+        """Batch version of `strand`, with the same results, running the transcript walks in a kernel (see `kernels.py`).
+
+        Returns
+        -------
+        `np.array`
+            Transcription strand of each position ('+', '-', or '+,-'), or `NAN_VAL` where no transcript matches.
+        """
+        chr_names = np.asarray(chr_names).astype(str)
+        positions = np.asarray(positions, dtype=np.int64)
+        assert np.isin(chr_names, CHROMOSOMES).all()
+        assert (np.asarray(gstrands) == GSTRAND_VAL.PLUS.value).all() # TODO update position when GSTRAND is not plus
+
+        strand_masks = np.zeros(len(positions), dtype=np.int64)
+        for chr_name in pd.unique(chr_names):
+            rows = np.flatnonzero(chr_names == chr_name)
+            if chr_name not in self._strand_arrays:
+                chr_df = self.df[chr_name]
+                self._strand_arrays[chr_name] = (
+                    chr_df[COLNAME.POS_START.value].values.astype(np.int64),
+                    chr_df[COLNAME.POS_END.value].values.astype(np.int64),
+                    # Bit flags, so that the strands of all found transcripts are combined with a bitwise or
+                    np.where(chr_df[COLNAME.TSTRAND.value].values == TSTRAND_VAL.PLUS.value, 1,
+                        np.where(chr_df[COLNAME.TSTRAND.value].values == TSTRAND_VAL.MINUS.value, 2, 4)).astype(np.int64)
+                )
+            starts, ends, strand_codes = self._strand_arrays[chr_name]
+            strand_masks[rows] = strand_walks(starts, ends, strand_codes, positions[rows], backend=kernel_backend)
+
+        mask_strands = np.full(8, NAN_VAL, dtype=object)
+        mask_strands[1] = TSTRAND_VAL.PLUS.value
+        mask_strands[2] = TSTRAND_VAL.MINUS.value
+        mask_strands[3] = '%s,%s' % (TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value)
+        return mask_strands[strand_masks]
+
+def download_human_genes(data_dir=EXPLOSIG_DATA_DIR):
     config = {
         "output": {
-            "hg19": os.path.join(EXPLOSIG_DATA_DIR, "genes", "refFlat19.txt"),
-            "hg38": os.path.join(EXPLOSIG_DATA_DIR, "genes", "refFlat38.txt")
+            "hg19": os.path.join(data_dir, "genes", "refFlat19.txt"),
+            "hg38": os.path.join(data_dir, "genes", "refFlat38.txt")
         }
     }
 
     snakefile = os.path.join(os.path.dirname(__file__), 'snakefiles', 'genes', 'human.smk')
     run_snakemake_with_config(snakefile, config)
-  
-def get_human_genes_dict():
-    download_human_genes()
+
+def get_human_genes_dict(data_dir=EXPLOSIG_DATA_DIR, download=True):
+    # Set download=False when the files are known to exist (e.g. in worker processes), to skip the snakemake check
+    if download:
+        download_human_genes(data_dir=data_dir)
     return {
-        ASSEMBLY_VAL.HG19.value: GeneLookup(os.path.join(EXPLOSIG_DATA_DIR, "genes", "refFlat19.txt")),
-        ASSEMBLY_VAL.HG38.value: GeneLookup(os.path.join(EXPLOSIG_DATA_DIR, "genes", "refFlat38.txt"))
+        ASSEMBLY_VAL.HG19.value: GeneLookup(os.path.join(data_dir, "genes", "refFlat19.txt")),
+        ASSEMBLY_VAL.HG38.value: GeneLookup(os.path.join(data_dir, "genes", "refFlat38.txt"))
     }
\ No newline at end of file
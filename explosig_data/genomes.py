@@ -1,13 +1,30 @@
 import os
+import json
+import struct
+import hashlib
 import logging
+import tempfile
+import threading
+import weakref
+import numpy as np
 from abc import abstractmethod
+from collections import OrderedDict
 from Bio import SeqIO
 from Bio.Seq import reverse_complement
 import twobitreader
 
 from .utils import run_snakemake_with_config
+from .bgzf import read_gzi, read_block_size, decompress_block
 from .constants import *
 
+try:
+    import fcntl
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Shared memory genomes require Python >= 3.8 on a POSIX system
+    fcntl = None
+    shared_memory = None
+
 class Genome:
     @abstractmethod
     def __init__(self, genome_filepath):
@@ -20,19 +37,25 @@ class Genome:
     @abstractmethod
     def base(self, chr_name, pos, gstrand):
         raise NotImplementedError
+
+    def seqs(self, chr_names, starts, ends, gstrand):
+        # Fetch many sequences at once. Subclasses can override this to order and merge the underlying reads.
+        return [ self.seq(chr_name=str(chr_name), start=int(start), end=int(end), gstrand=gstrand) for chr_name, start, end in zip(chr_names, starts, ends) ]
     
     def lflank(self, chr_name, pos, gstrand, size, reference_base=None):
         if reference_base != None:
             # optional verification (convenient if computing for SBS mutation)
             reference_base_from_genome = self.base(chr_name=chr_name, pos=pos, gstrand=gstrand)
-            assert(reference_base_from_genome == 'N' or reference_base_from_genome == reference_base)
+            if not (reference_base_from_genome == 'N' or reference_base_from_genome == reference_base):
+                raise ValueError("Reference base %s does not match the genome base %s at %s:%d." % (reference_base, reference_base_from_genome, chr_name, pos))
         return self.seq(chr_name=chr_name, start=pos-size-1, end=pos-1, gstrand=gstrand)
     
     def rflank(self, chr_name, pos, gstrand, size, reference_base=None):
         if reference_base != None:
             # optional verification (convenient if computing for SBS mutation)
             reference_base_from_genome = self.base(chr_name=chr_name, pos=pos, gstrand=gstrand)
-            assert(reference_base_from_genome == 'N' or reference_base_from_genome == reference_base)
+            if not (reference_base_from_genome == 'N' or reference_base_from_genome == reference_base):
+                raise ValueError("Reference base %s does not match the genome base %s at %s:%d." % (reference_base, reference_base_from_genome, chr_name, pos))
         return self.seq(chr_name=chr_name, start=pos, end=pos+size, gstrand=gstrand)
 
 class FastaGenome(Genome):
@@ -53,6 +76,9 @@ class FastaGenome(Genome):
         return str(self.genome[chr_name][pos-1])
 
 
+TWOBIT_BASES = np.frombuffer(b'TCAG', dtype=np.uint8)
+TWOBIT_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
 class TwoBitGenome(Genome):
     def __init__(self, genome_filepath):
         logging.debug('Loading genome...')
@@ -68,20 +94,415 @@ class TwoBitGenome(Genome):
         assert (gstrand == GSTRAND_VAL.PLUS.value) # TODO update position when GSTRAND is not plus
         return str(self.genome[chr_name][pos-1]).upper()
 
-def download_human_genomes():
+    def _decode(self, chr_seq, start, end):
+        # Decode the bases in [start, end) of a chromosome as an array of ASCII codes.
+        # Each byte packs four bases (T, C, A, G = 0, 1, 2, 3), most significant bits first.
+        chr_seq._file_handle.seek(chr_seq._offset + start // 4)
+        packed = np.frombuffer(chr_seq._file_handle.read((end + 3) // 4 - start // 4), dtype=np.uint8)
+        codes = ((packed[:, np.newaxis] >> TWOBIT_SHIFTS) & 3).ravel()
+        bases = TWOBIT_BASES[codes[start % 4:start % 4 + (end - start)]]
+        # N blocks override the packed bases
+        n_starts, n_ends = self._n_blocks(chr_seq)
+        first_n = max(np.searchsorted(n_starts, start, side='right') - 1, 0)
+        last_n = np.searchsorted(n_starts, end, side='left')
+        for n_start, n_end in zip(n_starts[first_n:last_n], n_ends[first_n:last_n]):
+            if n_end > start:
+                bases[max(n_start, start) - start:min(n_end, end) - start] = ord('N')
+        return bases
+
+    def _n_blocks(self, chr_seq):
+        if not hasattr(chr_seq, '_n_block_arrays'):
+            n_starts = np.array(chr_seq._n_block_starts, dtype=np.int64)
+            chr_seq._n_block_arrays = (n_starts, n_starts + np.array(chr_seq._n_block_sizes, dtype=np.int64))
+        return chr_seq._n_block_arrays
+
+    def seqs(self, chr_names, starts, ends, gstrand, max_gap=4096, max_run_bases=1048576):
+        # Fetch in chromosome and position order, decoding each run of nearby sequences (at most max_gap bases apart, and spanning at most max_run_bases) with a single read
+        assert (gstrand == GSTRAND_VAL.PLUS.value) # TODO update position when GSTRAND is not plus
+        chr_names = np.asarray(chr_names, dtype=str)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        result = [None] * len(chr_names)
+        for chr_name in np.unique(chr_names):
+            chr_seq = self.genome[chr_name]
+            rows = np.flatnonzero(chr_names == chr_name)
+            # Clip to the chromosome, as with slicing
+            chr_starts = np.clip(starts[rows], 0, len(chr_seq))
+            chr_ends = np.maximum(np.clip(ends[rows], 0, len(chr_seq)), chr_starts)
+            order = np.argsort(chr_starts, kind='mergesort')
+            run_start = 0
+            while run_start < len(order):
+                run_end = run_start + 1
+                run_seq_start, run_seq_end = chr_starts[order[run_start]], chr_ends[order[run_start]]
+                while (run_end < len(order) and chr_starts[order[run_end]] <= run_seq_end + max_gap
+                        and chr_ends[order[run_end]] - run_seq_start <= max_run_bases):
+                    run_seq_end = max(run_seq_end, chr_ends[order[run_end]])
+                    run_end += 1
+                bases = self._decode(chr_seq, run_seq_start, run_seq_end).tobytes()
+                for i in order[run_start:run_end]:
+                    result[rows[i]] = bases[chr_starts[i] - run_seq_start:chr_ends[i] - run_seq_start].decode('ascii')
+                run_start = run_end
+        return result
+
+class BgzfFastaGenome(Genome):
+    # Reads a BGZF-compressed FASTA file (e.g. from `bgzip_fasta` or `bgzip -i` plus `samtools faidx`) through its .fai and .gzi indexes,
+    # decompressing only the blocks that are needed and keeping the most recently used blocks in memory.
+    def __init__(self, genome_filepath, max_cached_blocks=1024):
+        logging.debug('Loading genome index...')
+
+        self.genome_filepath = genome_filepath
+        self.max_cached_blocks = max_cached_blocks
+        self.index = {}
+        with open(genome_filepath + '.fai', "r") as IN:
+            for line in IN:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+        block_offsets = read_gzi(genome_filepath + '.gzi')
+        self.block_compressed_offsets = np.array([ c for c, _ in block_offsets ], dtype=np.int64)
+        self.block_uncompressed_offsets = np.array([ u for _, u in block_offsets ], dtype=np.int64)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._f = None
+        self._pid = os.getpid()
+        logging.debug('Loading genome index complete')
+
+    def __getstate__(self):
+        # Open file handles and locks cannot be pickled, so they are re-created on first use
+        state = self.__dict__.copy()
+        state['_f'], state['_lock'], state['_cache'] = None, None, OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # A forked process would share the file handle's offset (and the lock) with its parent, so it opens its own
+        if self._pid != os.getpid():
+            self._f, self._lock, self._pid = None, threading.Lock(), os.getpid()
+
+    def _block(self, block_i):
+        block = self._cache.get(block_i)
+        if block is not None:
+            self._cache.move_to_end(block_i)
+            return block
+        if self._f is None:
+            self._f = open(self.genome_filepath, 'rb')
+        self._f.seek(int(self.block_compressed_offsets[block_i]))
+        block_size = read_block_size(self._f)
+        self._f.seek(int(self.block_compressed_offsets[block_i]))
+        block = decompress_block(self._f.read(block_size))
+        self._cache[block_i] = block
+        if len(self._cache) > self.max_cached_blocks:
+            self._cache.popitem(last=False)
+        return block
+
+    def _read(self, start, end):
+        # Read the uncompressed bytes in [start, end)
+        if end <= start:
+            return b''
+        first_block_i = np.searchsorted(self.block_uncompressed_offsets, start, side='right') - 1
+        last_block_i = np.searchsorted(self.block_uncompressed_offsets, end - 1, side='right') - 1
+        self._check_pid()
+        with self._lock:
+            data = b''.join(self._block(block_i) for block_i in range(first_block_i, last_block_i + 1))
+        data_start = start - int(self.block_uncompressed_offsets[first_block_i])
+        return data[data_start:data_start + (end - start)]
+
+    def _file_range(self, chr_name, start, end):
+        # Convert a 0-based, end-exclusive sequence range (clipped as with slicing) to an uncompressed file range
+        length, offset, line_bases, line_width = self.index[chr_name]
+        start, end = min(max(start, 0), length), min(max(end, 0), length)
+        if end <= start:
+            return offset, offset
+        return (offset + (start // line_bases) * line_width + start % line_bases,
+                offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1)
+
+    def seq(self, chr_name, start, end, gstrand):
+        assert (gstrand == GSTRAND_VAL.PLUS.value) # TODO update position when GSTRAND is not plus
+        file_start, file_end = self._file_range(chr_name, start, end)
+        return self._read(file_start, file_end).replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+
+    def base(self, chr_name, pos, gstrand):
+        return self.seq(chr_name, pos-1, pos, gstrand)
+
+    def seqs(self, chr_names, starts, ends, gstrand, max_gap=4096, max_run_bytes=1048576):
+        # Fetch in file order, reading each run of nearby sequences (at most max_gap bytes apart, and spanning at most max_run_bytes) with a single read
+        assert (gstrand == GSTRAND_VAL.PLUS.value) # TODO update position when GSTRAND is not plus
+        ranges = np.array([ self._file_range(str(chr_name), int(start), int(end)) for chr_name, start, end in zip(chr_names, starts, ends) ], dtype=np.int64).reshape(-1, 2)
+        result = [None] * ranges.shape[0]
+        order = np.lexsort((ranges[:, 1], ranges[:, 0]))
+        run_start = 0
+        while run_start < len(order):
+            run_end = run_start + 1
+            run_file_start, run_file_end = ranges[order[run_start]]
+            while (run_end < len(order) and ranges[order[run_end], 0] <= run_file_end + max_gap
+                    and ranges[order[run_end], 1] - run_file_start <= max_run_bytes):
+                run_file_end = max(run_file_end, ranges[order[run_end], 1])
+                run_end += 1
+            data = self._read(run_file_start, run_file_end)
+            for i in order[run_start:run_end]:
+                file_start, file_end = ranges[i] - run_file_start
+                result[i] = data[file_start:file_end].replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+            run_start = run_end
+        return result
+
+SHM_MAGIC = b'EXSG'
+SHM_MAX_ATTACHMENTS = 1024
+# Magic, index length, data offset, then one slot per attachment holding the attached process ID (0 if free)
+SHM_HEADER_FORMAT = '<4s4xQQ%dq' % SHM_MAX_ATTACHMENTS
+SHM_HEADER_SIZE = struct.calcsize(SHM_HEADER_FORMAT)
+
+def _fasta_lengths(genome_filepath):
+    # First pass over a FASTA file, to find the sequence names and lengths without keeping the sequences
+    lengths = OrderedDict()
+    with open(genome_filepath, 'rb') as IN:
+        for line in IN:
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode('ascii')
+                lengths[name] = 0
+            else:
+                lengths[name] += len(line.rstrip(b'\r\n'))
+    return lengths
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SharedMemoryGenome(Genome):
+    """A decoded genome in a named shared memory segment, so that any number of local processes can share one resident copy.
+
+    Each instance is one attachment to the segment. The process IDs of the attachments are recorded in the segment,
+    and the segment is removed when the last attachment is closed. Attachments of processes that exited without closing
+    are pruned whenever a process attaches or closes (or by calling `SharedMemoryGenome.cleanup`).
+    Instances can be pickled, in which case the unpickled copy is a new attachment.
+
+    Parameters
+    ----------
+    name : `str`
+        The name of an existing segment (see `SharedMemoryGenome.publish`).
+    """
+    def __init__(self, name):
+        _check_shared_memory()
+        with _shm_lock(name):
+            self._attach(name)
+
+    def _attach(self, name):
+        # Called with the segment's lock held
+        self.name = name
+        self._shm = _attach_shm(name)
+        magic, index_len, self._data_offset = struct.unpack_from('<4s4xQQ', self._shm.buf, 0)
+        if magic != SHM_MAGIC:
+            self._shm.close()
+            raise ValueError("Shared memory segment '%s' does not hold a genome." % name)
+        self.index = json.loads(bytes(self._shm.buf[SHM_HEADER_SIZE:SHM_HEADER_SIZE + index_len]).decode('ascii'))
+        _update_attachments(self._shm, add_pid=os.getpid())
+        # The segment is not tracked by the resource tracker (see `_untrack_shm`), so an attachment that is never closed
+        # is closed when it is garbage collected or the process exits
+        self._finalizer = weakref.finalize(self, _close_shm_attachment, name, self._shm)
+
+    @classmethod
+    def publish(cls, genome_filepath, name=None):
+        """Decode a FASTA file into a new shared memory segment, or attach to the segment if it has already been published.
+
+        Parameters
+        ----------
+        genome_filepath : `str`
+            Path to an uncompressed FASTA file.
+        name : `str`, optional
+            Name of the segment, by default derived from the absolute path of the file,
+            so that processes publishing the same file share a segment.
+
+        Returns
+        -------
+        `SharedMemoryGenome`
+            An attachment to the segment.
+        """
+        _check_shared_memory()
+        if name is None:
+            name = 'exsg_' + hashlib.sha1(os.path.realpath(genome_filepath).encode()).hexdigest()[:16]
+        # Holding the lock while the segment is filled makes other processes wait to attach until it is complete,
+        # and attaching before releasing it keeps the segment from being removed in between
+        with _shm_lock(name):
+            try:
+                _attach_shm(name).close()
+            except FileNotFoundError:
+                logging.debug('Loading genome into shared memory...')
+                lengths = _fasta_lengths(genome_filepath)
+                index, offset = {}, 0
+                for chr_name, length in lengths.items():
+                    index[chr_name] = [offset, length]
+                    offset += length
+                index_bytes = json.dumps(index).encode('ascii')
+                data_offset = SHM_HEADER_SIZE + len(index_bytes)
+                shm = shared_memory.SharedMemory(name=name, create=True, size=max(data_offset + offset, 1))
+                _untrack_shm(shm)
+                try:
+                    shm.buf[SHM_HEADER_SIZE:data_offset] = index_bytes
+                    with open(genome_filepath, 'rb') as IN:
+                        pos = data_offset
+                        for line in IN:
+                            if not line.startswith(b'>'):
+                                line = line.rstrip(b'\r\n')
+                                shm.buf[pos:pos + len(line)] = line
+                                pos += len(line)
+                    # The magic is written last, so a partially filled segment is never mistaken for a genome
+                    struct.pack_into('<4s4xQQ', shm.buf, 0, SHM_MAGIC, len(index_bytes), data_offset)
+                except BaseException:
+                    shm.close()
+                    shm.unlink()
+                    raise
+                shm.close()
+                logging.debug('Loading genome into shared memory complete')
+            genome = cls.__new__(cls)
+            genome._attach(name)
+        return genome
+
+    @staticmethod
+    def cleanup(name):
+        """Remove a segment if no live process is attached to it, e.g. after a crash.
+
+        Returns
+        -------
+        `bool`
+            Whether the segment was removed.
+        """
+        _check_shared_memory()
+        with _shm_lock(name):
+            try:
+                shm = _attach_shm(name)
+            except FileNotFoundError:
+                return False
+            num_attachments = _update_attachments(shm)
+            shm.close()
+            if num_attachments == 0:
+                shared_memory.SharedMemory(name=name).unlink()
+                return True
+            return False
+
+    def num_attachments(self):
+        with _shm_lock(self.name):
+            return _update_attachments(self._shm)
+
+    def close(self):
+        """Close this attachment, removing the segment if it was the last one."""
+        if self._shm is None:
+            return
+        self._finalizer()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        return { 'name': self.name }
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def seq(self, chr_name, start, end, gstrand):
+        assert (gstrand == GSTRAND_VAL.PLUS.value) # TODO update position when GSTRAND is not plus
+        offset, length = self.index[chr_name]
+        # Clip to the chromosome, as with slicing
+        start, end = min(max(start, 0), length), min(max(end, 0), length)
+        if end <= start:
+            return ''
+        return bytes(self._shm.buf[self._data_offset + offset + start:self._data_offset + offset + end]).decode('ascii')
+
+    def base(self, chr_name, pos, gstrand):
+        return self.seq(chr_name, pos-1, pos, gstrand)
+
+def _close_shm_attachment(name, shm):
+    with _shm_lock(name):
+        num_attachments = _update_attachments(shm, remove_pid=os.getpid())
+        shm.close()
+        if num_attachments == 0:
+            shared_memory.SharedMemory(name=name).unlink()
+
+def _check_shared_memory():
+    if shared_memory is None:
+        raise ValueError("Shared memory genomes require Python >= 3.8 on a POSIX system.")
+
+class _shm_lock:
+    # Inter-process lock for attaching to and closing a segment, held on a lock file named after the segment
+    def __init__(self, name):
+        self.path = os.path.join(tempfile.gettempdir(), 'explosig_data_%s.lock' % name)
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+def _untrack_shm(shm):
+    # The resource tracker would otherwise remove the segment when the process that created or attached it exits,
+    # even if other processes are still attached. Removal is handled by the attachment counts instead.
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+def _attach_shm(name):
+    shm = shared_memory.SharedMemory(name=name)
+    _untrack_shm(shm)
+    return shm
+
+def _update_attachments(shm, add_pid=None, remove_pid=None):
+    # Prune attachments of processes that have exited, optionally add or remove one, and return the number remaining
+    pids = list(struct.unpack_from('<%dq' % SHM_MAX_ATTACHMENTS, shm.buf, 24))
+    pids = [ (pid if (pid != 0 and _pid_alive(pid)) else 0) for pid in pids ]
+    if remove_pid is not None and remove_pid in pids:
+        pids[pids.index(remove_pid)] = 0
+    if add_pid is not None:
+        if 0 not in pids:
+            raise ValueError("Too many processes are attached to shared memory segment.")
+        pids[pids.index(0)] = add_pid
+    struct.pack_into('<%dq' % SHM_MAX_ATTACHMENTS, shm.buf, 24, *pids)
+    return sum(pid != 0 for pid in pids)
+
+GENOME_FORMATS = {
+    'fasta': ('.fa', FastaGenome),
+    'bgzf': ('.fa.bgz', BgzfFastaGenome),
+    'shared': ('.fa', SharedMemoryGenome.publish)
+}
+
+def _check_genome_format(genome_format):
+    if genome_format not in GENOME_FORMATS:
+        raise ValueError("Invalid genome format '%s'. Expected one of %s." % (genome_format, ", ".join(GENOME_FORMATS.keys())))
+
+def download_human_genomes(data_dir=EXPLOSIG_DATA_DIR, genome_format='fasta'):
+    _check_genome_format(genome_format)
     config = {
         "output": {
-            "hg19": os.path.join(EXPLOSIG_DATA_DIR, "genomes", "hg19.fa"),
-            "hg38": os.path.join(EXPLOSIG_DATA_DIR, "genomes", "hg38.fa")
-        }
+            "hg19": os.path.join(data_dir, "genomes", "hg19.fa"),
+            "hg38": os.path.join(data_dir, "genomes", "hg38.fa")
+        },
+        "format": genome_format
     }
 
     snakefile = os.path.join(os.path.dirname(__file__), 'snakefiles', 'genomes', 'human.smk')
     run_snakemake_with_config(snakefile, config)
 
-def get_human_genomes_dict():
-    download_human_genomes()
+def get_human_genomes_dict(data_dir=EXPLOSIG_DATA_DIR, download=True, genome_format='fasta'):
+    # Set download=False when the files are known to exist (e.g. in worker processes), to skip the snakemake check.
+    # Set genome_format='bgzf' to read the compressed genomes with random access rather than loading them into memory,
+    # or genome_format='shared' to share one decoded copy of each genome between processes (see `SharedMemoryGenome`).
+    _check_genome_format(genome_format)
+    if download:
+        download_human_genomes(data_dir=data_dir, genome_format=genome_format)
+    ext, genome_class = GENOME_FORMATS[genome_format]
     return {
-        ASSEMBLY_VAL.HG19.value: FastaGenome(os.path.join(EXPLOSIG_DATA_DIR, "genomes", "hg19.fa")),
-        ASSEMBLY_VAL.HG38.value: FastaGenome(os.path.join(EXPLOSIG_DATA_DIR, "genomes", "hg38.fa"))
-    }
\ No newline at end of file
+        ASSEMBLY_VAL.HG19.value: genome_class(os.path.join(data_dir, "genomes", "hg19" + ext)),
+        ASSEMBLY_VAL.HG38.value: genome_class(os.path.join(data_dir, "genomes", "hg38" + ext))
+    }
@@ -1,7 +1,14 @@
+import os
 import sys
+import json
+import queue
 import logging
+import threading
+import numpy as np
 import pandas as pd
 
+from .constants import *
+
 FORMAT = '%(levelname)-10s: %(message)s'
 FORMAT_WITH_TIME = '%(asctime)s ' + FORMAT
 
@@ -29,4 +36,143 @@ def get_logger(console_verbosity=logging.INFO, outfile=None):
 
 def get_df_drop_message(col, reason, df_0, df_1):
     num_rows = df_0.shape[0] - df_1.shape[0]
-    return "Dropping %i rows because %s in %s column" % (num_rows, reason, col)
\ No newline at end of file
+    return "Dropping %i rows because %s in %s column" % (num_rows, reason, col)
+
+def write_df_atomic(df, path, **kwargs):
+    # Write to a temporary file in the same directory and then rename,
+    # so that readers (possibly on other machines) never see a partially-written file.
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    df.to_csv(tmp_path, sep='\t', **kwargs)
+    os.replace(tmp_path, path)
+
+def write_pickle_atomic(df, path):
+    # Pickles keep the column types of a dataframe exactly, e.g. for checkpoints that are read back by the same package
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+def write_json_atomic(obj, path):
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# Data types for reading dataframes that are already in the standard (or extended) format
+standard_dtypes = {
+    COLNAME.PATIENT.value: str,
+    COLNAME.SAMPLE.value: str,
+    COLNAME.CHR.value: str,
+    COLNAME.REF.value: str,
+    COLNAME.VAR.value: str,
+}
+
+def as_standard_dtypes(df):
+    # Cast the columns of a dataframe in place as `read_standard_ssm_file` does, keeping null values
+    # (`astype(str)` would replace them with the string 'nan')
+    for colname, dtype in standard_dtypes.items():
+        values = df[colname].values.astype(object)
+        not_null = ~pd.isna(values)
+        values[not_null] = [ dtype(v) for v in values[not_null] ]
+        values[~not_null] = np.nan
+        df[colname] = values
+    return df
+
+def read_csv_filtered(input_file, filter_df=None, chunksize=100000, **kwargs):
+    """Read a delimited file, applying a filter to each chunk as it is parsed, so that the rows that are filtered out are never held all at once.
+
+    Parameters
+    ----------
+    input_file : `str`
+        Path to the file.
+    filter_df : `function`, optional
+        Function that takes a raw chunk dataframe and returns the filtered dataframe, by default None (read the whole file at once)
+    chunksize : `int`, optional
+        Number of rows to parse at a time when filtering, by default 100000
+
+    Any other keyword arguments are passed to `pd.read_csv`.
+    """
+    if filter_df is None:
+        return pd.read_csv(input_file, **kwargs)
+    chunks = [ filter_df(chunk) for chunk in pd.read_csv(input_file, chunksize=chunksize, **kwargs) ]
+    if len(chunks) == 0:
+        return pd.read_csv(input_file, nrows=0, **kwargs)
+    return pd.concat(chunks, ignore_index=True)
+
+def read_standard_ssm_file(input_file, chunksize=None):
+    # Returns a dataframe, or an iterator of dataframes if chunksize is not None
+    return pd.read_csv(input_file, sep='\t', dtype=standard_dtypes, chunksize=chunksize)
+
+
+class PrefetchIterator:
+    """Iterate over an iterable in a background thread, keeping up to `max_prefetch` items ready in a bounded queue.
+
+    This overlaps reading (and decompressing) the next input or chunk with computation on the current one.
+    Exceptions raised by the underlying iterable are re-raised by the consumer.
+
+    Parameters
+    ----------
+    iterable : iterable
+        The iterable to consume in the background, e.g. a `pd.read_csv` chunk reader.
+    max_prefetch : `int`, optional
+        The maximum number of items to read ahead, by default 2. If 0, items are read in the consumer's thread.
+    """
+    _DONE = object()
+
+    def __init__(self, iterable, max_prefetch=2):
+        self.finished = False
+        self.thread = None
+        if max_prefetch > 0:
+            self.queue = queue.Queue(maxsize=max_prefetch)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._produce, args=(iterable,), daemon=True)
+            self.thread.start()
+        else:
+            self.iterator = iter(iterable)
+
+    def _put(self, entry):
+        # Give up if the consumer has stopped, rather than blocking forever on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((None, e))
+            return
+        self._put((self._DONE, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.thread is None:
+            return next(self.iterator)
+        if self.finished:
+            raise StopIteration
+        item, error = self.queue.get()
+        if error is not None:
+            self.finished = True
+            raise error
+        if item is self._DONE:
+            self.finished = True
+            raise StopIteration
+        return item
+
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
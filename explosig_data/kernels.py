@@ -0,0 +1,142 @@
+import numpy as np
+from Bio.Seq import reverse_complement
+
+try:
+    import numba
+except ImportError:
+    # Compiled kernels require the numba package, otherwise the same loops run as plain Python
+    numba = None
+
+# Loops over typed arrays, for the parts of categorization and transcript lookup that do not vectorize with numpy.
+# Each kernel is written once in plain Python, and compiled with numba when the 'numba' backend is requested.
+#
+# Backends:
+#   'python'  the plain Python loops
+#   'numba'   the loops compiled with numba (raises an error if numba is not installed)
+#   'auto'    'numba' if numba is installed, otherwise 'python'
+KERNEL_BACKENDS = [ 'auto', 'python', 'numba' ]
+
+def resolve_kernel_backend(backend):
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError("Unknown kernel backend '%s' (must be one of: %s)." % (backend, ", ".join(KERNEL_BACKENDS)))
+    if backend == 'auto':
+        return 'numba' if numba is not None else 'python'
+    if backend == 'numba' and numba is None:
+        raise ValueError("The numba kernel backend requires the numba package.")
+    return backend
+
+def _repeat_scans(units, unit_lengths, five_primes, five_lengths, three_primes, three_lengths, max_repeats,
+                    tprime_repeats, fprime_repeats, tprime_overlaps, fprime_overlaps):
+    for r in range(units.shape[0]):
+        u = unit_lengths[r]
+        # Whole copies of the unit at the start of the 3' flank, and at the end of the 5' flank
+        n = 0
+        while n < max_repeats and (n + 1) * u <= three_lengths[r]:
+            matches = True
+            for k in range(u):
+                if three_primes[r, n * u + k] != units[r, k]:
+                    matches = False
+                    break
+            if not matches:
+                break
+            n += 1
+        tprime_repeats[r] = n
+        n = 0
+        while n < max_repeats and (n + 1) * u <= five_lengths[r]:
+            start = five_lengths[r] - (n + 1) * u
+            matches = True
+            for k in range(u):
+                if five_primes[r, start + k] != units[r, k]:
+                    matches = False
+                    break
+            if not matches:
+                break
+            n += 1
+        fprime_repeats[r] = n
+        # Microhomology: bases shared by the unit and the start of the 3' flank, or by the unit and the end of the 5' flank
+        k = 0
+        while k < u and k < three_lengths[r] and three_primes[r, k] == units[r, k]:
+            k += 1
+        tprime_overlaps[r] = k
+        k = 0
+        while k < u and k < five_lengths[r] and five_primes[r, five_lengths[r] - 1 - k] == units[r, u - 1 - k]:
+            k += 1
+        fprime_overlaps[r] = k
+
+def _strand_walks(starts, ends, strand_codes, positions, first_rows, strand_masks):
+    for r in range(positions.shape[0]):
+        pos = positions[r]
+        j = first_rows[r]
+        mask = 0
+        # Transcripts are sorted by end position: walk right from the first transcript that ends at or after the position,
+        # until a transcript starts after the position (as in `genes.search_right`)
+        if j > 0:
+            while j < ends.shape[0]:
+                if starts[j] <= pos and ends[j] >= pos:
+                    mask |= strand_codes[j]
+                if starts[j] > pos:
+                    break
+                j += 1
+        strand_masks[r] = mask
+
+_PYTHON_KERNELS = {
+    'repeat_scans': _repeat_scans,
+    'strand_walks': _strand_walks,
+}
+_NUMBA_KERNELS = {}
+
+def get_kernel(name, backend='auto'):
+    backend = resolve_kernel_backend(backend)
+    if backend == 'python':
+        return _PYTHON_KERNELS[name]
+    # Compiled on first use
+    if name not in _NUMBA_KERNELS:
+        _NUMBA_KERNELS[name] = numba.njit(nogil=True)(_PYTHON_KERNELS[name])
+    return _NUMBA_KERNELS[name]
+
+
+# Sequences are passed to kernels as zero-padded uint8 matrices with one row per sequence, and an array of lengths.
+_COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _code in range(32, 127):
+    _COMPLEMENT[_code] = ord(reverse_complement(chr(_code)))
+
+def encode_sequences(seqs):
+    """Encode strings as a zero-padded (sequences, max length) uint8 matrix and an array of lengths."""
+    seqs = [ str(s) for s in seqs ]
+    lengths = np.array([ len(s) for s in seqs ], dtype=np.int64)
+    width = max(int(lengths.max()) if len(seqs) > 0 else 0, 1)
+    encoded = np.array(seqs, dtype='S%d' % width)
+    return np.frombuffer(encoded.tobytes(), dtype=np.uint8).reshape(len(seqs), width).copy(), lengths
+
+def reverse_complement_sequences(matrix, lengths, rows):
+    """Reverse complement the given rows of an encoded sequence matrix, in place."""
+    if len(rows) == 0:
+        return matrix
+    sub_lengths = lengths[rows]
+    source_cols = sub_lengths[:, np.newaxis] - 1 - np.arange(matrix.shape[1])[np.newaxis, :]
+    in_seq = (source_cols >= 0)
+    reversed_rows = np.zeros((len(rows), matrix.shape[1]), dtype=np.uint8)
+    reversed_rows[in_seq] = _COMPLEMENT[matrix[rows][np.nonzero(in_seq)[0], source_cols[in_seq]]]
+    matrix[rows] = reversed_rows
+    return matrix
+
+def repeat_scans(units, unit_lengths, five_primes, five_lengths, three_primes, three_lengths, max_repeats, backend='auto'):
+    """Count the copies of each unit flanking it (up to `max_repeats` on each side), and its overlap with each flank.
+
+    Returns
+    -------
+    `tuple`
+        (3' repeats, 5' repeats, 3' overlaps, 5' overlaps) integer arrays.
+    """
+    num_rows = units.shape[0]
+    results = tuple(np.zeros(num_rows, dtype=np.int64) for _ in range(4))
+    get_kernel('repeat_scans', backend)(units, unit_lengths, five_primes, five_lengths, three_primes, three_lengths, max_repeats, *results)
+    return results
+
+def strand_walks(starts, ends, strand_codes, positions, backend='auto'):
+    """Find the bitwise or of the strand codes of the transcripts (sorted by end position) found for each position."""
+    positions = np.asarray(positions, dtype=np.int64)
+    first_rows = np.searchsorted(ends, positions, side='left')
+    strand_masks = np.zeros(len(positions), dtype=np.int64)
+    get_kernel('strand_walks', backend)(starts, ends, strand_codes, positions, first_rows, strand_masks)
+    return strand_masks
@@ -0,0 +1,232 @@
+import os
+import gzip
+import logging
+import numpy as np
+import pandas as pd
+from Bio.Seq import reverse_complement
+
+from .constants import *
+from .utils import run_snakemake_with_config
+from .i_o import get_logger, get_df_drop_message
+
+
+def _strip_chr(chr_name):
+    return chr_name[3:] if chr_name.startswith('chr') else chr_name
+
+class LiftOver:
+    """Convert positions between genome assemblies using a UCSC chain file.
+
+    The aligned blocks of all chains are loaded into arrays sorted by source position (one set per source chromosome),
+    so that whole columns of positions can be converted with `np.searchsorted`.
+    Where the blocks of different chains overlap in the source assembly, the block that starts first is used
+    (UCSC `over.chain` files are netted, so such overlaps are rare).
+
+    Parameters
+    ----------
+    chain_filepath : `str`
+        Path to a plain or gzip-compressed UCSC chain file.
+    """
+    def __init__(self, chain_filepath):
+        logging.debug('Loading chain file...')
+
+        # Per source chromosome lists of (source start, source end, target start, target chromosome, target strand, target size)
+        blocks = {}
+        open_func = gzip.open if chain_filepath.endswith('.gz') else open
+        with open_func(chain_filepath, 'rt') as IN:
+            chain = None
+            for line in IN:
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                if fields[0] == 'chain':
+                    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    t_name, q_name, q_size, q_strand = _strip_chr(fields[2]), _strip_chr(fields[7]), int(fields[8]), fields[9]
+                    t_pos, q_pos = int(fields[5]), int(fields[10])
+                    chain = blocks.setdefault(t_name, [])
+                    continue
+                # size [dt dq]
+                size = int(fields[0])
+                chain.append((t_pos, t_pos + size, q_pos, q_name, q_strand, q_size))
+                if len(fields) == 3:
+                    t_pos += size + int(fields[1])
+                    q_pos += size + int(fields[2])
+
+        self.target_chromosomes = np.array(sorted(set(b[3] for chr_blocks in blocks.values() for b in chr_blocks)), dtype=object)
+        target_chromosome_codes = { chr_name: i for i, chr_name in enumerate(self.target_chromosomes) }
+
+        self.blocks = {}
+        for chr_name, chr_blocks in blocks.items():
+            chr_blocks = sorted(chr_blocks, key=lambda b: b[0])
+            source_starts = np.array([ b[0] for b in chr_blocks ], dtype=np.int64)
+            source_ends = np.array([ b[1] for b in chr_blocks ], dtype=np.int64)
+            # Drop blocks that overlap an earlier block
+            previous_ends = np.concatenate([[0], np.maximum.accumulate(source_ends)[:-1]])
+            keep = (source_starts >= previous_ends)
+            self.blocks[chr_name] = {
+                'source_start': source_starts[keep],
+                'source_end': source_ends[keep],
+                'target_start': np.array([ b[2] for b in chr_blocks ], dtype=np.int64)[keep],
+                'target_chromosome': np.array([ target_chromosome_codes[b[3]] for b in chr_blocks ], dtype=np.int64)[keep],
+                'target_minus': np.array([ b[4] == '-' for b in chr_blocks ], dtype=bool)[keep],
+                'target_size': np.array([ b[5] for b in chr_blocks ], dtype=np.int64)[keep],
+            }
+        logging.debug('Loading chain file complete')
+
+    def convert(self, chr_names, positions):
+        """Convert 1-based positions.
+
+        Parameters
+        ----------
+        chr_names : array-like
+            Source chromosome names (without the 'chr' prefix).
+        positions : array-like
+            Source 1-based positions.
+
+        Returns
+        -------
+        `tuple`
+            (target chromosome names, target 1-based positions, whether mapped to the minus strand, whether mapped) arrays.
+            Unmapped positions have chromosome `NAN_VAL` and position -1.
+        """
+        chr_names = np.asarray(chr_names, dtype=str)
+        positions = np.asarray(positions, dtype=np.int64)
+        target_chr_codes = np.full(len(positions), -1, dtype=np.int64)
+        target_positions = np.full(len(positions), -1, dtype=np.int64)
+        target_minus = np.zeros(len(positions), dtype=bool)
+
+        for chr_name in np.unique(chr_names):
+            if chr_name not in self.blocks:
+                continue
+            rows = np.flatnonzero(chr_names == chr_name)
+            blocks = self.blocks[chr_name]
+            pos0 = positions[rows] - 1
+            i = np.searchsorted(blocks['source_start'], pos0, side='right') - 1
+            in_block = (i >= 0) & (pos0 < blocks['source_end'][np.maximum(i, 0)])
+            rows, pos0, i = rows[in_block], pos0[in_block], i[in_block]
+            target_pos0 = blocks['target_start'][i] + (pos0 - blocks['source_start'][i])
+            # Chain coordinates on the minus strand count from the end of the target chromosome
+            minus = blocks['target_minus'][i]
+            target_pos0 = np.where(minus, blocks['target_size'][i] - 1 - target_pos0, target_pos0)
+            target_chr_codes[rows] = blocks['target_chromosome'][i]
+            target_positions[rows] = target_pos0 + 1
+            target_minus[rows] = minus
+
+        mapped = (target_chr_codes >= 0)
+        target_chr_names = np.full(len(positions), NAN_VAL, dtype=object)
+        target_chr_names[mapped] = self.target_chromosomes[target_chr_codes[mapped]]
+        return target_chr_names, target_positions, target_minus, mapped
+
+
+def _reverse_complement_alleles(alleles):
+    return [ (allele if allele == '-' else reverse_complement(allele)) for allele in alleles ]
+
+def liftover_ssm_df(ssm_df, target_assembly=ASSEMBLY_VAL.HG19.value, liftovers=None, return_unmapped=False, console_verbosity=logging.DEBUG):
+    """Convert the positions of a standardized simple somatic mutation dataframe to a single genome assembly.
+
+    Rows already on the target assembly are left unchanged. Rows on other assemblies are converted if both their start and end positions
+    map to the same target chromosome and strand with the same distance between them. Otherwise, they are dropped as unmapped.
+    Mutations that map to the minus strand have their reference and variant alleles reverse complemented.
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        A standardized simple somatic mutation dataframe.
+    target_assembly : `str`, optional
+        The genome assembly enum value to convert to, by default `ASSEMBLY_VAL.HG19.value`
+    liftovers : `dict`, optional
+        Dictionary mapping (source assembly, target assembly) enum value tuples to LiftOver objects, by default `get_human_liftover_dict()`
+    return_unmapped : `bool`, optional
+        Whether to also return the unmapped rows, by default `False`
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `pd.DataFrame` or `tuple`
+        The dataframe with all rows on the target assembly (and the dataframe of unmapped rows if `return_unmapped` is `True`).
+        Genomes and gene tables are then only needed for the target assembly, e.g. `extend_ssm_df(df, genomes={target_assembly: genome}, genes={target_assembly: genes})`.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if there is no LiftOver object for an assembly in the dataframe.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    df = ssm_df.reset_index(drop=True)
+    assemblies = df[COLNAME.ASSEMBLY.value].values
+    source_assemblies = [ a for a in pd.unique(assemblies) if a != target_assembly ]
+    if len(source_assemblies) == 0:
+        return (df, df.iloc[:0]) if return_unmapped else df
+    if liftovers == None:
+        liftovers = get_human_liftover_dict()
+    for source_assembly in source_assemblies:
+        if (source_assembly, target_assembly) not in liftovers:
+            raise ValueError("No liftover from assembly '%s' to '%s'." % (source_assembly, target_assembly))
+
+    df[COLNAME.CHR.value] = df[COLNAME.CHR.value].astype(str)
+    mapped = np.ones(df.shape[0], dtype=bool)
+    for source_assembly in source_assemblies:
+        liftover = liftovers[(source_assembly, target_assembly)]
+        rows = np.flatnonzero(assemblies == source_assembly)
+        chr_names = df[COLNAME.CHR.value].values[rows]
+        pos_starts = df[COLNAME.POS_START.value].values[rows].astype(np.int64)
+        pos_ends = df[COLNAME.POS_END.value].values[rows].astype(np.int64)
+
+        start_chr_names, start_positions, start_minus, start_mapped = liftover.convert(chr_names, pos_starts)
+        end_chr_names, end_positions, end_minus, end_mapped = liftover.convert(chr_names, pos_ends)
+        # Both ends must map to the same chromosome and strand, without a gap or overlap in between
+        rows_mapped = (
+            start_mapped & end_mapped
+            & (start_chr_names == end_chr_names)
+            & (start_minus == end_minus)
+            & (np.abs(end_positions - start_positions) == (pos_ends - pos_starts))
+            & np.isin(start_chr_names, CHROMOSOMES)
+        )
+        mapped[rows[~rows_mapped]] = False
+        logging.debug("Lifted over %d of %d rows from %s to %s" % (rows_mapped.sum(), len(rows), source_assembly, target_assembly))
+
+        rows, minus = rows[rows_mapped], start_minus[rows_mapped]
+        start_positions, end_positions = start_positions[rows_mapped], end_positions[rows_mapped]
+        df.loc[rows, COLNAME.CHR.value] = start_chr_names[rows_mapped]
+        # On the minus strand, the start and end positions swap
+        df.loc[rows, COLNAME.POS_START.value] = np.where(minus, end_positions, start_positions)
+        df.loc[rows, COLNAME.POS_END.value] = np.where(minus, start_positions, end_positions)
+        df.loc[rows, COLNAME.ASSEMBLY.value] = target_assembly
+        minus_rows = rows[minus]
+        if len(minus_rows) > 0:
+            df.loc[minus_rows, COLNAME.REF.value] = _reverse_complement_alleles(df.loc[minus_rows, COLNAME.REF.value].values)
+            df.loc[minus_rows, COLNAME.VAR.value] = _reverse_complement_alleles(df.loc[minus_rows, COLNAME.VAR.value].values)
+
+    filtered_df = df.loc[mapped].copy()
+    logging.debug(get_df_drop_message(COLNAME.ASSEMBLY.value, "position could not be lifted over", df, filtered_df))
+    unmapped_df = ssm_df.reset_index(drop=True).loc[~mapped]
+
+    # Restore the chromosome ordering and row order of a standardized dataframe
+    filtered_df[COLNAME.CHR.value] = pd.Categorical(filtered_df[COLNAME.CHR.value], CHROMOSOMES, ordered=True)
+    filtered_df = filtered_df.sort_values([COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value]).reset_index(drop=True)
+
+    if return_unmapped:
+        return filtered_df, unmapped_df
+    else:
+        return filtered_df
+
+def download_human_liftover_chains(data_dir=EXPLOSIG_DATA_DIR):
+    config = {
+        "output": {
+            "hg19_to_hg38": os.path.join(data_dir, "liftover", "hg19ToHg38.over.chain.gz"),
+            "hg38_to_hg19": os.path.join(data_dir, "liftover", "hg38ToHg19.over.chain.gz")
+        }
+    }
+
+    snakefile = os.path.join(os.path.dirname(__file__), 'snakefiles', 'liftover', 'human.smk')
+    run_snakemake_with_config(snakefile, config)
+
+def get_human_liftover_dict(data_dir=EXPLOSIG_DATA_DIR, download=True):
+    # Set download=False when the files are known to exist (e.g. in worker processes), to skip the snakemake check
+    if download:
+        download_human_liftover_chains(data_dir=data_dir)
+    return {
+        (ASSEMBLY_VAL.HG19.value, ASSEMBLY_VAL.HG38.value): LiftOver(os.path.join(data_dir, "liftover", "hg19ToHg38.over.chain.gz")),
+        (ASSEMBLY_VAL.HG38.value, ASSEMBLY_VAL.HG19.value): LiftOver(os.path.join(data_dir, "liftover", "hg38ToHg19.over.chain.gz"))
+    }
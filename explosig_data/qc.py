@@ -0,0 +1,169 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+
+
+def qc_requested(qc_report):
+    # QC counts are only computed if a report was passed in or if they would be logged
+    return (qc_report is not None) or logging.getLogger().isEnabledFor(logging.DEBUG)
+
+class QCReport:
+    """Quality control counts collected while standardizing, cleaning, and counting mutations.
+
+    Counts are summed across calls, so one report can be passed to every chunk of a streamed file.
+
+    Attributes
+    ----------
+    value_counts : `dict`
+        Dictionary mapping (stage, column name) tuples to dictionaries mapping column values to numbers of rows.
+    drops : `dict`
+        Dictionary mapping (stage, column name, reason) tuples to numbers of dropped rows.
+    """
+    def __init__(self):
+        self.value_counts = {}
+        self.drops = {}
+
+    def add_value_counts(self, stage, colname, counts):
+        stage_counts = self.value_counts.setdefault((stage, colname), {})
+        for value, num_rows in counts.items():
+            stage_counts[value] = stage_counts.get(value, 0) + int(num_rows)
+
+    def add_drop(self, stage, colname, reason, num_rows):
+        key = (stage, colname, reason)
+        self.drops[key] = self.drops.get(key, 0) + int(num_rows)
+
+    def merge(self, other):
+        for (stage, colname), counts in other.value_counts.items():
+            self.add_value_counts(stage, colname, counts)
+        for (stage, colname, reason), num_rows in other.drops.items():
+            self.add_drop(stage, colname, reason, num_rows)
+        return self
+
+    def value_counts_df(self):
+        """Get the value counts as a long-format dataframe with stage, column, value, and rows columns."""
+        return pd.DataFrame([
+            (stage, colname, value, num_rows)
+            for (stage, colname), counts in self.value_counts.items()
+            for value, num_rows in counts.items()
+        ], columns=['stage', 'column', 'value', 'rows'])
+
+    def drops_df(self):
+        """Get the dropped row counts as a long-format dataframe with stage, column, reason, and rows columns."""
+        return pd.DataFrame([
+            (stage, colname, reason, num_rows)
+            for (stage, colname, reason), num_rows in self.drops.items()
+        ], columns=['stage', 'column', 'reason', 'rows'])
+
+    def to_dict(self):
+        # JSON-serializable form, e.g. for the command-line summary
+        return {
+            'value_counts': [
+                { 'stage': stage, 'column': colname, 'counts': { str(k): v for k, v in counts.items() } }
+                for (stage, colname), counts in self.value_counts.items()
+            ],
+            'drops': [
+                { 'stage': stage, 'column': colname, 'reason': reason, 'rows': num_rows }
+                for (stage, colname, reason), num_rows in self.drops.items()
+            ]
+        }
+
+def count_values(stage, series, values, qc_report=None):
+    """Count the values of a column with a single pass, adding them to the report.
+
+    Parameters
+    ----------
+    stage : `str`
+        Name of the processing stage.
+    series : `pd.Series`
+        The column to count.
+    values : `list`
+        The values to report, in order (values not present get a count of zero).
+    qc_report : `QCReport`, optional
+        Report to which to add the counts.
+
+    Returns
+    -------
+    `list` or `None`
+        The count of each value, or `None` if QC counts were not requested.
+    """
+    if not qc_requested(qc_report):
+        return None
+    counts = series.value_counts(dropna=False)
+    counts = [ int(counts.get(value, 0)) for value in values ]
+    if qc_report is not None:
+        qc_report.add_value_counts(stage, series.name, dict(zip(values, counts)))
+    return counts
+
+def log_drops(stage, drops, qc_report=None):
+    """Log and report dropped row counts, given as a list of (column name, reason, number of rows) tuples."""
+    for colname, reason, num_rows in drops:
+        if qc_report is not None:
+            qc_report.add_drop(stage, colname, reason, num_rows)
+        logging.debug("Dropping %i rows because %s in %s column" % (num_rows, reason, colname))
+
+class RowMask:
+    """Validity of the rows of a dataframe, with a reason code for each dropped row, carried through the processing stages.
+
+    Stages drop rows by adding reasons to the mask rather than by filtering the dataframe,
+    so that the dataframe is only materialized once, after the last stage.
+    Each row is counted under the first reason that drops it.
+
+    Parameters
+    ----------
+    num_rows : `int`
+        The number of rows of the dataframe.
+    qc_report : `QCReport`, optional
+        Report to which to add the number of rows dropped for each reason.
+
+    Attributes
+    ----------
+    codes : `np.array`
+        Reason code of each row: 0 for valid rows, or `i` for rows dropped for `reasons[i - 1]`.
+    reasons : `list`
+        List of (stage, column name, reason) tuples.
+    """
+    def __init__(self, num_rows, qc_report=None):
+        self.codes = np.zeros(num_rows, dtype=np.int32)
+        self.reasons = []
+        self.qc_report = qc_report
+
+    def __len__(self):
+        return len(self.codes)
+
+    def drop(self, stage, colname, reason, mask):
+        """Drop the (still valid) rows where `mask` is `True`, returning the number of rows dropped.
+
+        Raises
+        ------
+        `ValueError`
+            Raises error if the mask is not boolean (e.g. has NaN values, which would otherwise count as `True`).
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            raise ValueError("Row mask for %s (%s) is not boolean." % (colname, reason))
+        dropped = (self.codes == 0) & mask
+        self.reasons.append((stage, colname, reason))
+        self.codes[dropped] = len(self.reasons)
+        num_rows = int(dropped.sum())
+        log_drops(stage, [(colname, reason, num_rows)], qc_report=self.qc_report)
+        return num_rows
+
+    @property
+    def valid(self):
+        return (self.codes == 0)
+
+    def num_valid(self):
+        return int((self.codes == 0).sum())
+
+    def rows(self):
+        """Get the positions of the valid rows."""
+        return np.flatnonzero(self.codes == 0)
+
+    def drops_df(self):
+        """Get the dropped row counts as a long-format dataframe with stage, column, reason, and rows columns."""
+        code_counts = np.bincount(self.codes, minlength=len(self.reasons) + 1)
+        drops_df = pd.DataFrame(self.reasons, columns=['stage', 'column', 'reason'])
+        drops_df['rows'] = code_counts[1:]
+        return drops_df.groupby(['stage', 'column', 'reason'], sort=False, as_index=False)['rows'].sum()
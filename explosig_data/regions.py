@@ -0,0 +1,158 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger
+from .qc import log_drops
+
+
+def _strip_chr(chr_names):
+    chr_names = pd.Series(chr_names, dtype=str)
+    return chr_names.str.replace(r'^chr', '', regex=True).values
+
+class TargetRegions:
+    """Sorted, merged target intervals (e.g. an exome capture kit), for vectorized overlap lookups.
+
+    Intervals are stored per chromosome as two arrays of 0-based half-open start and end positions,
+    merged so that they do not overlap or touch, so that each lookup is a single `np.searchsorted` call.
+
+    Parameters
+    ----------
+    chr_names : array-like
+        Chromosome names of the intervals (with or without the 'chr' prefix).
+    starts : array-like
+        0-based start positions of the intervals.
+    ends : array-like
+        0-based exclusive end positions of the intervals.
+    padding : `int`, optional
+        Number of base pairs by which to extend each interval on both sides, by default 0
+    """
+    def __init__(self, chr_names, starts, ends, padding=0):
+        chr_names = _strip_chr(chr_names)
+        starts = np.maximum(np.asarray(starts, dtype=np.int64) - padding, 0)
+        ends = np.asarray(ends, dtype=np.int64) + padding
+        if (ends < starts).any():
+            raise ValueError("Interval end positions must not be less than start positions.")
+
+        self.regions = {}
+        for chr_name in pd.unique(chr_names):
+            rows = np.flatnonzero(chr_names == chr_name)
+            order = np.argsort(starts[rows], kind='stable')
+            chr_starts, chr_ends = starts[rows][order], ends[rows][order]
+            # An interval starts a new merged interval if it starts after every earlier interval has ended
+            previous_ends = np.concatenate([[-1], np.maximum.accumulate(chr_ends)[:-1]])
+            new_interval = (chr_starts > previous_ends)
+            merged_ids = np.cumsum(new_interval) - 1
+            merged_ends = np.full(merged_ids[-1] + 1, -1, dtype=np.int64)
+            np.maximum.at(merged_ends, merged_ids, chr_ends)
+            self.regions[chr_name] = (chr_starts[new_interval], merged_ends)
+
+    @classmethod
+    def from_bed(cls, bed_filepath, padding=0):
+        """Load target intervals from the first three columns of a (plain or gzip-compressed) BED file.
+
+        Parameters
+        ----------
+        bed_filepath : `str`
+            Path to the BED file. Header, track, and browser lines are skipped.
+        padding : `int`, optional
+            Number of base pairs by which to extend each interval on both sides, by default 0
+
+        Returns
+        -------
+        `TargetRegions`
+            The merged target intervals.
+        """
+        logging.debug('Loading BED file...')
+        bed_df = pd.read_csv(bed_filepath, sep='\t', header=None, usecols=[0, 1, 2], names=['chr', 'start', 'end'],
+                                dtype={ 'chr': str }, comment='#', low_memory=False)
+        bed_df = bed_df.loc[~bed_df['chr'].str.startswith(('track', 'browser'))]
+        regions = cls(bed_df['chr'].values, bed_df['start'].values.astype(np.int64), bed_df['end'].values.astype(np.int64), padding=padding)
+        logging.debug("Loaded %d intervals as %d merged intervals" % (bed_df.shape[0], len(regions)))
+        return regions
+
+    def __len__(self):
+        return sum(len(chr_starts) for chr_starts, _ in self.regions.values())
+
+    def size(self):
+        """Get the total number of base pairs covered by the merged intervals."""
+        return int(sum((chr_ends - chr_starts).sum() for chr_starts, chr_ends in self.regions.values()))
+
+    def overlaps(self, chr_names, pos_starts, pos_ends):
+        """Check whether positions overlap the target intervals.
+
+        Parameters
+        ----------
+        chr_names : array-like
+            Chromosome names (with or without the 'chr' prefix).
+        pos_starts : array-like
+            1-based start positions.
+        pos_ends : array-like
+            1-based inclusive end positions.
+
+        Returns
+        -------
+        `np.array`
+            Boolean array, `True` where [start, end] overlaps an interval.
+        """
+        pos_starts = np.asarray(pos_starts, dtype=np.int64)
+        pos_ends = np.asarray(pos_ends, dtype=np.int64)
+        result = np.zeros(len(pos_starts), dtype=bool)
+
+        # Group rows by chromosome with one sort, rather than one comparison over all rows per chromosome
+        chr_codes, chr_uniques = pd.factorize(np.asarray(chr_names))
+        chr_uniques = _strip_chr(chr_uniques)
+        order = np.argsort(chr_codes, kind='stable')
+        bounds = np.searchsorted(chr_codes[order], np.arange(len(chr_uniques) + 1))
+        for chr_code, chr_name in enumerate(chr_uniques):
+            if chr_name not in self.regions:
+                continue
+            rows = order[bounds[chr_code]:bounds[chr_code + 1]]
+            chr_starts, chr_ends = self.regions[chr_name]
+            # The first interval that ends after the start position overlaps if it starts at or before the end position
+            i = np.searchsorted(chr_ends, pos_starts[rows] - 1, side='right')
+            in_range = (i < len(chr_starts))
+            result[rows[in_range]] = (chr_starts[i[in_range]] < pos_ends[rows[in_range]])
+        return result
+
+
+def filter_ssm_df_by_regions(ssm_df, regions, mark=False, qc_report=None, console_verbosity=logging.DEBUG):
+    """Restrict a simple somatic mutation dataframe to target regions, e.g. the capture region shared by WXS and WGS samples.
+
+    Positions must be on the same assembly as the target regions (see `liftover_ssm_df`).
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        A standardized simple somatic mutation dataframe.
+    regions : `TargetRegions` or `str`
+        The target regions, or the path to a BED file.
+    mark : `bool`, optional
+        Whether to add a `COLNAME.IN_REGION` column instead of dropping the rows outside the target regions, by default `False`
+    qc_report : `QCReport`, optional
+        Report to which to add the number of dropped rows.
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `pd.DataFrame`
+        The filtered (or marked) dataframe.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    if isinstance(regions, str):
+        regions = TargetRegions.from_bed(regions)
+
+    in_region = regions.overlaps(
+        ssm_df[COLNAME.CHR.value].values,
+        ssm_df[COLNAME.POS_START.value].values,
+        ssm_df[COLNAME.POS_END.value].values
+    )
+    if mark:
+        ssm_df[COLNAME.IN_REGION.value] = in_region
+        return ssm_df
+
+    log_drops('regions', [(COLNAME.POS_START.value, "position outside target regions", int((~in_region).sum()))], qc_report=qc_report)
+    return ssm_df.loc[in_region]
@@ -0,0 +1,340 @@
+import io
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import socketserver
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .constants import *
+from .categories import CATEGORY_SCHEMES
+from .i_o import as_standard_dtypes, read_standard_ssm_file
+from .ssm_extended import extend_ssm_df, apply_reference_mismatch_policy, _check_reference_mismatch_policy
+from .ssm_counts import counts_dfs_from_extended_ssm_df
+
+
+class ServiceBusyError(Exception):
+    pass
+
+class _Request:
+    def __init__(self, ssm_df, reference_mismatch):
+        self.ssm_df = ssm_df
+        self.reference_mismatch = reference_mismatch
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MutationService:
+    """Extend and count standardized mutations against reference data that stays loaded between requests.
+
+    Requests are queued and extended together in batches by a single worker thread: after the first request of a batch arrives,
+    further requests are added until `max_batch_rows` rows are reached or `batch_wait` seconds have passed.
+
+    Parameters
+    ----------
+    genomes : `dict`
+        Dictionary mapping genome assembly enum values to Genome objects.
+    genes : `dict`
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+    categories : `list`, optional
+        Names of the category schemes (keys of `CATEGORY_SCHEMES`) to compute, by default SBS_96, DBS_78, and INDEL_Alexandrov2018_83
+    max_batch_rows : `int`, optional
+        The maximum number of rows per batch, by default 100000
+    batch_wait : `float`, optional
+        The number of seconds to wait for more requests before extending a batch, by default 0.005
+    max_pending : `int`, optional
+        The maximum number of queued or running requests, beyond which requests are rejected, by default 64
+    """
+    def __init__(self, genomes, genes, categories=None, max_batch_rows=100000, batch_wait=0.005, max_pending=64):
+        if categories is None:
+            categories = ['SBS_96', 'DBS_78', 'INDEL_Alexandrov2018_83']
+        unknown_categories = [ c for c in categories if c not in CATEGORY_SCHEMES ]
+        if len(unknown_categories) > 0:
+            raise ValueError("Unknown category scheme(s): %s" % ", ".join(unknown_categories))
+
+        self.genomes = genomes
+        self.genes = genes
+        self.category_functions = { c: CATEGORY_SCHEMES[c][:2] for c in categories }
+        # Category lists are built once, rather than once per request
+        self.category_lists = { c: CATEGORY_SCHEMES[c][2]() for c in categories }
+        self.max_batch_rows = max_batch_rows
+        self.batch_wait = batch_wait
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._queue = queue.Queue()
+        # Held while queueing a request or the stop sentinel, so that no request is queued after the sentinel
+        self._queue_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            with self._queue_lock:
+                self._stopping = True
+                self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            # Fail any requests that the worker did not take, rather than leaving their clients waiting
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request.error = ServiceBusyError("The service was stopped.")
+                    request.done.set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def extend(self, ssm_df, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value):
+        """Extend a standardized simple somatic mutation dataframe, waiting for the batch that contains it.
+
+        Raises
+        ------
+        `ValueError`
+            Raises error if the dataframe is invalid, or a reference sequence does not match the genome and `reference_mismatch` is 'raise'.
+        `ServiceBusyError`
+            Raises error if `max_pending` requests are already queued or running, or the service is stopping.
+        """
+        _check_reference_mismatch_policy(reference_mismatch)
+        missing_cols = [ c for c in SSM_COLUMNS if c not in ssm_df.columns ]
+        if len(missing_cols) > 0:
+            raise ValueError("Mutations are missing column(s): %s" % ", ".join(missing_cols))
+        if ssm_df.shape[0] == 0:
+            raise ValueError("No mutations were provided.")
+        if self._thread is None:
+            raise ValueError("The service has not been started.")
+
+        if not self._pending.acquire(blocking=False):
+            raise ServiceBusyError("Too many pending requests.")
+        try:
+            request = _Request(as_standard_dtypes(ssm_df.reset_index(drop=True)), reference_mismatch)
+            with self._queue_lock:
+                if self._stopping:
+                    raise ServiceBusyError("The service is stopping.")
+                self._queue.put(request)
+            request.done.wait()
+        finally:
+            self._pending.release()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def counts(self, ssm_df, categories=None, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value):
+        """Extend a standardized simple somatic mutation dataframe and count its mutations.
+
+        Returns
+        -------
+        `dict`
+            Dictionary mapping category scheme names to count matrix dataframes (index is sample IDs, columns are category values).
+        """
+        if categories is None:
+            categories = list(self.category_lists.keys())
+        unknown_categories = [ c for c in categories if c not in self.category_lists ]
+        if len(unknown_categories) > 0:
+            raise ValueError("Category scheme(s) not served: %s" % ", ".join(unknown_categories))
+        extended_df = self.extend(ssm_df, reference_mismatch=reference_mismatch)
+        return counts_dfs_from_extended_ssm_df(extended_df, { c: self.category_lists[c] for c in categories }, console_verbosity=logging.WARNING)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            num_rows = request.ssm_df.shape[0]
+            deadline = time.time() + self.batch_wait
+            while num_rows < self.max_batch_rows:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                num_rows += request.ssm_df.shape[0]
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            self._process_batch(batch)
+        except Exception as e:
+            # Any other error fails the requests of the batch that are still waiting, and the worker thread keeps running
+            logging.exception(str(e))
+            for r in batch:
+                if not r.done.is_set():
+                    r.error = e
+                    r.done.set()
+
+    def _process_batch(self, batch):
+        batch_df = pd.concat([ r.ssm_df for r in batch ], ignore_index=True)
+        request_ids = np.repeat(np.arange(len(batch)), [ r.ssm_df.shape[0] for r in batch ])
+        logging.debug("Extending a batch of %d requests with %d rows" % (len(batch), batch_df.shape[0]))
+        try:
+            # Mismatches are flagged for the whole batch, and then handled with the policy of each request
+            extended_df = extend_ssm_df(batch_df, category_functions=self.category_functions, genomes=self.genomes, genes=self.genes,
+                                        reference_mismatch=REF_MISMATCH_POLICY.FLAG.value, console_verbosity=logging.WARNING)
+        except Exception as e:
+            if len(batch) > 1:
+                # Retry one request at a time, so that an invalid request does not fail the rest of the batch
+                for r in batch:
+                    self._process([r])
+            else:
+                batch[0].error = e
+                batch[0].done.set()
+            return
+
+        for i, r in enumerate(batch):
+            request_df = extended_df.iloc[np.flatnonzero(request_ids == i)].reset_index(drop=True)
+            mismatches = request_df.pop(COLNAME.REF_MISMATCH.value).values.astype(bool)
+            try:
+                r.result = apply_reference_mismatch_policy(request_df, mismatches, r.reference_mismatch)
+            except ValueError as e:
+                r.error = e
+            r.done.set()
+
+
+def _df_to_dict(df, index=True):
+    return json.loads(df.to_json(orient='split', index=index))
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP endpoints of a `MutationService`.
+
+    - GET /health
+    - POST /extend, returning the extended rows as a {"columns": [...], "data": [[...], ...]} object
+    - POST /counts, returning a {"counts": {category scheme: {"index": [...], "columns": [...], "data": [[...], ...]}}} object
+
+    POST bodies are either JSON, {"mutations": {"columns": [...], "data": [[...], ...]} or [{column: value}, ...], "categories": [...], "reference_mismatch": ...},
+    or a standardized mutation TSV file (Content-Type text/tab-separated-values) with the options as query parameters.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Clients connected over a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and len(self.client_address) > 0 else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_request(self):
+        url = urlparse(self.path)
+        options = { k: v[-1] for k, v in parse_qs(url.query).items() }
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('text/tab-separated-values'):
+            ssm_df = read_standard_ssm_file(io.StringIO(body.decode('utf-8')))
+            if 'categories' in options:
+                options['categories'] = options['categories'].split(',')
+        else:
+            try:
+                obj = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise ValueError("Request body is not valid JSON.")
+            if not isinstance(obj, dict) or 'mutations' not in obj:
+                raise ValueError("Request body is missing the mutations.")
+            mutations = obj.pop('mutations')
+            if isinstance(mutations, dict):
+                ssm_df = pd.DataFrame(mutations.get('data', []), columns=mutations.get('columns'))
+            else:
+                ssm_df = pd.DataFrame(mutations)
+            options.update(obj)
+        return url.path, ssm_df, options
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self._send_json(404, { 'error': 'Not found.' })
+            return
+        service = self.server.service
+        self._send_json(200, {
+            'status': 'ok',
+            'assemblies': sorted(service.genomes.keys()),
+            'categories': list(service.category_lists.keys()),
+        })
+
+    def do_POST(self):
+        service = self.server.service
+        if urlparse(self.path).path not in ['/extend', '/counts']:
+            self._send_json(404, { 'error': 'Not found.' })
+            return
+        try:
+            path, ssm_df, options = self._read_request()
+            reference_mismatch = options.get('reference_mismatch', self.server.reference_mismatch)
+            if path == '/extend':
+                extended_df = service.extend(ssm_df, reference_mismatch=reference_mismatch)
+                self._send_json(200, _df_to_dict(extended_df, index=False))
+            elif path == '/counts':
+                counts_dfs = service.counts(ssm_df, categories=options.get('categories'), reference_mismatch=reference_mismatch)
+                self._send_json(200, { 'counts': { c: _df_to_dict(counts_df) for c, counts_df in counts_dfs.items() } })
+        except ServiceBusyError as e:
+            self._send_json(503, { 'error': str(e) })
+        except (ValueError, KeyError) as e:
+            self._send_json(400, { 'error': str(e) })
+        except Exception as e:
+            logging.exception(str(e))
+            self._send_json(500, { 'error': str(e) })
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace a stale socket file left by a previous server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+def make_server(service, host='127.0.0.1', port=8000, unix_socket=None, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value):
+    """Create an HTTP server for a (started) `MutationService`, listening on a local port or on a Unix socket.
+
+    Parameters
+    ----------
+    service : `MutationService`
+        The service to which to pass requests.
+    host : `str`, optional
+        The address on which to listen, by default '127.0.0.1'
+    port : `int`, optional
+        The port on which to listen, by default 8000 (0 to pick a free port, see `server.server_address`)
+    unix_socket : `str`, optional
+        Path of a Unix socket on which to listen instead of a port, by default `None`
+    reference_mismatch : `str`, optional
+        The reference mismatch policy for requests that do not specify one, by default 'raise'
+
+    Returns
+    -------
+    `socketserver.BaseServer`
+        The server, to be run with `serve_forever()` and closed with `server_close()`.
+    """
+    _check_reference_mismatch_policy(reference_mismatch)
+    if unix_socket is not None:
+        server = _ThreadingUnixHTTPServer(unix_socket, ServiceRequestHandler)
+    else:
+        server = _ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.service = service
+    server.reference_mismatch = reference_mismatch
+    return server
@@ -3,6 +3,8 @@ import gzip
 import shutil
 from math import floor
 
+from explosig_data.bgzf import bgzip_fasta
+
 HG19_FASTA_URL = 'http://ftp.ensembl.org/pub/release-75/fasta/homo_sapiens/dna/Homo_sapiens.GRCh37.75.dna.primary_assembly.fa.gz'
 HG38_FASTA_URL = 'http://ftp.ensembl.org/pub/release-85/fasta/homo_sapiens/dna/Homo_sapiens.GRCh38.dna.primary_assembly.fa.gz'
 
@@ -10,11 +12,14 @@ def print_download_progress(x, y, z):
     if floor(x*y*100/z) - floor((x-1)*y*100/z) >= 1:
         print("Download progress: {}%".format(floor(x*y*100/z)))
 
+# With format 'bgzf', the downloads are recompressed with random-access indexes rather than extracted
+GENOME_EXT = ('.bgz' if config.get('format', 'fasta') == 'bgzf' else '')
+
 # Rules
 rule genomes_human_all:
     input:
-        config['output']['hg19'],
-        config['output']['hg38']
+        config['output']['hg19'] + GENOME_EXT,
+        config['output']['hg38'] + GENOME_EXT
 
 rule genomes_human_hg19_extract:
     input:
@@ -36,6 +41,26 @@ rule genomes_human_hg38_extract:
             with open(config['output']['hg38'], 'wb') as f_out:
                 shutil.copyfileobj(f_in, f_out)
 
+rule genomes_human_hg19_bgzip:
+    input:
+        config['output']['hg19'] + '.gz'
+    output:
+        config['output']['hg19'] + '.bgz',
+        config['output']['hg19'] + '.bgz.fai',
+        config['output']['hg19'] + '.bgz.gzi'
+    run:
+        bgzip_fasta(config['output']['hg19'] + '.gz', config['output']['hg19'] + '.bgz')
+
+rule genomes_human_hg38_bgzip:
+    input:
+        config['output']['hg38'] + '.gz'
+    output:
+        config['output']['hg38'] + '.bgz',
+        config['output']['hg38'] + '.bgz.fai',
+        config['output']['hg38'] + '.bgz.gzi'
+    run:
+        bgzip_fasta(config['output']['hg38'] + '.gz', config['output']['hg38'] + '.bgz')
+
 rule genomes_human_hg19_download:
     output:
         config['output']['hg19'] + '.gz'
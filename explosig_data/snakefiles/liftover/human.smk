@@ -0,0 +1,35 @@
+from urllib.request import urlretrieve
+from math import floor
+
+HG19_TO_HG38_CHAIN_URL = 'http://hgdownload.soe.ucsc.edu/goldenPath/hg19/liftOver/hg19ToHg38.over.chain.gz'
+HG38_TO_HG19_CHAIN_URL = 'http://hgdownload.soe.ucsc.edu/goldenPath/hg38/liftOver/hg38ToHg19.over.chain.gz'
+
+def print_download_progress(x, y, z):
+    if floor(x*y*100/z) - floor((x-1)*y*100/z) >= 1:
+        print("Download progress: {}%".format(floor(x*y*100/z)))
+
+# Rules
+rule liftover_human_all:
+    input:
+        config['output']['hg19_to_hg38'],
+        config['output']['hg38_to_hg19']
+
+rule liftover_human_hg19_to_hg38_download:
+    output:
+        config['output']['hg19_to_hg38']
+    run:
+        urlretrieve(
+            HG19_TO_HG38_CHAIN_URL, 
+            config['output']['hg19_to_hg38'], 
+            reporthook=print_download_progress
+        )
+
+rule liftover_human_hg38_to_hg19_download:
+    output:
+        config['output']['hg38_to_hg19']
+    run:
+        urlretrieve(
+            HG38_TO_HG19_CHAIN_URL, 
+            config['output']['hg38_to_hg19'], 
+            reporthook=print_download_progress
+        )
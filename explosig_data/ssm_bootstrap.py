@@ -0,0 +1,123 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger
+
+
+def _binomial_draws(rng, totals, counts, num_replicates):
+    """Draw multinomial replicates with sequential conditional binomials, vectorized over replicates and rows.
+
+    Parameters
+    ----------
+    rng : `np.random.Generator`
+        The random number generator.
+    totals : `np.array`
+        Number of draws for each row, shape (rows,).
+    counts : `np.array`
+        Observed counts, shape (rows, categories). The multinomial probabilities are `counts / totals`.
+    num_replicates : `int`
+        Number of replicates to draw.
+
+    Returns
+    -------
+    `np.array`
+        Replicate counts, shape (replicates, rows, categories).
+    """
+    draws = np.zeros((num_replicates,) + counts.shape, dtype=np.int64)
+    # Draws not yet assigned to a category, and the observed counts not yet used as probability mass
+    remaining_draws = np.broadcast_to(totals, (num_replicates, len(totals))).copy()
+    remaining_counts = totals.copy()
+    for k in range(counts.shape[1]):
+        counts_k = counts[:, k]
+        if not counts_k.any():
+            continue
+        # P(category k | not categories < k), from integer counts so the last category of each row gets all remaining draws
+        p = np.divide(counts_k, remaining_counts, out=np.zeros(len(counts_k)), where=(remaining_counts > 0))
+        draws[:, :, k] = rng.binomial(remaining_draws, np.minimum(p, 1.0))
+        remaining_draws -= draws[:, :, k]
+        remaining_counts = remaining_counts - counts_k
+    return draws
+
+def bootstrap_counts(counts_df, num_replicates, batch_size=10, seed=None, console_verbosity=logging.DEBUG):
+    """Draw bootstrap replicates of a mutation count dataframe, resampling the mutations of every sample at once.
+
+    Each replicate of a sample is a multinomial draw with the sample's total number of mutations
+    and the sample's observed category frequencies as probabilities.
+    Replicates are yielded in batches, so that only `batch_size` replicates are held in memory at a time.
+
+    Parameters
+    ----------
+    counts_df : `pd.DataFrame`
+        A mutation count dataframe produced by `counts_from_extended_ssm_df`, in either the matrix format
+        (index is sample IDs, columns are category values) or the sparse format (sample, category, and counts columns).
+    num_replicates : `int`
+        The total number of replicates to draw.
+    batch_size : `int`, optional
+        The number of replicates per batch, by default 10
+    seed : `int` or `np.random.Generator`, optional
+        Seed for `np.random.default_rng`, by default `None`. The same seed and batch size give the same replicates.
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Yields
+    ------
+    `pd.DataFrame`
+        For matrix input, a dataframe with a (replicate, sample ID) index and the category values as columns.
+        For sparse input, a dataframe with replicate, sample, category, and counts columns, without zero counts.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the counts are negative or the sparse format columns are missing.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    if batch_size < 1:
+        raise ValueError("Batch size must be at least 1.")
+
+    rng = np.random.default_rng(seed)
+    sparse_input = ('counts' in counts_df.columns)
+
+    if sparse_input:
+        category_colnames = [ c for c in counts_df.columns if c not in [COLNAME.SAMPLE.value, 'counts'] ]
+        if COLNAME.SAMPLE.value not in counts_df.columns or len(category_colnames) != 1:
+            raise ValueError("Sparse counts dataframe must have exactly the sample, category, and counts columns.")
+        category_colname = category_colnames[0]
+        # Order the non-zero entries by sample, and lay them out as a (sample, position within sample) matrix
+        counts_df = counts_df.loc[counts_df['counts'].values > 0]
+        sample_codes, samples = pd.factorize(counts_df[COLNAME.SAMPLE.value], sort=True)
+        order = np.argsort(sample_codes, kind='stable')
+        sample_codes = sample_codes[order]
+        entry_counts = counts_df['counts'].values[order].astype(np.int64)
+        entry_categories = counts_df[category_colname].values[order]
+        starts = np.searchsorted(sample_codes, np.arange(len(samples)))
+        positions = np.arange(len(sample_codes)) - starts[sample_codes]
+        counts = np.zeros((len(samples), (positions.max() + 1) if len(positions) > 0 else 0), dtype=np.int64)
+        counts[sample_codes, positions] = entry_counts
+    else:
+        counts = counts_df.values.astype(np.int64)
+
+    if (counts < 0).any():
+        raise ValueError("Counts must not be negative.")
+    totals = counts.sum(axis=1)
+
+    logging.debug("Drawing %d bootstrap replicates of %d samples in batches of %d" % (num_replicates, counts.shape[0], batch_size))
+
+    for batch_start in range(0, num_replicates, batch_size):
+        batch_replicates = np.arange(batch_start, min(batch_start + batch_size, num_replicates))
+        draws = _binomial_draws(rng, totals, counts, len(batch_replicates))
+
+        if sparse_input:
+            draws = draws[:, sample_codes, positions]
+            replicate_idx, entry_idx = np.nonzero(draws)
+            yield pd.DataFrame({
+                'replicate': batch_replicates[replicate_idx],
+                COLNAME.SAMPLE.value: samples.values[sample_codes[entry_idx]],
+                category_colname: entry_categories[entry_idx],
+                'counts': draws[replicate_idx, entry_idx]
+            })
+        else:
+            index = pd.MultiIndex.from_product([batch_replicates, counts_df.index], names=['replicate', counts_df.index.name])
+            yield pd.DataFrame(draws.reshape(-1, counts.shape[1]), index=index, columns=counts_df.columns)
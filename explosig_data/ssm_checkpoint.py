@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger, write_pickle_atomic, write_json_atomic
+from .ssm_extended import extend_ssm_df, default_category_functions
+from .genomes import get_human_genomes_dict
+from .genes import get_human_genes_dict
+
+# Checkpointed extension of a standardized simple somatic mutation dataframe, in batches of samples.
+#
+# Progress is kept in a checkpoint directory, laid out as follows:
+#
+#   checkpoint_dir/manifest.json               input fingerprint and batch assignments (written before the first batch)
+#   checkpoint_dir/batches/batch-00000.pickle  extended rows of a completed batch (written atomically)
+#
+# A batch is complete once its file exists, so a restarted run skips it.
+
+MANIFEST_FILENAME = 'manifest.json'
+
+def _batch_path(checkpoint_dir, batch_id):
+    return os.path.join(checkpoint_dir, 'batches', 'batch-%05d.pickle' % batch_id)
+
+def _fingerprint(ssm_df):
+    # Identifies the input rows (including their order), so that a checkpoint is never resumed with different input
+    key_cols = [ COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value, COLNAME.POS_END.value, COLNAME.REF.value, COLNAME.VAR.value ]
+    hashes = pd.util.hash_pandas_object(ssm_df[key_cols].astype(str), index=False).values
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+def extend_ssm_df_checkpointed(ssm_df, checkpoint_dir, samples_per_batch=100, category_functions=None, genomes=None, genes=None,
+                                reference_mismatch=REF_MISMATCH_POLICY.RAISE.value, console_verbosity=logging.DEBUG):
+    """Extend a standardized simple somatic mutation dataframe in batches of samples, saving each completed batch to disk.
+
+    Samples are assigned to batches in sorted order, so the batches are the same every time the same input is extended.
+    If the run is interrupted, calling this function again with the same input and checkpoint directory skips the completed batches.
+    The result is the same as that of `extend_ssm_df` on the whole dataframe.
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        An already-standardized simple somatic mutation dataframe.
+    checkpoint_dir : `str`
+        Path to the checkpoint directory.
+    samples_per_batch : `int`, optional
+        The number of samples per batch, by default 100
+    category_functions : `dict`, optional
+        Dictionary mapping category column names to tuples: (category_name_func, `list` of applicable mutation type enum values).
+    genomes : `dict`, optional
+        Dictionary mapping genome assembly enum values to Genome objects.
+    genes : `dict`, optional
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+    reference_mismatch : `str`, optional
+        What to do with mutations whose reference sequence does not match the genome ('raise', 'drop', or 'flag'), by default 'raise'
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `pd.DataFrame`
+        Mutation dataframe in the extended format.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the dataframe has no rows, or if the checkpoint directory was created for a different input or different settings.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    if category_functions == None:
+        category_functions = default_category_functions()
+
+    if ssm_df.shape[0] == 0:
+        raise ValueError("Input dataframe has no rows.")
+
+    sample_ids = ssm_df[COLNAME.SAMPLE.value].astype(str).values
+    samples = np.sort(pd.unique(sample_ids))
+    batch_ids = np.searchsorted(samples, sample_ids) // samples_per_batch
+    num_batches = int((len(samples) + samples_per_batch - 1) // samples_per_batch)
+
+    manifest = {
+        'fingerprint': _fingerprint(ssm_df),
+        'rows': int(ssm_df.shape[0]),
+        'samples_per_batch': samples_per_batch,
+        'num_batches': num_batches,
+        'categories': sorted(category_functions.keys()),
+        'reference_mismatch': reference_mismatch
+    }
+    manifest_path = os.path.join(checkpoint_dir, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            existing_manifest = json.load(f)
+        if existing_manifest != manifest:
+            raise ValueError("Checkpoint directory '%s' was created for a different input or different settings." % checkpoint_dir)
+    else:
+        os.makedirs(os.path.join(checkpoint_dir, 'batches'), exist_ok=True)
+        write_json_atomic(manifest, manifest_path)
+
+    remaining_ids = [ i for i in range(num_batches) if not os.path.exists(_batch_path(checkpoint_dir, i)) ]
+    logging.debug("%d of %d batches have already been completed" % (num_batches - len(remaining_ids), num_batches))
+    # Reference data is loaded once for all batches
+    if len(remaining_ids) > 0:
+        if genomes == None:
+            genomes = get_human_genomes_dict()
+        if genes == None:
+            genes = get_human_genes_dict()
+
+    # Rows are indexed by their position in the input while extending, to restore the input order when assembling the batches
+    positions_df = ssm_df.reset_index(drop=True)
+    for batch_id in remaining_ids:
+        batch_df = positions_df.loc[batch_ids == batch_id]
+        extended_df = extend_ssm_df(batch_df.copy(), category_functions=category_functions, genomes=genomes, genes=genes,
+                                    reference_mismatch=reference_mismatch, console_verbosity=console_verbosity)
+        write_pickle_atomic(extended_df, _batch_path(checkpoint_dir, batch_id))
+        logging.debug("Completed batch %d of %d (%d rows)" % (batch_id + 1, num_batches, batch_df.shape[0]))
+
+    extended_df = pd.concat([ pd.read_pickle(_batch_path(checkpoint_dir, i)) for i in range(num_batches) ])
+    extended_df = extended_df.sort_index(kind='mergesort')
+    extended_df.index = ssm_df.index[extended_df.index.values]
+    return extended_df
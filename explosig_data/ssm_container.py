@@ -2,19 +2,119 @@ import pandas as pd
 import logging
 
 from .ssm_extended import extend_ssm_df
-from .ssm_counts import counts_from_extended_ssm_df
+from .ssm_checkpoint import extend_ssm_df_checkpointed
+from .ssm_counts import counts_from_extended_ssm_df, counts_dfs_from_extended_ssm_df
+from .ssm_stream import counts_from_ssm_chunks
+from .ssm_store import SimpleSomaticMutationStore, write_ssm_store
+from .liftover import liftover_ssm_df
+from .ssm_bootstrap import bootstrap_counts
+from .regions import filter_ssm_df_by_regions
+from .ssm_genes import gene_counts_from_ssm_df
+from .ssm_cube import CountCube
+from .arrow_io import as_pandas_df, df_to_arrow
+from .constants import *
 
 class SimpleSomaticMutationContainer(object):
 
-    def __init__(self, ssm_df):
-        self.ssm_df = ssm_df
+    def __init__(self, ssm_df, qc_report=None):
+        # Arrow tables and Polars dataframes are converted once, and the stages then share the dataframe
+        self._ssm_df = as_pandas_df(ssm_df)
+        self.qc_report = qc_report
+        self.store = None
+        self.store_query = {}
+        self.unmapped_df = None
         self.extended_df = None
         self.counts_dfs = {}
+        self.count_cubes = {}
+
+    @property
+    def ssm_df(self):
+        # Containers opened from a store only read the matching mutations on first access
+        if self._ssm_df is None and self.store is not None:
+            self._ssm_df = self.store.query(**self.store_query)
+        return self._ssm_df
+
+    @ssm_df.setter
+    def ssm_df(self, ssm_df):
+        self._ssm_df = ssm_df
+
+    @classmethod
+    def from_store(cls, store, samples=None, cancer_types=None, region=None):
+        if not isinstance(store, SimpleSomaticMutationStore):
+            store = SimpleSomaticMutationStore(store)
+        container = cls(None)
+        container.store = store
+        container.store_query = dict(samples=samples, cancer_types=cancer_types, region=region)
+        return container
+
+    @classmethod
+    def from_ssm_chunks(cls, ssm_chunks, category_lists, **kwargs):
+        # Streaming mode: only the count matrices are kept, so ssm_df and extended_df remain None
+        container = cls(None)
+        container.counts_dfs = counts_from_ssm_chunks(ssm_chunks, category_lists, **kwargs)
+        return container
     
-    def extend_df(self, **kwargs):
-        self.extended_df = extend_ssm_df(self.ssm_df, **kwargs)
+    def liftover_df(self, target_assembly, **kwargs):
+        # Unmapped rows are kept for inspection
+        self.ssm_df, self.unmapped_df = liftover_ssm_df(self.ssm_df, target_assembly=target_assembly, return_unmapped=True, **kwargs)
+        return self
+
+    def filter_regions(self, regions, **kwargs):
+        kwargs.setdefault('qc_report', self.qc_report)
+        self.ssm_df = filter_ssm_df_by_regions(self.ssm_df, regions, **kwargs)
+        return self
+
+    def extend_df(self, checkpoint_dir=None, **kwargs):
+        # With a checkpoint directory, completed batches of samples are saved, and an interrupted call can be resumed
+        if checkpoint_dir is not None:
+            self.extended_df = extend_ssm_df_checkpointed(self.ssm_df, checkpoint_dir, **kwargs)
+        else:
+            self.extended_df = extend_ssm_df(self.ssm_df, **kwargs)
         return self
     
     def to_counts_df(self, category_colname, category_values, **kwargs):
+        kwargs.setdefault('qc_report', self.qc_report)
         self.counts_dfs[category_colname] = counts_from_extended_ssm_df(self.extended_df, category_colname, category_values, **kwargs)
-        return self
\ No newline at end of file
+        return self
+
+    def bootstrap_counts_df(self, category_colname, num_replicates, **kwargs):
+        # Returns a generator of replicate batches rather than the container, since replicates are not kept
+        return bootstrap_counts(self.counts_dfs[category_colname], num_replicates, **kwargs)
+
+    def to_counts_dfs(self, category_lists, **kwargs):
+        # Counts several category columns in one pass, e.g. to_counts_dfs({ 'SBS_96': SBS_96_category_list(), 'DBS_78': DBS_78_category_list() })
+        kwargs.setdefault('qc_report', self.qc_report)
+        self.counts_dfs.update(counts_dfs_from_extended_ssm_df(self.extended_df, category_lists, **kwargs))
+        return self
+
+    def to_count_cube(self, category_colname, category_values, **kwargs):
+        # Roll up with self.count_cubes[category_colname].rollup(COLNAME.PATIENT.value), for example
+        kwargs.setdefault('qc_report', self.qc_report)
+        self.count_cubes[category_colname] = CountCube(self.extended_df, category_colname, category_values, **kwargs)
+        return self
+
+    def to_gene_counts_df(self, **kwargs):
+        # Gene by sample counts only need positions, so they are computed from ssm_df rather than extended_df
+        kwargs.setdefault('qc_report', self.qc_report)
+        self.counts_dfs[COLNAME.GENE_SYMBOL.value] = gene_counts_from_ssm_df(self.ssm_df, **kwargs)
+        return self
+
+    def to_arrow(self, output_format='arrow'):
+        # Returns a dict of the dataframes computed so far as Arrow tables (or Polars dataframes), rather than the container:
+        # 'ssm_df', 'extended_df', and 'counts_dfs' (a dict by category column name)
+        tables = {}
+        if self._ssm_df is not None:
+            tables['ssm_df'] = df_to_arrow(self._ssm_df, output_format=output_format)
+        if self.extended_df is not None:
+            tables['extended_df'] = df_to_arrow(as_pandas_df(self.extended_df), output_format=output_format)
+        tables['counts_dfs'] = {}
+        for colname, counts_df in self.counts_dfs.items():
+            # Count matrices keep their sample IDs as a first column, and sparse counts already have one
+            counts_df = as_pandas_df(counts_df)
+            index_name = None if COLNAME.SAMPLE.value in counts_df.columns else COLNAME.SAMPLE.value
+            tables['counts_dfs'][colname] = df_to_arrow(counts_df, output_format=output_format, index_name=index_name)
+        return tables
+
+    def to_store(self, store_dir):
+        self.store = write_ssm_store(self.ssm_df, store_dir)
+        return self
@@ -1,25 +1,33 @@
 import logging
+import numpy as np
 import pandas as pd
 
 from .constants import *
 from .categories import *
 from .i_o import get_logger, get_df_drop_message
+from .qc import log_drops
+from .arrow_io import as_pandas_df, check_output_format, df_to_arrow
 
 
 def counts_from_extended_ssm_df(extended_df, category_colname, category_values,
-                                sparse_output=False, console_verbosity=logging.DEBUG):
+                                sparse_output=False, qc_report=None, output_format='pandas', console_verbosity=logging.DEBUG):
     """Construct a count matrix dataframe from a simple somatic mutation dataframe that has already been "extended".
     
     Parameters
     ----------
-    extended_df : `pd.DataFrame`
-        An extended simple somatic mutation dataframe (e.g. produced by the `extend_ssm_df` function).
+    extended_df : `pd.DataFrame`, `pyarrow.Table`, or `polars.DataFrame`
+        An extended simple somatic mutation dataframe (e.g. produced by the `extend_ssm_df` function), or Arrow table.
     category_colname : `str`
         The category column name.
     category_values : `list`
         A list of all possible values for the category column. These will become the column names of the output dataframe.
     sparse_output : `bool`, optional
         Whether the returned dataframe will be in a sparse format, by default `False`
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of dropped rows.
+    output_format : `str`, optional
+        Return 'pandas' dataframes, 'arrow' tables, or 'polars' dataframes, by default 'pandas'.
+        Count matrices in the Arrow formats hold the sample IDs in a first `COLNAME.SAMPLE` column.
     console_verbosity : `int`, optional
         Logging verbosity enum value, by default `logging.DEBUG`
     
@@ -33,63 +41,111 @@ def counts_from_extended_ssm_df(extended_df, category_colname, category_values,
     `ValueError`
         Raises error if expected columns are missing from the input dataframe.
     """
-    
-    ssm_df = extended_df
-    categories = category_values
-
-    dtypes = {
-        COLNAME.PATIENT.value: str,
-        COLNAME.SAMPLE.value: str,
-        COLNAME.CHR.value: str,
-        COLNAME.POS_START.value: object,
-        COLNAME.POS_END.value: object,
-        COLNAME.TSTRAND.value: str,
-        COLNAME.REF.value: str,
-        COLNAME.VAR.value: str,
-        COLNAME.FPRIME.value: str,
-        COLNAME.TPRIME.value: str,
-        COLNAME.MUT_TYPE.value: str,
-        category_colname: str
-    }
+    return counts_dfs_from_extended_ssm_df(extended_df, { category_colname: category_values }, sparse_output=sparse_output,
+                                            qc_report=qc_report, output_format=output_format, console_verbosity=console_verbosity)[category_colname]
+
+def counts_dfs_from_extended_ssm_df(extended_df, category_lists, sparse_output=False, qc_report=None, output_format='pandas',
+                                    console_verbosity=logging.DEBUG):
+    """Construct the count matrix dataframes of several category columns at once.
+
+    The sample column is factorized and the NaN allele masks are computed once, and each matrix is then counted with a single `np.bincount`.
+    The results are the same as calling `counts_from_extended_ssm_df` for each category column.
+
+    Parameters
+    ----------
+    extended_df : `pd.DataFrame`, `pyarrow.Table`, or `polars.DataFrame`
+        An extended simple somatic mutation dataframe (e.g. produced by the `extend_ssm_df` function), or Arrow table.
+    category_lists : `dict`
+        Dictionary mapping category column names to lists of all possible values for the category column.
+    sparse_output : `bool`, optional
+        Whether the returned dataframes will be in a sparse format, by default `False`
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of dropped rows.
+    output_format : `str`, optional
+        Return 'pandas' dataframes, 'arrow' tables, or 'polars' dataframes, by default 'pandas'.
+        Count matrices in the Arrow formats hold the sample IDs in a first `COLNAME.SAMPLE` column.
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `dict`
+        Dictionary mapping category column names to mutation count dataframes (see `counts_from_extended_ssm_df`).
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if expected columns are missing from the input dataframe.
+    """
+
+    check_output_format(output_format)
+    ssm_df = as_pandas_df(extended_df)
+
+    expected_cols = [
+        COLNAME.PATIENT.value,
+        COLNAME.SAMPLE.value,
+        COLNAME.CHR.value,
+        COLNAME.POS_START.value,
+        COLNAME.POS_END.value,
+        COLNAME.TSTRAND.value,
+        COLNAME.REF.value,
+        COLNAME.VAR.value,
+        COLNAME.FPRIME.value,
+        COLNAME.TPRIME.value,
+        COLNAME.MUT_TYPE.value,
+    ]
 
     # Check that the input df contains the expected columns.
-    missing_cols = list(set(dtypes.keys()) - set(ssm_df.columns.values))
-    if len(missing_cols) == 1 and missing_cols[0] == category_colname:
-        raise ValueError("Input dataframe is missing the category column.")
-    elif len(missing_cols) > 1:
-        raise ValueError("Input dataframe is missing too many columns.")
-
-    # Filter out mutations with categories not in our lists
-    filtered_df = ssm_df.loc[ssm_df[category_colname].isin(set(categories))].copy()
-    logging.debug(get_df_drop_message(category_colname, "invalid value", ssm_df, filtered_df))
-    ssm_df = filtered_df
-
-    # remove na's
-    filtered_df = ssm_df.dropna(subset=[COLNAME.VAR.value])
-    logging.debug(get_df_drop_message(COLNAME.VAR.value, "NaN value", ssm_df, filtered_df))
-    ssm_df = filtered_df
-
-    filtered_df = ssm_df.dropna(subset=[COLNAME.REF.value])
-    logging.debug(get_df_drop_message(COLNAME.REF.value, "NaN value", ssm_df, filtered_df))
-    ssm_df = filtered_df
-
-    groups = ssm_df.groupby([COLNAME.SAMPLE.value, category_colname])
-
-    counts_df = groups.size().reset_index(name='counts')
-
-    # TODO: figure out how to factor in transcription strand column. and donor column.
-    #       (easy with sparse output format (just add to the groupby),
-    #           but for matrix-style output format need to look into using pandas MultiIndex columns)
-
-    if sparse_output:
-        return counts_df
-    else:
-        # Initialize sample x context matrix to hold mutation context counts
-        counts_matrix_df = pd.DataFrame(data=0, columns=categories, index=list(ssm_df[COLNAME.SAMPLE.value].unique()))
-        # Pivot to get a (possibly) incomplete matrix
-        partial_matrix_df = counts_df.pivot(index=COLNAME.SAMPLE.value, columns=category_colname, values='counts')
-        # Expand back out and fill empty cells with zeros
-        counts_matrix_df = counts_matrix_df.add(partial_matrix_df, fill_value=0)
-        # Select columns using the category list array (pandas add function does reorder the columns for some reason)
-        counts_matrix_df = counts_matrix_df[categories]
-        return counts_matrix_df
\ No newline at end of file
+    for category_colname in category_lists.keys():
+        missing_cols = list(set(expected_cols + [category_colname]) - set(ssm_df.columns.values))
+        if len(missing_cols) == 1 and missing_cols[0] == category_colname:
+            raise ValueError("Input dataframe is missing the category column.")
+        elif len(missing_cols) > 1:
+            raise ValueError("Input dataframe is missing too many columns.")
+
+    # Shared by all category columns: NaN allele masks, and sample codes (in sorted order, as in the output index)
+    na_var = ssm_df[COLNAME.VAR.value].isna().values
+    na_ref = ssm_df[COLNAME.REF.value].isna().values
+    sample_codes, samples = pd.factorize(ssm_df[COLNAME.SAMPLE.value].values, sort=True)
+    valid_sample = (sample_codes >= 0)
+
+    counts_dfs = {}
+    for category_colname, categories in category_lists.items():
+        category_codes = pd.Categorical(ssm_df[category_colname].values, categories=categories).codes.astype(np.int64)
+        # Filter out mutations with categories not in our lists, or with NaN alleles, with a single mask
+        invalid_category = (category_codes < 0)
+        log_drops('count', [
+            (category_colname, "invalid value", int(invalid_category.sum())),
+            (COLNAME.VAR.value, "NaN value", int((na_var & ~invalid_category).sum())),
+            (COLNAME.REF.value, "NaN value", int((na_ref & ~(invalid_category | na_var)).sum())),
+        ], qc_report=qc_report)
+        valid = ~(invalid_category | na_var | na_ref) & valid_sample
+
+        # Count every (sample, category) pair in one pass
+        num_categories = len(categories)
+        counts_matrix = np.bincount(
+            sample_codes[valid] * num_categories + category_codes[valid], minlength=len(samples) * num_categories
+        ).reshape(len(samples), num_categories)
+        # Only samples with at least one counted mutation are included
+        present = (counts_matrix.sum(axis=1) > 0)
+
+        # Counts by transcription strand, or rolled up to patients, cancer types, or cohorts, are provided by `CountCube`
+
+        if sparse_output:
+            # Long format, ordered by sample and then category value
+            category_order = np.argsort(np.asarray(categories, dtype=str), kind='stable')
+            sample_i, category_i = np.nonzero(counts_matrix[present][:, category_order])
+            counts_dfs[category_colname] = pd.DataFrame({
+                COLNAME.SAMPLE.value: samples[present][sample_i],
+                category_colname: np.asarray(categories, dtype=object)[category_order][category_i],
+                'counts': counts_matrix[present][:, category_order][sample_i, category_i].astype(np.int64)
+            })
+        else:
+            counts_dfs[category_colname] = pd.DataFrame(
+                data=counts_matrix[present].astype(float), index=list(samples[present]), columns=categories
+            )
+
+    if output_format != 'pandas':
+        index_name = None if sparse_output else COLNAME.SAMPLE.value
+        return { colname: df_to_arrow(counts_df, output_format=output_format, index_name=index_name) for colname, counts_df in counts_dfs.items() }
+    return counts_dfs
@@ -0,0 +1,161 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger
+from .qc import log_drops
+
+# Levels to which a count cube can be rolled up. Every sample belongs to one patient, cancer type, and cohort.
+CUBE_LEVELS = [ COLNAME.SAMPLE.value, COLNAME.PATIENT.value, COLNAME.CANCER_TYPE.value, COLNAME.COHORT.value ]
+
+class CountCube:
+    """Mutation counts of one category column, precomputed once by sample, transcription strand, and category value.
+
+    Counts are stored sparsely, as one entry per non-zero (sample, strand, category) cell,
+    and each sample's patient, cancer type, and cohort are stored once as codes.
+    Rolling up to any level then maps the entries' sample codes to that level and counts them with a single `np.bincount`,
+    rather than grouping the extended dataframe again.
+
+    Parameters
+    ----------
+    extended_df : `pd.DataFrame`
+        An extended simple somatic mutation dataframe (e.g. produced by the `extend_ssm_df` function).
+    category_colname : `str`
+        The category column name.
+    category_values : `list`
+        A list of all possible values for the category column.
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of dropped rows.
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+    """
+    def __init__(self, extended_df, category_colname, category_values, qc_report=None, console_verbosity=logging.DEBUG):
+        get_logger(console_verbosity=console_verbosity)
+
+        expected_cols = CUBE_LEVELS + [ COLNAME.TSTRAND.value, COLNAME.REF.value, COLNAME.VAR.value ]
+        missing_cols = [ c for c in expected_cols if c not in extended_df.columns ]
+        if category_colname not in extended_df.columns:
+            raise ValueError("Input dataframe is missing the category column.")
+        elif len(missing_cols) > 0:
+            raise ValueError("Input dataframe is missing column(s): %s" % ", ".join(missing_cols))
+
+        self.category_colname = category_colname
+        self.category_values = list(category_values)
+
+        category_codes = pd.Categorical(extended_df[category_colname].values, categories=self.category_values).codes.astype(np.int64)
+        na_var = extended_df[COLNAME.VAR.value].isna().values
+        na_ref = extended_df[COLNAME.REF.value].isna().values
+        invalid_category = (category_codes < 0)
+        log_drops('count', [
+            (category_colname, "invalid value", int(invalid_category.sum())),
+            (COLNAME.VAR.value, "NaN value", int((na_var & ~invalid_category).sum())),
+            (COLNAME.REF.value, "NaN value", int((na_ref & ~(invalid_category | na_var)).sum())),
+        ], qc_report=qc_report)
+        sample_codes, samples = pd.factorize(extended_df[COLNAME.SAMPLE.value].values, sort=True)
+        valid = ~(invalid_category | na_var | na_ref) & (sample_codes >= 0)
+
+        # Dimension tables: the levels of each sample (from its first row), and the transcription strand values
+        first_rows = np.unique(sample_codes[valid], return_index=True)[1]
+        first_rows = np.flatnonzero(valid)[first_rows]
+        self.samples = np.asarray(samples, dtype=object)[sample_codes[first_rows]]
+        self.level_codes = {}
+        self.level_values = {}
+        for level in CUBE_LEVELS[1:]:
+            level_values = extended_df[level].values[first_rows].astype(object)
+            level_values[pd.isna(level_values)] = NAN_VAL
+            self.level_codes[level], self.level_values[level] = pd.factorize(level_values, sort=True)
+        self.level_codes[COLNAME.SAMPLE.value] = np.arange(len(self.samples))
+        self.level_values[COLNAME.SAMPLE.value] = self.samples
+        # Sample codes of the cube only cover samples with at least one counted mutation
+        cube_sample_codes = np.full(len(samples), -1, dtype=np.int64)
+        cube_sample_codes[sample_codes[first_rows]] = np.arange(len(first_rows))
+
+        tstrands = extended_df[COLNAME.TSTRAND.value].values[valid].astype(object)
+        tstrands[pd.isna(tstrands)] = NAN_VAL
+        tstrand_codes, self.tstrand_values = pd.factorize(tstrands, sort=True)
+
+        # Sparse entries: the non-zero (sample, strand, category) cells
+        num_categories = len(self.category_values)
+        cell_keys = (cube_sample_codes[sample_codes[valid]] * len(self.tstrand_values) + tstrand_codes) * num_categories + category_codes[valid]
+        cell_keys, self.entry_counts = np.unique(cell_keys, return_counts=True)
+        self.entry_categories = cell_keys % num_categories
+        self.entry_tstrands = (cell_keys // num_categories) % max(len(self.tstrand_values), 1)
+        self.entry_samples = cell_keys // (num_categories * max(len(self.tstrand_values), 1))
+        logging.debug("Built a %s count cube with %d entries for %d samples" % (category_colname, len(self.entry_counts), len(self.samples)))
+
+    def __len__(self):
+        return len(self.entry_counts)
+
+    def rollup(self, levels=COLNAME.SAMPLE.value, by_tstrand=False, sparse_output=False):
+        """Aggregate the counts to one or more levels.
+
+        Parameters
+        ----------
+        levels : `str` or `list`, optional
+            One or more of the sample, patient, cancer type, and cohort column names, by default the sample column name.
+        by_tstrand : `bool`, optional
+            Whether to keep the transcription strand dimension, by default `False`
+        sparse_output : `bool`, optional
+            Whether the returned dataframe will be in a sparse format, by default `False`
+
+        Returns
+        -------
+        `pd.DataFrame`
+            A mutation count dataframe, in the format of `counts_from_extended_ssm_df`. Rolled up to the sample level without strands,
+            it is the same as `counts_from_extended_ssm_df`. If not sparse, index is the level values (a `pd.MultiIndex` for several levels),
+            and with `by_tstrand` the columns are a (transcription strand, category value) `pd.MultiIndex`.
+            If sparse, level, [transcription strand,] category, and counts columns, without zero counts.
+
+        Raises
+        ------
+        `ValueError`
+            Raises error if a level is not one of `CUBE_LEVELS`.
+        """
+        if isinstance(levels, str):
+            levels = [levels]
+        unknown_levels = [ l for l in levels if l not in CUBE_LEVELS ]
+        if len(levels) == 0 or len(unknown_levels) > 0:
+            raise ValueError("Roll-up levels must be among: %s" % ", ".join(CUBE_LEVELS))
+
+        # Map samples to groups (the combinations of level values that occur), which only touches the sample dimension table
+        if len(levels) == 1:
+            sample_groups = self.level_codes[levels[0]]
+            group_codes = np.arange(len(self.level_values[levels[0]]))[:, np.newaxis]
+        else:
+            sample_level_codes = np.stack([ self.level_codes[l] for l in levels ], axis=1)
+            group_codes, sample_groups = np.unique(sample_level_codes, axis=0, return_inverse=True)
+            sample_groups = sample_groups.reshape(-1)
+        num_groups = group_codes.shape[0]
+
+        num_tstrands = len(self.tstrand_values) if by_tstrand else 1
+        num_categories = len(self.category_values)
+        entry_tstrands = self.entry_tstrands if by_tstrand else 0
+        counts_matrix = np.bincount(
+            (sample_groups[self.entry_samples] * num_tstrands + entry_tstrands) * num_categories + self.entry_categories,
+            weights=self.entry_counts, minlength=num_groups * num_tstrands * num_categories
+        ).reshape(num_groups, num_tstrands * num_categories)
+        present = (counts_matrix.sum(axis=1) > 0)
+        group_values = [ np.asarray(self.level_values[l], dtype=object)[group_codes[present, i]] for i, l in enumerate(levels) ]
+
+        if sparse_output:
+            # Long format, ordered by group, strand, and then category value
+            category_order = np.argsort(np.asarray(self.category_values, dtype=str), kind='stable')
+            column_order = (np.arange(num_tstrands)[:, np.newaxis] * num_categories + category_order[np.newaxis, :]).reshape(-1)
+            group_i, column_i = np.nonzero(counts_matrix[present][:, column_order])
+            counts_df = pd.DataFrame({ l: group_values[i][group_i] for i, l in enumerate(levels) })
+            if by_tstrand:
+                counts_df[COLNAME.TSTRAND.value] = np.asarray(self.tstrand_values, dtype=object)[column_order[column_i] // num_categories]
+            counts_df[self.category_colname] = np.asarray(self.category_values, dtype=object)[column_order[column_i] % num_categories]
+            counts_df['counts'] = counts_matrix[present][group_i, column_order[column_i]].astype(np.int64)
+            return counts_df
+
+        if len(levels) == 1:
+            index = list(group_values[0])
+        else:
+            index = pd.MultiIndex.from_arrays(group_values, names=levels)
+        if by_tstrand:
+            columns = pd.MultiIndex.from_product([list(self.tstrand_values), self.category_values], names=[COLNAME.TSTRAND.value, self.category_colname])
+        else:
+            columns = self.category_values
+        return pd.DataFrame(data=counts_matrix[present], index=index, columns=columns)
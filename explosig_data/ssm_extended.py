@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 import pandas as pd
 
 
@@ -7,47 +8,214 @@ from .categories import *
 from .i_o import get_logger, get_df_drop_message
 from .genomes import get_human_genomes_dict
 from .genes import get_human_genes_dict
+from .kernels import resolve_kernel_backend
+from .category_schemes import CategoryScheme
+from .arrow_io import as_pandas_df, check_output_format, df_to_arrow
 
-# Add columns containing five prime and three prime flanking base pairs.
-def add_flanking_columns(df, genomes):
+# Add columns containing five prime and three prime flanking base pairs,
+# and check the reference sequences against the genome (see `check_reference_sequences`).
+def add_flanking_columns(df, genomes, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value):
+    _check_reference_mismatch_policy(reference_mismatch)
 
     # Calculate number of flanking base pairs to add
-    def get_flanking_size(row):
-        return 6 * max( len(row[COLNAME.REF.value]), len(row[COLNAME.VAR.value]) )
-
-    logging.info("Adding 5' flanking base column...")
-
-    # if these are single-base substitution mutations, easy to pass in reference base during this step
-    # to perform additional genome lookup assertions that can catch position indexing differences
-    df[COLNAME.FPRIME.value] = df.apply(lambda row: genomes[row[COLNAME.ASSEMBLY.value]].lflank(
-        chr_name=str(row[COLNAME.CHR.value]),
-        pos=int(row[COLNAME.POS_START.value]),
-        gstrand=row[COLNAME.GSTRAND.value],
-        size=get_flanking_size(row),
-        reference_base=(row[COLNAME.REF.value] if row[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.SBS.value else None)), axis='columns')
-    
-    logging.info("Adding 3' flanking base column...")
+    # (mutations with a NaN allele are left to be dropped by the counts stage)
+    flanking_sizes = 6 * np.maximum(df[COLNAME.REF.value].str.len().fillna(0).values, df[COLNAME.VAR.value].str.len().fillna(0).values).astype(np.int64)
+    pos_starts = df[COLNAME.POS_START.value].values.astype(np.int64)
+    pos_ends = df[COLNAME.POS_END.value].values.astype(np.int64)
+    # Fetch one window per mutation spanning both flanks and the mutated bases, [start - 1 - size, end + size) in 0-based coordinates
+    window_starts = np.maximum(pos_starts - 1 - flanking_sizes, 0)
+    window_ends = pos_ends + flanking_sizes
+
+    logging.info("Adding 5' and 3' flanking base columns...")
+
+    windows = np.empty(df.shape[0], dtype=object)
+    assemblies = df[COLNAME.ASSEMBLY.value].values
+    for assembly in pd.unique(assemblies):
+        rows = np.flatnonzero(assemblies == assembly)
+        for gstrand in pd.unique(df[COLNAME.GSTRAND.value].values[rows]):
+            strand_rows = rows[df[COLNAME.GSTRAND.value].values[rows] == gstrand]
+            windows[strand_rows] = genomes[assembly].seqs(
+                chr_names=df[COLNAME.CHR.value].values[strand_rows].astype(str),
+                starts=window_starts[strand_rows],
+                ends=window_ends[strand_rows],
+                gstrand=gstrand
+            )
+
+    fprime_lens = (pos_starts - 1) - window_starts
+    tprime_starts = pos_ends - window_starts
+    df[COLNAME.FPRIME.value] = [ window[:fprime_len] for window, fprime_len in zip(windows, fprime_lens) ]
+    df[COLNAME.TPRIME.value] = [ window[tprime_start:] for window, tprime_start in zip(windows, tprime_starts) ]
+
+    # The reference sequence lies between the flanks, so it can be checked without another genome lookup
+    genome_refs = [ window[fprime_len:tprime_start] for window, fprime_len, tprime_start in zip(windows, fprime_lens, tprime_starts) ]
+    mismatches = check_reference_sequences(df, genome_refs)
+    return apply_reference_mismatch_policy(df, mismatches, reference_mismatch)
+
+def _check_reference_mismatch_policy(reference_mismatch):
+    policies = [ p.value for p in REF_MISMATCH_POLICY ]
+    if reference_mismatch not in policies:
+        raise ValueError("Invalid reference mismatch policy '%s'. Expected one of %s." % (reference_mismatch, ", ".join(policies)))
+
+# Reference sequences of these lengths (single and doublet base substitutions) are compared as encoded byte matrices, and longer ones row by row
+VECTORIZED_REF_LENGTHS = [1, 2]
+
+_UPPER_CODES = np.arange(256, dtype=np.uint8)
+_UPPER_CODES[ord('a'):ord('z') + 1] -= 32
+
+def _upper_base_codes(seqs, length):
+    # (sequences, length) matrix of upper case byte codes
+    encoded = np.array(seqs, dtype='S%d' % length)
+    return _UPPER_CODES[np.frombuffer(encoded.tobytes(), dtype=np.uint8).reshape(len(seqs), length)]
 
-    df[COLNAME.TPRIME.value] = df.apply(lambda row: genomes[row[COLNAME.ASSEMBLY.value]].rflank(
-        chr_name=str(row[COLNAME.CHR.value]),
-        pos=int(row[COLNAME.POS_END.value]),
-        gstrand=row[COLNAME.GSTRAND.value],
-        size=get_flanking_size(row),
-        reference_base=(row[COLNAME.REF.value] if row[COLNAME.MUT_TYPE.value] == MUT_TYPE_VAL.SBS.value else None)), axis='columns')
+def _is_ascii(seqs):
+    # Whether each sequence can be encoded as single bytes by `_upper_base_codes`
+    return np.array([ not isinstance(seq, str) or len(seq.encode('utf-8')) == len(seq) for seq in seqs ], dtype=bool)
+
+def check_reference_sequences(df, genome_refs):
+    """Compare the reference sequence of each mutation to the genome, catching position indexing differences.
+
+    Mutations without a reference sequence (insertions), or whose reference sequence length does not match its positions, are not checked.
+    Genome bases that are 'N' match any reference base.
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        A standardized simple somatic mutation dataframe.
+    genome_refs : `list`
+        The genome sequence from the start to the end position of each mutation.
+
+    Returns
+    -------
+    `np.array`
+        Boolean array, `True` where the reference sequence does not match the genome.
+    """
+    refs = df[COLNAME.REF.value].values
+    genome_refs = np.asarray(genome_refs, dtype=object)
+    spans = (df[COLNAME.POS_END.value].values - df[COLNAME.POS_START.value].values + 1)
+    # NaN alleles are not checked
+    unchecked = ~pd.isna(refs)
 
+    mismatches = np.zeros(len(refs), dtype=bool)
+    for length in VECTORIZED_REF_LENGTHS:
+        rows = np.flatnonzero(unchecked & (spans == length))
+        if len(rows) == 0:
+            continue
+        try:
+            # One more byte than the span, to find the references that are exactly as long as their span
+            ref_codes = _upper_base_codes(refs[rows], length + 1)
+            genome_codes = _upper_base_codes(genome_refs[rows], length)
+        except UnicodeEncodeError:
+            # Sequences with non-ASCII characters are left to the row by row comparison below
+            rows = rows[_is_ascii(refs[rows]) & _is_ascii(genome_refs[rows])]
+            ref_codes = _upper_base_codes(refs[rows], length + 1)
+            genome_codes = _upper_base_codes(genome_refs[rows], length)
+        checked = (ref_codes[:, length - 1] != 0) & (ref_codes[:, length] == 0) & ((ref_codes[:, 0] != ord('-')) | (length > 1))
+        # Genome sequences clipped at a chromosome end are padded with zeros, which match any base (as with `zip`)
+        differ = ((genome_codes != ord('N')) & (genome_codes != 0) & (genome_codes != ref_codes[:, :length])).any(axis=1)
+        mismatches[rows] = checked & differ
+        unchecked[rows] = False
+
+    # Indels and longer substitutions
+    for i in np.flatnonzero(unchecked):
+        ref, genome_ref = refs[i], genome_refs[i]
+        if isinstance(ref, str) and ref != '-' and len(ref) == spans[i]:
+            mismatches[i] = any(g != 'N' and g != r for g, r in zip(genome_ref.upper(), ref.upper()))
+    return mismatches
+
+def reference_mismatch_report(df, mismatches=None):
+    """Summarize reference sequence mismatches per source (provenance) and sample.
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        A simple somatic mutation dataframe.
+    mismatches : `np.array`, optional
+        Boolean array of mismatches, by default the `COLNAME.REF_MISMATCH` column added by the 'flag' policy.
+
+    Returns
+    -------
+    `pd.DataFrame`
+        Index is (provenance, sample) pairs that have mismatches, columns are the number of rows and the number of mismatched rows.
+    """
+    if mismatches is None:
+        mismatches = df[COLNAME.REF_MISMATCH.value].values
+    report_df = pd.DataFrame({
+        COLNAME.PROVENANCE.value: df[COLNAME.PROVENANCE.value].values,
+        COLNAME.SAMPLE.value: df[COLNAME.SAMPLE.value].values,
+        'rows': 1,
+        'mismatches': np.asarray(mismatches, dtype=np.int64)
+    }).groupby([COLNAME.PROVENANCE.value, COLNAME.SAMPLE.value]).sum()
+    return report_df.loc[report_df['mismatches'] > 0]
+
+def apply_reference_mismatch_policy(df, mismatches, reference_mismatch):
+    num_mismatches = int(mismatches.sum())
+    if num_mismatches > 0:
+        report_df = reference_mismatch_report(df, mismatches)
+        per_provenance = report_df.groupby(level=0)['mismatches'].sum()
+        message = "%d of %d mutations have a reference sequence that does not match the genome (%s)" % (
+            num_mismatches, df.shape[0], ", ".join("%s: %d" % item for item in per_provenance.items())
+        )
+        if reference_mismatch == REF_MISMATCH_POLICY.RAISE.value:
+            first = df.loc[mismatches].iloc[0]
+            raise ValueError("%s, e.g. %s at %s:%d in sample %s." % (
+                message, first[COLNAME.REF.value], first[COLNAME.CHR.value], first[COLNAME.POS_START.value], first[COLNAME.SAMPLE.value]
+            ))
+        logging.warning(message)
+        logging.debug("Reference mismatches per sample:\n%s" % report_df.to_string())
+
+    if reference_mismatch == REF_MISMATCH_POLICY.FLAG.value:
+        df[COLNAME.REF_MISMATCH.value] = mismatches
+    elif reference_mismatch == REF_MISMATCH_POLICY.DROP.value:
+        filtered_df = df.loc[~mismatches]
+        logging.debug(get_df_drop_message(COLNAME.REF.value, "genome mismatch", df, filtered_df))
+        df = filtered_df
     return df
 
 # Add a category column for the given category name and list functions.
-def add_mutation_category_column(df, category_functions):
+# Declarative schemes (see `category_schemes.py`) are classified with their lookup tables, and with a kernel backend (see `kernels.py`),
+# categories that have a batch name function are named all at once.
+def add_mutation_category_column(df, category_functions, kernel_backend=None):
+    # Mutations with a NaN allele are not categorized
+    has_alleles = (df[COLNAME.REF.value].notna() & df[COLNAME.VAR.value].notna()).values
     # Add category column
-    for category_name, (category_name_func, mut_types) in category_functions.items():
+    for category_name, category_function in category_functions.items():
+        if isinstance(category_function, CategoryScheme):
+            category_function = (category_function, category_function.mut_types)
+        category_name_func, mut_types = category_function
         logging.info("Adding category {colname} column...".format(colname=category_name))
-        df[category_name] = df.apply(lambda row: (category_name_func(row) if row[COLNAME.MUT_TYPE.value] in mut_types else NAN_VAL), axis='columns')
+        if isinstance(category_name_func, CategoryScheme):
+            category_names = category_name_func.classify(df, mut_types=mut_types)
+            category_names[~has_alleles] = NAN_VAL
+            df[category_name] = category_names
+            continue
+
+        rows = np.flatnonzero(df[COLNAME.MUT_TYPE.value].isin(mut_types).values & has_alleles)
+        category_names = np.full(df.shape[0], NAN_VAL, dtype=object)
+        if len(rows) > 0:
+            if kernel_backend is not None and category_name_func in BATCH_CATEGORY_NAME_FUNCTIONS:
+                category_names[rows] = BATCH_CATEGORY_NAME_FUNCTIONS[category_name_func](df.iloc[rows], kernel_backend=kernel_backend)
+            else:
+                category_names[rows] = df.iloc[rows].apply(category_name_func, axis='columns').values
+        df[category_name] = category_names
 
     return df
 
 # Add a column specifying whether the mutation is on the transcribed or non-transcribed strand.
-def add_transcription_strand_column(df, genes):
+def add_transcription_strand_column(df, genes, kernel_backend=None):
+    if kernel_backend is not None:
+        tstrands = np.full(df.shape[0], NAN_VAL, dtype=object)
+        assemblies = df[COLNAME.ASSEMBLY.value].values
+        for assembly in pd.unique(assemblies):
+            rows = np.flatnonzero(assemblies == assembly)
+            tstrands[rows] = genes[assembly].strands(
+                chr_names=df[COLNAME.CHR.value].values[rows],
+                positions=df[COLNAME.POS_START.value].values[rows],
+                gstrands=df[COLNAME.GSTRAND.value].values[rows],
+                kernel_backend=kernel_backend
+            )
+        df[COLNAME.TSTRAND.value] = tstrands
+        return df
+
     def determine_tstrand(row):
         try:
             tstrand = genes[row[COLNAME.ASSEMBLY.value]].strand(
@@ -63,35 +231,58 @@ def add_transcription_strand_column(df, genes):
 
     return df
 
+# Category functions used when none are passed to extend_ssm_df.
+def default_category_functions():
+    return {
+        'INDEL_Alexandrov2018_83': (INDEL_Alexandrov2018_83_category_name, [MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value]),
+        'DBS_78': (DBS_78_category_name, [MUT_TYPE_VAL.DBS.value]),
+        'SBS_96': (SBS_96_category_name, [MUT_TYPE_VAL.SBS.value]),
+    }
+
 def extend_ssm_df(ssm_df, category_functions=None, genomes=None, genes=None, 
-                    console_verbosity=logging.DEBUG):
+                    reference_mismatch=REF_MISMATCH_POLICY.RAISE.value, kernel_backend=None, output_format='pandas', console_verbosity=logging.DEBUG):
     """Extend a standardized simple somatic mutation dataframe by adding the following columns: flanking bases, transcription strand, mutation category.
     
     Parameters
     ----------
-    ssm_df : `pd.DataFrame`
-        An already-standardized simple somatic mutation dataframe.
+    ssm_df : `pd.DataFrame`, `pyarrow.Table`, or `polars.DataFrame`
+        An already-standardized simple somatic mutation dataframe, or Arrow table (see `arrow_io.df_from_arrow`).
     category_functions : `dict`, optional
-        Dictionary mapping category column names to tuples: (category_name_func, `list` of applicable mutation type enum values).
+        Dictionary mapping category column names to tuples: (category_name_func, `list` of applicable mutation type enum values),
+        or to `CategoryScheme` objects.
     genomes : `dict`, optional
         Dictionary mapping genome assembly enum values to Genome objects.
     genes : `dict`, optional
         Dictionary mapping genome assembly enum values to GeneLookup objects.
+    reference_mismatch : `str`, optional
+        What to do with mutations whose reference sequence does not match the genome: 'raise' an error, 'drop' the rows,
+        or 'flag' them in a new `COLNAME.REF_MISMATCH` column, by default 'raise'
+    kernel_backend : `str`, optional
+        Run the transcription strand lookups and indel categorization in batch kernels, with the same results: 'python', 'numba',
+        or 'auto' (numba if it is installed), by default `None` (row by row)
+    output_format : `str`, optional
+        Return a 'pandas' dataframe, an 'arrow' table, or a 'polars' dataframe (without the row index), by default 'pandas'
     
     Returns
     -------
     pd.DataFrame
-        Mutation dataframe in the extended format.
+        Mutation dataframe in the extended format (or an Arrow table or Polars dataframe).
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if a reference sequence does not match the genome and `reference_mismatch` is 'raise'.
     """
 
     get_logger(console_verbosity=console_verbosity)
 
     if category_functions == None:
-        category_functions = {
-            'INDEL_Alexandrov2018_83': (INDEL_Alexandrov2018_83_category_name, [MUT_TYPE_VAL.INS.value, MUT_TYPE_VAL.DEL.value]),
-            'DBS_78': (DBS_78_category_name, [MUT_TYPE_VAL.DBS.value]),
-            'SBS_96': (SBS_96_category_name, [MUT_TYPE_VAL.SBS.value]),
-        }
+        category_functions = default_category_functions()
+
+    if kernel_backend is not None:
+        resolve_kernel_backend(kernel_backend)
+    check_output_format(output_format)
+    ssm_df = as_pandas_df(ssm_df)
     
     if genomes == None:
         genomes = get_human_genomes_dict()
@@ -99,9 +290,9 @@ def extend_ssm_df(ssm_df, category_functions=None, genomes=None, genes=None,
     if genes == None:
         genes = get_human_genes_dict()
     
-    ssm_df = add_flanking_columns(ssm_df, genomes)
-    ssm_df = add_transcription_strand_column(ssm_df, genes)
-    ssm_df = add_mutation_category_column(ssm_df, category_functions)
+    ssm_df = add_flanking_columns(ssm_df, genomes, reference_mismatch=reference_mismatch)
+    ssm_df = add_transcription_strand_column(ssm_df, genes, kernel_backend=kernel_backend)
+    ssm_df = add_mutation_category_column(ssm_df, category_functions, kernel_backend=kernel_backend)
 
     #logging.info('Adding distance to previous mutation column')
     #ssm_df = add_dist_to_prev_mut_column(ssm_df)
@@ -109,7 +300,7 @@ def extend_ssm_df(ssm_df, category_functions=None, genomes=None, genes=None,
     #logging.info('Adding rolling mean column')
     #ssm_df = add_rolling_mean_column(ssm_df)
 
-    return ssm_df
+    return df_to_arrow(ssm_df, output_format=output_format)
 
 
 
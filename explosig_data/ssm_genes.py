@@ -0,0 +1,123 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger
+from .qc import log_drops
+from .genes import get_human_genes_dict
+
+
+def _check_columns(ssm_df):
+    expected_cols = [ COLNAME.SAMPLE.value, COLNAME.ASSEMBLY.value, COLNAME.CHR.value, COLNAME.POS_START.value ]
+    missing_cols = [ c for c in expected_cols if c not in ssm_df.columns ]
+    if len(missing_cols) > 0:
+        raise ValueError("Input dataframe is missing column(s): %s" % ", ".join(missing_cols))
+
+def _assembly_groups(ssm_df, genes):
+    # Yields (row positions, GeneLookup) for each genome assembly in the dataframe
+    assembly_codes, assemblies = pd.factorize(ssm_df[COLNAME.ASSEMBLY.value].values)
+    for assembly_code, assembly in enumerate(assemblies):
+        if assembly not in genes:
+            raise ValueError("No gene lookup for genome assembly '%s'." % assembly)
+        yield np.flatnonzero(assembly_codes == assembly_code), genes[assembly]
+
+def add_gene_symbol_column(df, genes=None):
+    """Add a `COLNAME.GENE_SYMBOL` column with the symbols of the genes overlapping the start position of each mutation.
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        A standardized (or extended) simple somatic mutation dataframe.
+    genes : `dict`, optional
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+
+    Returns
+    -------
+    `pd.DataFrame`
+        The dataframe, with comma-separated gene symbols, or `NAN_VAL` for intergenic mutations.
+    """
+    _check_columns(df)
+    if genes == None:
+        genes = get_human_genes_dict()
+
+    gene_symbols = np.full(df.shape[0], NAN_VAL, dtype=object)
+    for rows, lookup in _assembly_groups(df, genes):
+        gene_symbols[rows] = lookup.gene_symbols(df[COLNAME.CHR.value].values[rows], df[COLNAME.POS_START.value].values[rows])
+    df[COLNAME.GENE_SYMBOL.value] = gene_symbols
+    return df
+
+def gene_counts_from_ssm_df(ssm_df, genes=None, sparse_output=True, qc_report=None, console_verbosity=logging.DEBUG):
+    """Construct a gene by sample mutation count dataframe, counting each mutation once for every gene that overlaps its start position.
+
+    Genes are found with one binary search per chromosome, and the (sample, gene) pairs are counted with a single `np.unique`,
+    so that only the non-zero counts are held in memory.
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        A standardized (or extended) simple somatic mutation dataframe.
+    genes : `dict`, optional
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+    sparse_output : `bool`, optional
+        Whether the returned dataframe will be in a sparse format, by default `True`.
+        The matrix format has a cell for every (sample, gene) pair, e.g. 200 million cells for 10,000 samples and 20,000 genes.
+    qc_report : `QCReport`, optional
+        Report to which to add the number of dropped (intergenic) rows.
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `pd.DataFrame`
+        A mutation count dataframe. If sparse, sample, gene symbol, and counts columns, ordered by sample and then gene symbol.
+        If not sparse, index is sample IDs, columns are gene symbols, cells are count values.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if expected columns are missing from the input dataframe, or there is no gene lookup for its genome assembly.
+    """
+    get_logger(console_verbosity=console_verbosity)
+    _check_columns(ssm_df)
+    if genes == None:
+        genes = get_human_genes_dict()
+
+    sample_codes, samples = pd.factorize(ssm_df[COLNAME.SAMPLE.value].values, sort=True)
+
+    pair_sample_codes = []
+    pair_gene_names = []
+    num_intergenic = 0
+    for rows, lookup in _assembly_groups(ssm_df, genes):
+        rows = rows[sample_codes[rows] >= 0]
+        set_ids = lookup.gene_set_ids(ssm_df[COLNAME.CHR.value].values[rows], ssm_df[COLNAME.POS_START.value].values[rows])
+        offsets, members = lookup.gene_set_members()
+        # Expand each row into one (sample, gene) pair per overlapping gene
+        sizes = offsets[set_ids + 1] - offsets[set_ids]
+        num_intergenic += int((sizes == 0).sum())
+        pair_starts = np.repeat(offsets[set_ids], sizes)
+        pair_offsets = np.arange(len(pair_starts)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        pair_sample_codes.append(np.repeat(sample_codes[rows], sizes))
+        pair_gene_names.append(lookup.gene_names[members[pair_starts + pair_offsets]])
+
+    log_drops('gene count', [(COLNAME.POS_START.value, "no overlapping gene", num_intergenic)], qc_report=qc_report)
+
+    pair_sample_codes = np.concatenate(pair_sample_codes + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    gene_codes, gene_names = pd.factorize(np.concatenate(pair_gene_names + [np.zeros(0, dtype=object)]), sort=True)
+    # Count every (sample, gene) pair in one pass, without allocating the full matrix
+    pair_keys, pair_counts = np.unique(pair_sample_codes * len(gene_names) + gene_codes, return_counts=True)
+    pair_sample_codes, pair_gene_codes = np.divmod(pair_keys, max(len(gene_names), 1))
+    logging.debug("Counted %d mutations in %d genes of %d samples" % (int(pair_counts.sum()), len(gene_names), len(np.unique(pair_sample_codes))))
+
+    if sparse_output:
+        return pd.DataFrame({
+            COLNAME.SAMPLE.value: np.asarray(samples, dtype=object)[pair_sample_codes],
+            COLNAME.GENE_SYMBOL.value: np.asarray(gene_names, dtype=object)[pair_gene_codes],
+            'counts': pair_counts.astype(np.int64)
+        })
+
+    # Only samples with at least one counted mutation are included
+    present_samples, pair_rows = np.unique(pair_sample_codes, return_inverse=True)
+    counts_matrix = np.zeros((len(present_samples), len(gene_names)), dtype=float)
+    counts_matrix[pair_rows, pair_gene_codes] = pair_counts
+    return pd.DataFrame(data=counts_matrix, index=list(np.asarray(samples, dtype=object)[present_samples]), columns=list(gene_names))
@@ -0,0 +1,230 @@
+import os
+import json
+import logging
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger, write_df_atomic, write_json_atomic, read_standard_ssm_file
+from .ssm_extended import extend_ssm_df, default_category_functions
+from .ssm_counts import counts_dfs_from_extended_ssm_df
+from .ssm_container import SimpleSomaticMutationContainer
+
+# Map/reduce execution over partitions of a standardized simple somatic mutation dataframe.
+#
+# All coordination happens through files in a shared directory, laid out as follows:
+#
+#   shard_dir/manifest.json                      partitioning scheme and partition IDs
+#   shard_dir/partitions/partition-00000.tsv     standardized rows (written by `partition_ssm_df`)
+#   shard_dir/extended/partition-00000.tsv       extended rows (written by `map_ssm_partition`)
+#   shard_dir/counts/SBS_96/partition-00000.tsv  partial count matrices (written by `map_ssm_partition`)
+#   shard_dir/done/partition-00000.json          completion marker (written last by `map_ssm_partition`)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+PARTITION_BY_SAMPLE = 'sample'
+PARTITION_BY_CHROMOSOME = 'chromosome'
+
+def _partition_path(shard_dir, subdir, partition_id, ext='.tsv'):
+    return os.path.join(shard_dir, subdir, 'partition-%05d%s' % (partition_id, ext))
+
+def read_shard_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_FILENAME)) as f:
+        return json.load(f)
+
+def partition_ssm_df(ssm_df, shard_dir, num_partitions=16, by=PARTITION_BY_SAMPLE):
+    """Split a standardized simple somatic mutation dataframe into partition files in a shared directory.
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        An already-standardized simple somatic mutation dataframe.
+    shard_dir : `str`
+        Path to the shared directory.
+    num_partitions : `int`, optional
+        Number of partitions when partitioning by sample hash, by default 16
+    by : `str`, optional
+        Either `'sample'` (partition by a stable hash of the sample ID, so each sample is in exactly one partition)
+        or `'chromosome'` (one partition per chromosome), by default `'sample'`
+
+    Returns
+    -------
+    `list`
+        The IDs of the non-empty partitions that were written.
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if the partitioning scheme is not recognized.
+    """
+    if by == PARTITION_BY_SAMPLE:
+        # pandas' object hashing uses a fixed key, so assignments are the same on every machine
+        hashes = pd.util.hash_pandas_object(ssm_df[COLNAME.SAMPLE.value], index=False).values
+        partition_ids = (hashes % num_partitions).astype(int)
+    elif by == PARTITION_BY_CHROMOSOME:
+        num_partitions = len(CHROMOSOMES)
+        partition_ids = pd.Categorical(ssm_df[COLNAME.CHR.value].astype(str), CHROMOSOMES).codes
+    else:
+        raise ValueError("Unknown partitioning scheme '%s'." % str(by))
+
+    os.makedirs(os.path.join(shard_dir, 'partitions'), exist_ok=True)
+
+    written_ids = []
+    for partition_id, partition_df in ssm_df.groupby(partition_ids, sort=True):
+        partition_id = int(partition_id)
+        write_df_atomic(partition_df, _partition_path(shard_dir, 'partitions', partition_id), index=False)
+        written_ids.append(partition_id)
+        logging.debug("Wrote partition %d with %d rows" % (partition_id, partition_df.shape[0]))
+
+    # The manifest is written last, so its presence means that all partitions are available
+    write_json_atomic({
+        'by': by,
+        'num_partitions': num_partitions,
+        'partitions': written_ids
+    }, os.path.join(shard_dir, MANIFEST_FILENAME))
+
+    return written_ids
+
+def map_ssm_partition(shard_dir, partition_id, category_lists, category_functions=None, genomes=None, genes=None,
+                        write_extended=True, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value, console_verbosity=logging.DEBUG):
+    """Extend and count a single partition, writing the results to the shared directory.
+
+    Partitions that already have a completion marker are skipped, so the same partition may safely be submitted more than once.
+
+    Parameters
+    ----------
+    shard_dir : `str`
+        Path to the shared directory.
+    partition_id : `int`
+        The partition to process.
+    category_lists : `dict`
+        Dictionary mapping category column names to lists of all possible values for each category column.
+    category_functions : `dict`, optional
+        Dictionary mapping category column names to tuples: (category_name_func, `list` of applicable mutation type enum values).
+        By default, the default category functions of `extend_ssm_df`. Only the columns in `category_lists` are computed.
+    genomes : `dict`, optional
+        Dictionary mapping genome assembly enum values to Genome objects.
+    genes : `dict`, optional
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+    write_extended : `bool`, optional
+        Whether to also write the extended rows of the partition, by default `True`
+    reference_mismatch : `str`, optional
+        What to do with mutations whose reference sequence does not match the genome ('raise', 'drop', or 'flag'), by default 'raise'
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `bool`
+        `True` if the partition was processed, `False` if it had already been completed.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    done_path = _partition_path(shard_dir, 'done', partition_id, ext='.json')
+    if os.path.exists(done_path):
+        logging.debug("Partition %d has already been completed" % partition_id)
+        return False
+
+    if category_functions == None:
+        category_functions = default_category_functions()
+    missing_cols = set(category_lists.keys()) - set(category_functions.keys())
+    if len(missing_cols) > 0:
+        raise ValueError("No category function for category column(s) %s." % ", ".join(sorted(missing_cols)))
+    # Only compute the categories that will be counted
+    category_functions = { colname: category_functions[colname] for colname in category_lists.keys() }
+
+    ssm_df = read_standard_ssm_file(_partition_path(shard_dir, 'partitions', partition_id))
+    extended_df = extend_ssm_df(ssm_df, category_functions=category_functions, genomes=genomes, genes=genes,
+                                reference_mismatch=reference_mismatch, console_verbosity=console_verbosity)
+
+    if write_extended:
+        os.makedirs(os.path.join(shard_dir, 'extended'), exist_ok=True)
+        write_df_atomic(extended_df, _partition_path(shard_dir, 'extended', partition_id), index=False)
+
+    for category_colname, counts_df in counts_dfs_from_extended_ssm_df(extended_df, category_lists).items():
+        os.makedirs(os.path.join(shard_dir, 'counts', category_colname), exist_ok=True)
+        write_df_atomic(counts_df, _partition_path(shard_dir, os.path.join('counts', category_colname), partition_id),
+                        index_label=COLNAME.SAMPLE.value)
+
+    os.makedirs(os.path.join(shard_dir, 'done'), exist_ok=True)
+    write_json_atomic({
+        'partition': partition_id,
+        'rows': int(extended_df.shape[0]),
+        'categories': sorted(category_lists.keys()),
+        'extended': write_extended
+    }, done_path)
+    return True
+
+def reduce_ssm_partitions(shard_dir, category_lists, include_extended=False):
+    """Merge the results of all mapped partitions.
+
+    The merge is deterministic: count matrices are summed in partition order and their rows are sorted by sample ID,
+    and extended rows are sorted by patient, sample, chromosome, and start position (as in `clean_ssm_df`).
+    The merged count matrices are also written to `shard_dir/reduced/counts-<category>.tsv`.
+
+    Parameters
+    ----------
+    shard_dir : `str`
+        Path to the shared directory.
+    category_lists : `dict`
+        Dictionary mapping category column names to lists of all possible values for each category column.
+    include_extended : `bool`, optional
+        Whether to also merge the extended partitions, by default `False`
+
+    Returns
+    -------
+    `SimpleSomaticMutationContainer`
+        A container holding the merged count matrices (and the merged extended dataframe if requested).
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if any partition has not been completed, or was mapped without some of the category columns
+        (or, if `include_extended` is `True`, without writing its extended rows).
+    """
+    manifest = read_shard_manifest(shard_dir)
+    partition_ids = sorted(manifest['partitions'])
+
+    missing_ids = [ i for i in partition_ids if not os.path.exists(_partition_path(shard_dir, 'done', i, ext='.json')) ]
+    if len(missing_ids) > 0:
+        raise ValueError("Partitions have not been completed: %s" % ", ".join(map(str, missing_ids)))
+    unextended_ids = []
+    for partition_id in partition_ids:
+        with open(_partition_path(shard_dir, 'done', partition_id, ext='.json')) as f:
+            done = json.load(f)
+        mapped_categories = done['categories']
+        if not done['extended']:
+            unextended_ids.append(partition_id)
+        missing_cols = sorted(set(category_lists.keys()) - set(mapped_categories))
+        if len(missing_cols) > 0:
+            raise ValueError("Partition %d was mapped without the category column(s) %s (mapped: %s)." % (
+                partition_id, ", ".join(missing_cols), ", ".join(mapped_categories)
+            ))
+    if include_extended and len(unextended_ids) > 0:
+        raise ValueError("Partitions were mapped without writing their extended rows: %s" % ", ".join(map(str, unextended_ids)))
+
+    container = SimpleSomaticMutationContainer(None)
+    os.makedirs(os.path.join(shard_dir, 'reduced'), exist_ok=True)
+
+    for category_colname, category_values in category_lists.items():
+        counts_df = pd.DataFrame(data=0, columns=category_values, index=pd.Index([], name=COLNAME.SAMPLE.value))
+        for partition_id in partition_ids:
+            partial_df = pd.read_csv(_partition_path(shard_dir, os.path.join('counts', category_colname), partition_id),
+                                        sep='\t', index_col=0, dtype={COLNAME.SAMPLE.value: str})
+            counts_df = counts_df.add(partial_df, fill_value=0)
+        counts_df = counts_df[category_values].sort_index()
+        write_df_atomic(counts_df, os.path.join(shard_dir, 'reduced', 'counts-%s.tsv' % category_colname))
+        container.counts_dfs[category_colname] = counts_df
+
+    if include_extended:
+        extended_df = pd.concat([
+            read_standard_ssm_file(_partition_path(shard_dir, 'extended', partition_id))
+            for partition_id in partition_ids
+        ], ignore_index=True)
+        extended_df[COLNAME.CHR.value] = pd.Categorical(extended_df[COLNAME.CHR.value], CHROMOSOMES, ordered=True)
+        extended_df = extended_df.sort_values(
+            [COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value],
+            kind='mergesort'
+        ).reset_index(drop=True)
+        container.extended_df = extended_df
+
+    return container
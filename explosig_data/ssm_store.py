@@ -0,0 +1,238 @@
+import io
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import standard_dtypes, write_df_atomic, write_json_atomic
+
+# A persistent store of a standardized simple somatic mutation dataframe, laid out as follows:
+#
+#   store_dir/mutations.tsv            header + rows sorted by patient, sample, chromosome, and start position
+#   store_dir/samples.tsv              per-sample metadata with the byte offset, byte length, and number of rows of each sample
+#   store_dir/index/<chr>.<array>.npy  per-chromosome arrays sorted by start position: start, end, offset (bytes), length (bytes)
+#   store_dir/manifest.json            written last, so its presence means that the store is complete
+#
+# Since every sample's rows are contiguous, and every row's byte range is indexed by chromosome and position,
+# queries read only the byte ranges of the matching rows.
+
+MUTATIONS_FILENAME = 'mutations.tsv'
+SAMPLES_FILENAME = 'samples.tsv'
+MANIFEST_FILENAME = 'manifest.json'
+INDEX_ARRAYS = ['start', 'end', 'offset', 'length']
+
+SAMPLE_META_COLUMNS = [
+    COLNAME.SAMPLE.value,
+    COLNAME.PATIENT.value,
+    COLNAME.CANCER_TYPE.value,
+    COLNAME.COHORT.value,
+]
+
+def _index_path(store_dir, chromosome, array_name):
+    return os.path.join(store_dir, 'index', '%s.%s.npy' % (chromosome, array_name))
+
+def parse_region(region):
+    """Parse a region given as a `(chromosome, start, end)` tuple or a `'chromosome:start-end'` string (1-based, inclusive)."""
+    if isinstance(region, str):
+        chromosome, _, span = region.partition(':')
+        if span == '':
+            start, end = 1, np.iinfo(np.int64).max
+        else:
+            start, _, end = span.replace(',', '').partition('-')
+            start, end = int(start), int(end)
+        region = (chromosome, start, end)
+    chromosome, start, end = region
+    chromosome = str(chromosome)
+    if chromosome.startswith('chr'):
+        chromosome = chromosome[3:]
+    return (chromosome, int(start), int(end))
+
+def write_ssm_store(ssm_df, store_dir):
+    """Write a standardized simple somatic mutation dataframe (e.g. produced by `clean_ssm_df`) to an indexed store.
+
+    Parameters
+    ----------
+    ssm_df : `pd.DataFrame`
+        An already-standardized simple somatic mutation dataframe.
+    store_dir : `str`
+        Path to the directory in which to write the store.
+
+    Returns
+    -------
+    `SimpleSomaticMutationStore`
+        The opened store.
+    """
+    os.makedirs(os.path.join(store_dir, 'index'), exist_ok=True)
+
+    df = ssm_df[SSM_COLUMNS].copy()
+    df[COLNAME.CHR.value] = pd.Categorical(df[COLNAME.CHR.value].astype(str), CHROMOSOMES, ordered=True)
+    df = df.sort_values([COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value], kind='mergesort')
+    df = df.reset_index(drop=True)
+
+    # Serialize all rows, then find the byte range of each row from the positions of the newlines
+    header = df.iloc[:0].to_csv(sep='\t', index=False).encode()
+    data = df.to_csv(sep='\t', index=False, header=False).encode()
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) + 1
+    offsets = len(header) + np.concatenate([[0], line_ends[:-1]]).astype(np.int64)
+    lengths = (line_ends - np.concatenate([[0], line_ends[:-1]])).astype(np.int64)
+
+    tmp_path = os.path.join(store_dir, MUTATIONS_FILENAME + '.tmp-%d' % os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(data)
+    os.replace(tmp_path, os.path.join(store_dir, MUTATIONS_FILENAME))
+    del data
+
+    # Per-sample byte ranges
+    samples = df[COLNAME.SAMPLE.value].values
+    first_rows = np.flatnonzero(np.concatenate([[True], samples[1:] != samples[:-1]])) if len(samples) > 0 else np.array([], dtype=int)
+    num_rows = np.diff(np.concatenate([first_rows, [len(samples)]]))
+    samples_df = df.loc[first_rows, SAMPLE_META_COLUMNS].reset_index(drop=True)
+    samples_df['offset'] = offsets[first_rows]
+    samples_df['length'] = np.add.reduceat(lengths, first_rows) if len(first_rows) > 0 else []
+    samples_df['rows'] = num_rows
+    if samples_df[COLNAME.SAMPLE.value].duplicated().any():
+        raise ValueError("Sample IDs must be unique across patients to be stored.")
+    write_df_atomic(samples_df, os.path.join(store_dir, SAMPLES_FILENAME), index=False)
+
+    # Per-chromosome coordinate indexes
+    chromosome_codes = df[COLNAME.CHR.value].cat.codes.values
+    starts = df[COLNAME.POS_START.value].values.astype(np.int64)
+    ends = df[COLNAME.POS_END.value].values.astype(np.int64)
+    max_lengths = {}
+    for chromosome_i, chromosome in enumerate(CHROMOSOMES):
+        rows = np.flatnonzero(chromosome_codes == chromosome_i)
+        rows = rows[np.argsort(starts[rows], kind='mergesort')]
+        for array_name, values in zip(INDEX_ARRAYS, [starts, ends, offsets, lengths]):
+            np.save(_index_path(store_dir, chromosome, array_name), values[rows])
+        max_lengths[chromosome] = int((ends[rows] - starts[rows]).max() + 1) if len(rows) > 0 else 0
+
+    write_json_atomic({
+        'rows': int(df.shape[0]),
+        'samples': int(samples_df.shape[0]),
+        'columns': SSM_COLUMNS,
+        'max_mutation_lengths': max_lengths
+    }, os.path.join(store_dir, MANIFEST_FILENAME))
+
+    logging.debug("Wrote store with %d rows and %d samples" % (df.shape[0], samples_df.shape[0]))
+    return SimpleSomaticMutationStore(store_dir)
+
+
+class SimpleSomaticMutationStore:
+    """Random access to a store written by `write_ssm_store`, by sample, cancer type, and genomic region.
+
+    Parameters
+    ----------
+    store_dir : `str`
+        Path to the store directory.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST_FILENAME)) as f:
+            self.manifest = json.load(f)
+        self.samples = pd.read_csv(os.path.join(store_dir, SAMPLES_FILENAME), sep='\t', dtype={
+            COLNAME.SAMPLE.value: str, COLNAME.PATIENT.value: str, COLNAME.CANCER_TYPE.value: str, COLNAME.COHORT.value: str
+        }).set_index(COLNAME.SAMPLE.value, drop=False)
+        self._indexes = {}
+        with open(os.path.join(store_dir, MUTATIONS_FILENAME), 'rb') as f:
+            self.header = f.readline()
+
+    def _index(self, chromosome):
+        # Memory-map the chromosome's index arrays on first use
+        if chromosome not in self._indexes:
+            self._indexes[chromosome] = {
+                array_name: np.load(_index_path(self.store_dir, chromosome, array_name), mmap_mode='r')
+                for array_name in INDEX_ARRAYS
+            }
+        return self._indexes[chromosome]
+
+    def _region_rows(self, region):
+        chromosome, start, end = parse_region(region)
+        if chromosome not in CHROMOSOMES:
+            raise ValueError("Invalid chromosome '%s'." % chromosome)
+        index = self._index(chromosome)
+        # Rows are sorted by start position, and no mutation is longer than the maximum length,
+        # so only rows with start in [start - max_length + 1, end] can overlap the region
+        max_length = self.manifest['max_mutation_lengths'][chromosome]
+        lo = np.searchsorted(index['start'], start - max_length + 1, side='left')
+        hi = np.searchsorted(index['start'], end, side='right')
+        overlaps = (np.asarray(index['end'][lo:hi]) >= start)
+        return np.asarray(index['offset'][lo:hi])[overlaps], np.asarray(index['length'][lo:hi])[overlaps]
+
+    def select_samples(self, samples=None, cancer_types=None):
+        """Get the sample IDs matching a list of samples and/or a list of cancer types (or all sample IDs if neither is given)."""
+        selected = self.samples
+        if samples is not None:
+            selected = selected.loc[selected[COLNAME.SAMPLE.value].isin(set(samples))]
+        if cancer_types is not None:
+            if isinstance(cancer_types, str):
+                cancer_types = [cancer_types]
+            selected = selected.loc[selected[COLNAME.CANCER_TYPE.value].isin(set(cancer_types))]
+        return selected[COLNAME.SAMPLE.value].tolist()
+
+    def query(self, samples=None, cancer_types=None, region=None):
+        """Load the mutations matching all of the given criteria.
+
+        Parameters
+        ----------
+        samples : `list`, optional
+            Sample IDs to include, by default all samples.
+        cancer_types : `str` or `list`, optional
+            Cancer types to include, by default all cancer types.
+        region : `tuple` or `str`, optional
+            A genomic region given as `(chromosome, start, end)` or `'chromosome:start-end'` (1-based, inclusive), by default the whole genome.
+
+        Returns
+        -------
+        `pd.DataFrame`
+            The matching mutations in the standardized format, sorted by patient, sample, chromosome, and start position.
+        """
+        if samples is None and cancer_types is None:
+            sample_rows = self.samples
+        else:
+            sample_rows = self.samples.loc[self.select_samples(samples=samples, cancer_types=cancer_types)]
+
+        if region is None:
+            offsets = sample_rows['offset'].values.astype(np.int64)
+            lengths = sample_rows['length'].values.astype(np.int64)
+        else:
+            offsets, lengths = self._region_rows(region)
+            if samples is not None or cancer_types is not None:
+                # Keep the rows that fall within the byte range of a selected sample
+                sample_rows = sample_rows.sort_values('offset')
+                sample_starts = sample_rows['offset'].values.astype(np.int64)
+                sample_ends = sample_starts + sample_rows['length'].values.astype(np.int64)
+                i = np.searchsorted(sample_starts, offsets, side='right') - 1
+                in_samples = (i >= 0) & (offsets < sample_ends[np.maximum(i, 0)])
+                offsets, lengths = offsets[in_samples], lengths[in_samples]
+        return self._read_ranges(offsets, lengths)
+
+    def load(self):
+        """Load all mutations in the store."""
+        return self.query()
+
+    def _read_ranges(self, offsets, lengths):
+        order = np.argsort(offsets, kind='mergesort')
+        offsets, lengths = offsets[order], lengths[order]
+        buffer = io.BytesIO()
+        buffer.write(self.header)
+        with open(os.path.join(self.store_dir, MUTATIONS_FILENAME), 'rb') as f:
+            # Merge adjacent byte ranges so that each contiguous run is read with a single seek
+            range_start, range_end = None, None
+            for offset, length in zip(offsets.tolist(), lengths.tolist()):
+                if range_end is not None and offset == range_end:
+                    range_end += length
+                    continue
+                if range_start is not None:
+                    f.seek(range_start)
+                    buffer.write(f.read(range_end - range_start))
+                range_start, range_end = offset, offset + length
+            if range_start is not None:
+                f.seek(range_start)
+                buffer.write(f.read(range_end - range_start))
+        buffer.seek(0)
+        df = pd.read_csv(buffer, sep='\t', dtype=standard_dtypes)
+        df[COLNAME.CHR.value] = pd.Categorical(df[COLNAME.CHR.value], CHROMOSOMES, ordered=True)
+        return df
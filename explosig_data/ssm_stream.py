@@ -0,0 +1,150 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from .constants import *
+from .i_o import get_logger, PrefetchIterator
+from .ssm_extended import extend_ssm_df, default_category_functions
+from .ssm_counts import counts_dfs_from_extended_ssm_df
+from .genomes import get_human_genomes_dict
+from .genes import get_human_genes_dict
+
+
+class CountsAccumulator:
+    """A sample x category count matrix that grows as new samples are encountered.
+
+    Parameters
+    ----------
+    category_values : `list`
+        A list of all possible values for the category column. These will become the column names of the output dataframe.
+    """
+    def __init__(self, category_values):
+        self.categories = list(category_values)
+        self.category_index = pd.Index(self.categories)
+        self.samples = []
+        self.sample_index = {}
+        self.counts = np.zeros((0, len(self.categories)), dtype=np.int64)
+
+    def _add_samples(self, samples):
+        for sample in samples:
+            if sample not in self.sample_index:
+                self.sample_index[sample] = len(self.samples)
+                self.samples.append(sample)
+        if len(self.samples) > self.counts.shape[0]:
+            # Grow geometrically so that repeated chunks do not re-copy the matrix every time
+            capacity = max(len(self.samples), 2 * self.counts.shape[0])
+            grown = np.zeros((capacity, len(self.categories)), dtype=np.int64)
+            grown[:self.counts.shape[0]] = self.counts
+            self.counts = grown
+
+    def add(self, sparse_counts_df, category_colname, sample_order=None):
+        """Add counts in the sparse format returned by `counts_from_extended_ssm_df(..., sparse_output=True)`.
+
+        Parameters
+        ----------
+        sparse_counts_df : `pd.DataFrame`
+            Dataframe with sample, category, and `counts` columns.
+        category_colname : `str`
+            The category column name.
+        sample_order : `list`, optional
+            Order in which to register new samples, by default the order of the sparse counts dataframe.
+        """
+        samples = sparse_counts_df[COLNAME.SAMPLE.value].values
+        if sample_order is None:
+            sample_order = pd.unique(samples)
+        else:
+            present_samples = set(samples)
+            sample_order = [s for s in sample_order if s in present_samples]
+        self._add_samples(sample_order)
+
+        rows = np.array([self.sample_index[s] for s in samples], dtype=np.int64)
+        cols = self.category_index.get_indexer(sparse_counts_df[category_colname].values)
+        np.add.at(self.counts, (rows, cols), sparse_counts_df['counts'].values)
+
+    def to_df(self):
+        """Get the accumulated counts.
+
+        Returns
+        -------
+        `pd.DataFrame`
+            Index is sample IDs (in sorted order), columns are category values, cells are count values (as floats),
+            as returned by `counts_from_extended_ssm_df`.
+        """
+        counts_df = pd.DataFrame(data=self.counts[:len(self.samples)].astype(float), index=self.samples, columns=self.categories)
+        return counts_df.sort_index(kind='mergesort')
+
+
+def counts_from_ssm_chunks(ssm_chunks, category_lists, category_functions=None, genomes=None, genes=None,
+                            prefetch_chunks=0, reference_mismatch=REF_MISMATCH_POLICY.RAISE.value, qc_report=None,
+                            console_verbosity=logging.DEBUG):
+    """Construct count matrix dataframes by extending and counting one standardized chunk at a time.
+
+    The extended dataframe is never held in memory as a whole, so memory use is bounded by the chunk size plus the size of the count matrices.
+    Samples may span multiple chunks, since their counts are summed.
+
+    Parameters
+    ----------
+    ssm_chunks : iterable of `pd.DataFrame`
+        Standardized simple somatic mutation dataframes (e.g. produced by `standardize_ICGC_ssm_file_chunks`).
+    category_lists : `dict`
+        Dictionary mapping category column names to lists of all possible values for each category column.
+    category_functions : `dict`, optional
+        Dictionary mapping category column names to tuples: (category_name_func, `list` of applicable mutation type enum values).
+        By default, the default category functions of `extend_ssm_df` for the columns in `category_lists`.
+    genomes : `dict`, optional
+        Dictionary mapping genome assembly enum values to Genome objects.
+    genes : `dict`, optional
+        Dictionary mapping genome assembly enum values to GeneLookup objects.
+    prefetch_chunks : `int`, optional
+        Number of chunks to read and standardize ahead in a background thread while the current chunk is extended, by default 0
+    reference_mismatch : `str`, optional
+        What to do with mutations whose reference sequence does not match the genome ('raise', 'drop', or 'flag'), by default 'raise'
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of rows dropped while counting, by default None
+    console_verbosity : `int`, optional
+        Logging verbosity enum value, by default `logging.DEBUG`
+
+    Returns
+    -------
+    `dict`
+        Dictionary mapping category column names to mutation count dataframes (index is sample IDs, columns are category values).
+
+    Raises
+    ------
+    `ValueError`
+        Raises error if a category column in `category_lists` has no category function.
+    """
+    get_logger(console_verbosity=console_verbosity)
+
+    if category_functions == None:
+        category_functions = default_category_functions()
+    missing_cols = set(category_lists.keys()) - set(category_functions.keys())
+    if len(missing_cols) > 0:
+        raise ValueError("No category function for category column(s) %s." % ", ".join(sorted(missing_cols)))
+    # Only compute the categories that will be counted
+    category_functions = { colname: category_functions[colname] for colname in category_lists.keys() }
+
+    # Load the reference data once rather than for every chunk
+    if genomes == None:
+        genomes = get_human_genomes_dict()
+    if genes == None:
+        genes = get_human_genes_dict()
+
+    accumulators = { colname: CountsAccumulator(values) for colname, values in category_lists.items() }
+
+    num_rows = 0
+    with PrefetchIterator(ssm_chunks, max_prefetch=prefetch_chunks) as ssm_chunks:
+        for chunk_i, ssm_chunk in enumerate(ssm_chunks):
+            if ssm_chunk.shape[0] == 0:
+                continue
+            extended_chunk = extend_ssm_df(ssm_chunk, category_functions=category_functions, genomes=genomes, genes=genes,
+                                            reference_mismatch=reference_mismatch, console_verbosity=console_verbosity)
+            sample_order = pd.unique(extended_chunk[COLNAME.SAMPLE.value].values)
+            counts_dfs = counts_dfs_from_extended_ssm_df(extended_chunk, category_lists, sparse_output=True, qc_report=qc_report)
+            for colname, counts_df in counts_dfs.items():
+                accumulators[colname].add(counts_df, colname, sample_order=sample_order)
+            num_rows += extended_chunk.shape[0]
+            logging.debug("Counted chunk %d (%d rows so far)" % (chunk_i, num_rows))
+            del extended_chunk
+
+    return { colname: accumulator.to_df() for colname, accumulator in accumulators.items() }
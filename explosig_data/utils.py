@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import logging
 
@@ -8,6 +9,7 @@ import yaml
 
 from .constants import *
 from .i_o import get_logger, get_df_drop_message
+from .qc import log_drops, RowMask
 
 
 # Helper functions
@@ -17,50 +19,280 @@ def convert_with_map(row, index, convert_map):
   except KeyError:
     return NAN_VAL
 
-def clean_ssm_df(df):
+def map_values(values, convert_map):
+    # Vectorized `convert_with_map` over an array of values: each value is looked up in an index of the map's keys,
+    # and values that are not keys (index -1) take the appended NAN_VAL
+    mapped_values = np.array(list(convert_map.values()) + [NAN_VAL], dtype=object)
+    return mapped_values[pd.Index(list(convert_map.keys()), dtype=object).get_indexer(values)]
+
+def as_filter_values(values):
+    # Filter arguments may be a single value or a list of values
+    if values is None:
+        return None
+    if isinstance(values, str):
+        return [values]
+    return list(values)
+
+def get_filter_mask(filters):
+    """Combine filters into a single mask of rows to keep.
+
+    Parameters
+    ----------
+    filters : `list`
+        List of (column values, allowed values) tuples, where allowed values may be a single value, a list, or None (no filter).
+
+    Returns
+    -------
+    `np.array` or `None`
+        Boolean array, `True` for rows that pass every filter, or `None` if there are no filters.
+    """
+    mask = None
+    for values, allowed_values in filters:
+        allowed_values = as_filter_values(allowed_values)
+        if allowed_values is None:
+            continue
+        column_mask = pd.Series(values).isin(set(allowed_values)).values
+        mask = column_mask if mask is None else (mask & column_mask)
+    return mask
+
+def chromosome_filter_values(chromosomes):
+    # Match chromosomes given with or without the UCSC-style 'chr' prefix
+    chromosomes = as_filter_values(chromosomes)
+    if chromosomes is None:
+        return None
+    chromosomes = [ (c[3:] if c.startswith('chr') else c) for c in map(str, chromosomes) ]
+    return chromosomes + [ 'chr' + c for c in chromosomes ]
+
+def clean_ssm_df(df, qc_report=None, row_mask=None, row_order=None):
     """Perform the final stage of standardization of a simple somatic mutation dataframe.
     
     Parameters
     ----------
-    df : `pd.DataFrame`
-        A simple somatic mutation dataframe that contains all of the expected columns.
+    df : `pd.DataFrame` or `dict`
+        A simple somatic mutation dataframe that contains all of the expected columns,
+        or a dictionary mapping the expected column names to arrays (or single values) and `'index'` to the row index.
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of dropped rows.
+    row_mask : `RowMask`, optional
+        Rows already dropped by earlier stages, to which the rows dropped here are added. By default, all rows are valid.
+    row_order : `np.array`, optional
+        Order of the rows before sorting (as positions), which decides the order of rows with equal sort keys, by default the order of `df`.
     
     Returns
     -------
     `pd.DataFrame`
         The dataframe with typed columns, sorted rows, and filtered rows (filtered if NaN/invalid chromosome, NaN start pos, or NaN end pos).
+        Only this dataframe is materialized: earlier stages only add to the row mask.
     """
-    # Drop mutations with NaN chromosome
-    filtered_df = df.dropna(subset=[COLNAME.CHR.value])
-    logging.debug(get_df_drop_message(COLNAME.CHR.value, "NaN value", df, filtered_df))
-    df = filtered_df
-
-    # Drop mutations with NaN start position
-    filtered_df = df.dropna(subset=[COLNAME.POS_START.value])
-    logging.debug(get_df_drop_message(COLNAME.POS_START.value, "NaN value", df, filtered_df))
-    df = filtered_df
-
-    # Drop mutations with NaN end position
-    filtered_df = df.dropna(subset=[COLNAME.POS_END.value])
-    logging.debug(get_df_drop_message(COLNAME.POS_END.value, "NaN value", df, filtered_df))
-    df = filtered_df
-    
-    # Drop mutations with invalid chromosome
-    filtered_df = df.loc[df[COLNAME.CHR.value].isin(CHROMOSOMES)]
-    logging.debug(get_df_drop_message(COLNAME.CHR.value, "invalid value", df, filtered_df))
-    df = filtered_df
+    columns = _ssm_columns(df, SSM_COLUMNS)
+    rows = _clean_rows(columns, qc_report=qc_report, row_mask=row_mask, row_order=row_order)
+
+    # Sort the mutations by sample and then genomic location
+    chr_values, pos_starts, pos_ends = _typed_position_columns(columns, rows)
+    sort_df = pd.DataFrame({
+        COLNAME.PATIENT.value: _take(columns[COLNAME.PATIENT.value], rows),
+        COLNAME.SAMPLE.value: _take(columns[COLNAME.SAMPLE.value], rows),
+        COLNAME.CHR.value: chr_values,
+        COLNAME.POS_START.value: pos_starts,
+    })
+    order = sort_df.sort_values(SORT_COLUMNS).index.values
+    return _materialize(columns, rows[order], typed=(chr_values[order], pos_starts[order], pos_ends[order]))
+
+# Final ordering of standardized mutations: by sample and then genomic location
+SORT_COLUMNS = [COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value]
+# Columns with few distinct values, stored as categories in spilled runs
+SPILL_CATEGORY_COLUMNS = [
+    COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CANCER_TYPE.value, COLNAME.PROVENANCE.value, COLNAME.COHORT.value,
+    COLNAME.GSTRAND.value, COLNAME.SEQ_TYPE.value, COLNAME.MUT_TYPE.value, COLNAME.ASSEMBLY.value
+]
+
+def _ssm_columns(df, colnames):
+    # Column arrays (or single values) and the row index, without copying the dataframe
+    if isinstance(df, dict):
+        columns = { c: df[c] for c in colnames }
+        columns['index'] = df['index']
+    else:
+        columns = { c: df[c].values for c in colnames }
+        columns['index'] = df.index
+    return columns
+
+def _take(values, rows):
+    # Rows of a column array, or a single value repeated
+    if np.ndim(values) == 0:
+        # Filled rather than `np.full`, which would create a new string object for every row
+        repeated = np.empty(len(rows), dtype=object)
+        repeated.fill(values)
+        return repeated
+    return values[rows]
+
+def _clean_rows(columns, qc_report=None, row_mask=None, row_order=None):
+    # Add the clean stage drops to the row mask (each row is counted under the first reason that applies),
+    # and return the positions of the remaining rows in the input order
+    num_rows = len(columns['index'])
+    if row_mask is None:
+        row_mask = RowMask(num_rows, qc_report=qc_report)
+    na_chr = pd.isna(columns[COLNAME.CHR.value])
+    row_mask.drop('clean', COLNAME.CHR.value, "NaN value", na_chr)
+    row_mask.drop('clean', COLNAME.POS_START.value, "NaN value", pd.isna(columns[COLNAME.POS_START.value]))
+    row_mask.drop('clean', COLNAME.POS_END.value, "NaN value", pd.isna(columns[COLNAME.POS_END.value]))
+    row_mask.drop('clean', COLNAME.CHR.value, "invalid value", ~pd.Series(columns[COLNAME.CHR.value]).isin(CHROMOSOMES).values)
+
+    if row_order is None:
+        return row_mask.rows()
+    return row_order[row_mask.valid[row_order]]
 
+def _typed_position_columns(columns, rows):
     # Ensure correct types before sorting
-    df[COLNAME.CHR.value] = df[COLNAME.CHR.value].apply(str) # make sure everything is a string
-    df[COLNAME.POS_START.value] = df[COLNAME.POS_START.value].astype(int)
-    df[COLNAME.POS_END.value] = df[COLNAME.POS_END.value].astype(int)
+    chr_values = pd.Categorical([ str(c) for c in columns[COLNAME.CHR.value][rows] ], CHROMOSOMES, ordered=True)
+    pos_starts = columns[COLNAME.POS_START.value][rows].astype(int)
+    pos_ends = columns[COLNAME.POS_END.value][rows].astype(int)
+    return chr_values, pos_starts, pos_ends
 
-    # Sort the mutations by sample and then genomic location
-    df[COLNAME.CHR.value] = pd.Categorical(df[COLNAME.CHR.value], CHROMOSOMES, ordered=True)
-    df = df.sort_values([COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value])
+def _materialize(columns, rows, typed=None):
+    # Build the output dataframe, the only copy of the rows
+    chr_values, pos_starts, pos_ends = typed if typed is not None else _typed_position_columns(columns, rows)
+    typed_columns = { COLNAME.CHR.value: chr_values, COLNAME.POS_START.value: pos_starts, COLNAME.POS_END.value: pos_ends }
+    # Columns are inserted one at a time, since building the dataframe from a dict would copy them again into a single block
+    df = pd.DataFrame(index=columns['index'][rows])
+    for c, values in columns.items():
+        if c != 'index':
+            df[c] = typed_columns[c] if c in typed_columns else _take(values, rows)
+    return df
+
+def _filter_and_type_ssm_df(df, qc_report=None):
+    # Filter and type the rows as in `clean_ssm_df`, without sorting, keeping all columns
+    columns = _ssm_columns(df, df.columns)
+    return _materialize(columns, _clean_rows(columns, qc_report=qc_report))
+
+def _null_last_keys(values):
+    # A null flag and the string values, which compare as `sort_values` orders the column (with nulls last)
+    is_null = pd.isnull(values)
+    return is_null.astype(np.int8), np.where(is_null, '', values).astype(str)
+
+def _sort_keys(df):
+    # Sort keys as arrays, with chromosomes as their ordered codes
+    return (
+        *_null_last_keys(df[COLNAME.PATIENT.value].values),
+        *_null_last_keys(df[COLNAME.SAMPLE.value].values),
+        df[COLNAME.CHR.value].cat.codes.values,
+        df[COLNAME.POS_START.value].values,
+    )
+
+def _keys_at_most(keys, bound):
+    # Vectorized lexicographic comparison of each row's keys with a single bound
+    result = np.zeros(len(keys[0]), dtype=bool)
+    equal = np.ones(len(keys[0]), dtype=bool)
+    for key, bound_key in zip(keys, bound):
+        result |= equal & (key < bound_key)
+        equal &= (key == bound_key)
+    return result | equal
+
+def _spill_run(run_df, run_dir, block_rows):
+    # Write a sorted run as blocks of rows, so that the merge only holds one block per run at a time
+    os.makedirs(run_dir)
+    run_df = run_df.reset_index(drop=True)
+    for col in SPILL_CATEGORY_COLUMNS:
+        run_df[col] = run_df[col].astype('category')
+    block_paths = []
+    for block_start in range(0, run_df.shape[0], block_rows):
+        block_paths.append(os.path.join(run_dir, 'block-%05d.pickle' % len(block_paths)))
+        run_df.iloc[block_start:block_start + block_rows].to_pickle(block_paths[-1])
+    return block_paths
+
+def _read_block(block_path):
+    block_df = pd.read_pickle(block_path)
+    os.remove(block_path)
+    for col in SPILL_CATEGORY_COLUMNS:
+        block_df[col] = block_df[col].astype(object)
+    return block_df
+
+def clean_ssm_chunks(ssm_chunks, run_rows=1000000, chunksize=100000, spill_dir=None, qc_report=None):
+    """Clean and sort simple somatic mutation dataframe chunks that together may not fit in memory, with an external merge sort.
+
+    Each chunk is filtered as in `clean_ssm_df`. Filtered rows are collected into runs of at most `run_rows` rows,
+    and each run is sorted and spilled to a temporary directory. The runs are then merged, holding one block of `chunksize` rows per run in memory.
+    If all rows fit in a single run, nothing is written to disk.
+
+    Parameters
+    ----------
+    ssm_chunks : iterable
+        Simple somatic mutation dataframes that contain all of the expected columns (e.g. from one of the `standardize_*_chunks` functions).
+    run_rows : `int`, optional
+        The maximum number of rows to sort in memory at a time, by default 1000000
+    chunksize : `int`, optional
+        The number of rows per output chunk (and per spilled block), by default 100000
+    spill_dir : `str`, optional
+        Directory in which to create the temporary directory for spilled runs, by default the system temporary directory.
+    qc_report : `QCReport`, optional
+        Report to which to add the numbers of dropped rows.
+
+    Yields
+    ------
+    `pd.DataFrame`
+        Consecutive chunks of the cleaned dataframe, in the order of `clean_ssm_df`.
+    """
+    with tempfile.TemporaryDirectory(prefix='explosig_data_sort_', dir=spill_dir) as tmp_dir:
+        runs = []
+        buffer, buffer_rows = [], 0
+
+        def sorted_buffer():
+            run_df = pd.concat(buffer)
+            return run_df.sort_values(SORT_COLUMNS, kind='mergesort')[SSM_COLUMNS]
+
+        for ssm_chunk in ssm_chunks:
+            ssm_chunk = _filter_and_type_ssm_df(ssm_chunk, qc_report=qc_report)
+            # A chunk may be split between the end of one run and the start of the next
+            while ssm_chunk.shape[0] > 0:
+                piece = ssm_chunk.iloc[:run_rows - buffer_rows]
+                buffer.append(piece)
+                buffer_rows += piece.shape[0]
+                ssm_chunk = ssm_chunk.iloc[piece.shape[0]:]
+                if buffer_rows >= run_rows:
+                    runs.append(_spill_run(sorted_buffer(), os.path.join(tmp_dir, 'run-%05d' % len(runs)), chunksize))
+                    logging.debug("Spilled sorted run %d (%d rows)" % (len(runs), buffer_rows))
+                    buffer, buffer_rows = [], 0
+
+        if len(runs) == 0:
+            # Everything fits in memory
+            if buffer_rows > 0:
+                run_df = sorted_buffer().reset_index(drop=True)
+                for chunk_start in range(0, run_df.shape[0], chunksize):
+                    yield run_df.iloc[chunk_start:chunk_start + chunksize].reset_index(drop=True)
+            return
+        if buffer_rows > 0:
+            runs.append(_spill_run(sorted_buffer(), os.path.join(tmp_dir, 'run-%05d' % len(runs)), chunksize))
+        del buffer
+
+        # K-way merge: rows at or below the smallest last key of the loaded blocks can be output,
+        # since every run's remaining rows sort after its loaded block
+        blocks = [ _read_block(block_paths.pop(0)) for block_paths in runs ]
+        pending = None
+        while len(blocks) > 0:
+            block_keys = [ _sort_keys(block_df) for block_df in blocks ]
+            bound = min(tuple(key[-1] for key in keys) for keys in block_keys)
+            ready, remaining = [], []
+            for block_df, keys in zip(blocks, block_keys):
+                at_most = _keys_at_most(keys, bound)
+                ready.append(block_df.loc[at_most])
+                remaining.append(block_df.loc[~at_most])
+            merged_df = pd.concat(ready, ignore_index=True).sort_values(SORT_COLUMNS, kind='mergesort')
+            pending = merged_df if pending is None else pd.concat([pending, merged_df], ignore_index=True)
+            while pending.shape[0] >= chunksize:
+                yield pending.iloc[:chunksize].reset_index(drop=True)
+                pending = pending.iloc[chunksize:]
 
-    # Restrict to the standard set of columns
-    return df[SSM_COLUMNS]
+            # Load the next block of each run whose loaded block was used up
+            next_blocks, next_runs = [], []
+            for block_df, block_paths in zip(remaining, runs):
+                if block_df.shape[0] == 0:
+                    if len(block_paths) == 0:
+                        continue
+                    block_df = _read_block(block_paths.pop(0))
+                next_blocks.append(block_df)
+                next_runs.append(block_paths)
+            blocks, runs = next_blocks, next_runs
+        if pending is not None and pending.shape[0] > 0:
+            yield pending.reset_index(drop=True)
 
 
 def run_snakemake_with_config(snakefile_path, config):
@@ -16,7 +16,8 @@ setuptools.setup(
     package_data={
         'explosig_data': [
             os.path.join('snakefiles', 'genes', 'human.smk'),
-            os.path.join('snakefiles', 'genomes', 'human.smk')
+            os.path.join('snakefiles', 'genomes', 'human.smk'),
+            os.path.join('snakefiles', 'liftover', 'human.smk')
         ],
     },
     classifiers=[
@@ -24,6 +25,11 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
+    entry_points={
+        'console_scripts': [
+            'explosig-data=explosig_data.cli:main'
+        ],
+    },
     python_requires='>=3.6',
     install_requires=[
         'requests>=2.22.0',
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from explosig_data.constants import *
+from explosig_data.categories import (
+    INDEL_Alexandrov2018_16_category_name, INDEL_Alexandrov2018_83_category_name,
+    INDEL_Alexandrov2018_16_category_names, INDEL_Alexandrov2018_83_category_names,
+    INDEL_Alexandrov2018_category_names_helper
+)
+from explosig_data.genes import GeneLookup
+
+# The batch kernels must give the same results as the row by row functions, with every backend
+BACKENDS = [ 'python', 'numba' ]
+
+BASES = list('ACGT')
+
+@pytest.fixture(params=BACKENDS)
+def kernel_backend(request):
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    return request.param
+
+def random_indel_df(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_rows):
+        unit_length = int(rng.choice([1, 1, 1, 2, 3, 4, 5, 6, 7]))
+        unit = ''.join(rng.choice(BASES, unit_length))
+
+        def flank(length):
+            kind = rng.random()
+            if kind < 0.4:
+                # Copies of the unit, cut at a random point (repeats)
+                seq = (unit * (length // unit_length + 2))[:length]
+                cut = int(rng.integers(0, length + 1))
+                return seq[:cut] + ''.join(rng.choice(BASES, length - cut))
+            if kind < 0.6:
+                # A prefix of the unit (microhomology)
+                shared = int(rng.integers(1, unit_length + 1))
+                return unit[:shared] + ''.join(rng.choice(BASES, length - shared))
+            return ''.join(rng.choice(BASES, length))
+
+        # Flanks as short as the kernels allow (5 units), and longer
+        five_prime = flank(5 * unit_length + int(rng.integers(0, 4)))[::-1]
+        three_prime = flank(5 * unit_length + int(rng.integers(0, 4)))
+        if rng.random() < 0.5:
+            rows.append((five_prime, '-', unit, three_prime))
+        else:
+            rows.append((five_prime, unit, '-', three_prime))
+    return pd.DataFrame(rows, columns=[COLNAME.FPRIME.value, COLNAME.REF.value, COLNAME.VAR.value, COLNAME.TPRIME.value])
+
+def test_indel_category_names(kernel_backend):
+    df = random_indel_df(5000)
+    expected_16 = df.apply(INDEL_Alexandrov2018_16_category_name, axis='columns').values
+    expected_83 = df.apply(INDEL_Alexandrov2018_83_category_name, axis='columns').values
+
+    assert (INDEL_Alexandrov2018_16_category_names(df, kernel_backend=kernel_backend) == expected_16).all()
+    assert (INDEL_Alexandrov2018_83_category_names(df, kernel_backend=kernel_backend) == expected_83).all()
+    # The sample covers repeats and microhomology
+    assert any(n.startswith('DEL_MH_') for n in expected_83)
+    assert any(n.endswith('_5+') for n in expected_83)
+
+def test_indel_category_names_short_flanks(kernel_backend):
+    df = pd.DataFrame([('ACG', 'AC', '-', 'TTTTTTTTTTT')], columns=[COLNAME.FPRIME.value, COLNAME.REF.value, COLNAME.VAR.value, COLNAME.TPRIME.value])
+    with pytest.raises(ValueError):
+        INDEL_Alexandrov2018_83_category_name(df.iloc[0])
+    with pytest.raises(ValueError):
+        INDEL_Alexandrov2018_category_names_helper(df[COLNAME.FPRIME.value].values, df[COLNAME.REF.value].values,
+                                                    df[COLNAME.VAR.value].values, df[COLNAME.TPRIME.value].values, kernel_backend)
+
+@pytest.fixture(scope='module')
+def gene_lookup(tmp_path_factory):
+    # Random (often overlapping) transcripts on both strands, in the refFlat format
+    rng = np.random.default_rng(1)
+    lines = []
+    for i in range(600):
+        chr_name = rng.choice(['1', '2', 'X'])
+        start = int(rng.integers(1, 50000))
+        end = start + int(rng.integers(0, 3000))
+        lines.append('\t'.join(['G%d' % (i % 200), 'NM_%d' % i, 'chr' + chr_name, rng.choice(['+', '-']), str(start), str(end),
+                                str(start), str(end), '1', '%d,' % start, '%d,' % end]))
+    path = tmp_path_factory.mktemp('genes') / 'refFlat.txt'
+    path.write_text('\n'.join(lines) + '\n')
+    return GeneLookup(str(path))
+
+def test_strands(gene_lookup, kernel_backend):
+    rng = np.random.default_rng(2)
+    chr_names = rng.choice(['1', '2', 'X', 'Y'], 5000)
+    positions = rng.integers(1, 55000, 5000)
+
+    expected = []
+    for chr_name, pos in zip(chr_names, positions):
+        try:
+            expected.append(gene_lookup.strand(chr_name, pos, GSTRAND_VAL.PLUS.value))
+        except ValueError:
+            expected.append(NAN_VAL)
+    expected = np.array(expected, dtype=object)
+
+    found = gene_lookup.strands(chr_names, positions, np.full(len(positions), GSTRAND_VAL.PLUS.value), kernel_backend=kernel_backend)
+    assert pd.Series(found).equals(pd.Series(expected))
+    # The sample covers both strands, conflicts, and positions without transcripts
+    assert set(expected) == { TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value, '%s,%s' % (TSTRAND_VAL.PLUS.value, TSTRAND_VAL.MINUS.value), NAN_VAL }
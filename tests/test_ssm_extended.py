@@ -0,0 +1,16 @@
+import numpy as np
+import pandas as pd
+
+from explosig_data.constants import *
+from explosig_data.ssm_extended import check_reference_sequences
+
+def test_check_reference_sequences_non_ascii():
+    df = pd.DataFrame({
+        COLNAME.REF.value: [ 'A', 'É', 'AC', 'AÉ', 'G', 'T' ],
+        COLNAME.POS_START.value: 100,
+        COLNAME.POS_END.value: [ 100, 100, 101, 101, 100, 100 ],
+    })
+    genome_refs = [ 'A', 'A', 'AC', 'AC', 'Ä', 'n' ]
+    # Non-ASCII sequences are compared row by row, and are mismatches
+    expected = np.array([ False, True, False, True, True, False ])
+    np.testing.assert_array_equal(check_reference_sequences(df, genome_refs), expected)
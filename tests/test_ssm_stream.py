@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from explosig_data.constants import *
+from explosig_data.ssm_counts import counts_from_extended_ssm_df
+from explosig_data.ssm_stream import CountsAccumulator
+
+CATEGORIES = [ 'c1', 'c2', 'c3' ]
+
+def random_extended_df(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    extended_colnames = SSM_COLUMNS + [ COLNAME.TSTRAND.value, COLNAME.FPRIME.value, COLNAME.TPRIME.value, COLNAME.MUT_TYPE.value ]
+    extended_df = pd.DataFrame({ c: 'x' for c in extended_colnames }, index=range(num_rows))
+    extended_df[COLNAME.SAMPLE.value] = rng.choice([ 's3', 's1', 's2', 's10' ], num_rows)
+    extended_df['Category'] = rng.choice(CATEGORIES + [ 'other' ], num_rows)
+    return extended_df
+
+def test_counts_accumulator_matches_in_memory_counts():
+    extended_df = random_extended_df(500)
+    expected = counts_from_extended_ssm_df(extended_df, 'Category', CATEGORIES)
+
+    accumulator = CountsAccumulator(CATEGORIES)
+    for chunk_start in range(0, extended_df.shape[0], 70):
+        chunk_df = extended_df.iloc[chunk_start:chunk_start + 70]
+        accumulator.add(counts_from_extended_ssm_df(chunk_df, 'Category', CATEGORIES, sparse_output=True), 'Category')
+
+    pd.testing.assert_frame_equal(expected, accumulator.to_df())
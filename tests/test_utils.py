@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from explosig_data.constants import *
+from explosig_data.utils import clean_ssm_df, clean_ssm_chunks
+
+SORT_KEYS = [ COLNAME.PATIENT.value, COLNAME.SAMPLE.value, COLNAME.CHR.value, COLNAME.POS_START.value ]
+
+def random_ssm_df(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({ c: 'x' for c in SSM_COLUMNS }, index=range(num_rows))
+    patients = rng.choice(np.array([ 'a', 'm', 'z', None ], dtype=object), num_rows)
+    samples = rng.choice(np.array([ 's1', 's2', None ], dtype=object), num_rows)
+    df[COLNAME.PATIENT.value] = patients
+    df[COLNAME.SAMPLE.value] = samples
+    df[COLNAME.CHR.value] = rng.choice(CHROMOSOMES[:3], num_rows)
+    df[COLNAME.POS_START.value] = rng.integers(1, 100, num_rows)
+    df[COLNAME.POS_END.value] = df[COLNAME.POS_START.value]
+    # Unique values, to compare rows that share their sort keys
+    df[COLNAME.REF.value] = [ str(i) for i in range(num_rows) ]
+    return df
+
+def test_clean_ssm_chunks_null_keys():
+    df = random_ssm_df(300)
+    expected = clean_ssm_df(df.copy()).reset_index(drop=True)
+
+    chunks = [ df.iloc[i:i + 50] for i in range(0, df.shape[0], 50) ]
+    got = pd.concat(list(clean_ssm_chunks(chunks, run_rows=60, chunksize=40)), ignore_index=True)
+
+    pd.testing.assert_frame_equal(expected[SORT_KEYS], got[SORT_KEYS])
+    by_row = SORT_KEYS + [ COLNAME.REF.value ]
+    pd.testing.assert_frame_equal(
+        expected.sort_values(by_row).reset_index(drop=True)[SSM_COLUMNS],
+        got.sort_values(by_row).reset_index(drop=True)[SSM_COLUMNS]
+    )